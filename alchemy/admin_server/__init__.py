@@ -61,7 +61,12 @@ def create_app(test_config=None):
         status = dict()
         status_map = {True: 'ok', False: 'error'}
         status['web'] = status_map[True]
-        status['celery'] = status_map[health_check.check_celery()]
+        # Read from the heartbeats of the workers, so this is cheap enough to
+        # poll.
+        celery_status = health_check.get_celery_status()
+        status['celery'] = status_map[health_check.check_celery(celery_status)]
+        if celery_status is not None:
+            status['queues'] = celery_status
         return json.dumps(status)
 
     # TODO insecure way to access local files
@@ -12,6 +12,7 @@ from alchemy.db.model import (
 )
 from alchemy.shared.auth_backends import auth
 from alchemy.shared.component import annotation_dao
+from alchemy.shared.statistics_refresh import schedule_refresh_for_labels
 from .annotations_utils import parse_bulk_upload_v2_form, parse_form
 
 bp = Blueprint("annotations", __name__, url_prefix="/annotations")
@@ -89,6 +90,8 @@ def bulk_post_positive_annotations():
             db.session.rollback()
             raise
 
+        schedule_refresh_for_labels(db.session, labels)
+
         flash(
             f"Inserted or updated {len(entities)} annotations "
             f'from user="{user.username}"'
@@ -158,6 +161,7 @@ def bulk_post():
             requests.append(AnnotationUpsertRequest.from_dict(dict_data=dict_data))
 
         annotation_dao.upsert_annotations_bulk(requests)
+        schedule_refresh_for_labels(db.session, [label])
 
         flash(
             f"Inserted or updated {len(values)} annotations for "
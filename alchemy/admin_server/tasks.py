@@ -17,10 +17,7 @@ from flask import (
 from werkzeug.utils import secure_filename
 
 from alchemy.ar.ar_celery import generate_annotation_requests
-from alchemy.ar.data import (
-    compute_annotation_statistics_db,
-    compute_annotation_request_statistics,
-)
+from alchemy.ar.data import fetch_task_statistics, load_task_statistics
 from alchemy.data.request.task_request import TaskCreateRequest
 from alchemy.data.request.task_request import TaskUpdateRequest
 from alchemy.db.model import (
@@ -39,11 +36,8 @@ from alchemy.shared.annotation_server_path_finder import (
     generate_annotation_server_admin_examine_link,
     generate_annotation_server_compare_link,
 )
-from alchemy.shared.celery_job_status import (
-    CeleryJobStatus,
-    create_status,
-    delete_status,
-)
+from alchemy.shared import statistics_refresh
+from alchemy.shared.celery_job_status import CeleryJobStatus, create_status
 from alchemy.shared.component import task_dao
 from alchemy.shared.auth_backends import auth
 from alchemy.shared.utils import (
@@ -111,6 +105,7 @@ def create():
             }
         )
         task = task_dao.create_task(create_request=create_request)
+        statistics_refresh.invalidate_label_tasks()
 
         return redirect(url_for("tasks.show", id=task.id))
     except Exception as e:
@@ -155,27 +150,35 @@ def show(id):
 
     # -------------------------------------------------------------------------
     # Annotations
-    annotation_statistics_per_label = dict()
-    for label in task.get_labels():
-        annotation_statistics_per_label[label] = compute_annotation_statistics_db(
-            dbsession=db.session, label=label, task_id=id
-        )
-
-    annotation_request_statistics = compute_annotation_request_statistics(
-        dbsession=db.session, task_id=id
-    )
-
-    status_assign_jobs_active = []
-    status_assign_jobs_stale = []
-    for cjs in CeleryJobStatus.fetch_all_by_context_id(f"assign:{task.id}"):
-        if cjs.is_stale():
-            status_assign_jobs_stale.append(cjs)
-        else:
-            status_assign_jobs_active.append(cjs)
-
-    # TODO delete stale jobs on a queue, instead of here.
-    for cjs in status_assign_jobs_stale:
-        delete_status(cjs.celery_id, cjs.context_id)
+    # Computed in the background when the annotations change, see
+    # alchemy.shared.statistics_refresh.
+    task_statistics = fetch_task_statistics(db.session, task.id)
+    if task_statistics is None or set(task.get_labels()) != set(
+        task_statistics.statistics["labels"]
+    ):
+        # Never computed, or the labels of the task changed: show them once
+        # they're computed.
+        task_statistics = None
+        statistics_refresh.schedule_refresh([task.id])
+    elif task_statistics.get_age_seconds() > statistics_refresh.get_max_age():
+        statistics_refresh.schedule_refresh([task.id])
+
+    annotation_statistics_per_label = None
+    annotation_request_statistics = None
+    statistics_computed_at = None
+    if task_statistics is not None:
+        (
+            annotation_statistics_per_label,
+            annotation_request_statistics,
+        ) = load_task_statistics(task_statistics.statistics, task.id)
+        statistics_computed_at = task_statistics.get_computed_at_utc()
+
+    # Stale jobs are deleted by ar_celery.sweep_job_statuses.
+    status_assign_jobs_active = [
+        cjs
+        for cjs in CeleryJobStatus.fetch_all_by_context_id(f"assign:{task.id}")
+        if not cjs.is_stale()
+    ]
 
     # Admin Examine Links
     admin_examine_links = [
@@ -233,6 +236,7 @@ def show(id):
         task=task,
         annotation_statistics_per_label=annotation_statistics_per_label,
         annotation_request_statistics=annotation_request_statistics,
+        statistics_computed_at=statistics_computed_at,
         status_assign_jobs=status_assign_jobs_active,
         models_per_label=models_per_label,
         deployment_configs_per_model=deployment_configs_per_model,
@@ -292,6 +296,9 @@ def update(id):
         )
         task_dao.update_task(update_request)
         logging.info("Updated tasks and deleted requests from removed " "annotators.")
+        statistics_refresh.invalidate_label_tasks()
+        # The requests of the removed annotators are gone.
+        statistics_refresh.schedule_refresh([task.id])
         return redirect(url_for("tasks.show", id=task.id))
     except Exception as e:
         error = str(e)
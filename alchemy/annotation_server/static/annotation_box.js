@@ -112,38 +112,38 @@ class AnnotationBox extends React.Component {
         var textStyle = { padding: '5px' };
 
         if (req.pattern_info !== undefined && req.pattern_info !== null) {
-            let tokens = req.pattern_info.tokens;
-            let matches = req.pattern_info.matches;
-
-            var rendered_tokens = [];
-
-            function isMatch(i) {
-                /** Easy way to check matches. */
-                for (let idx in matches) {
-                    let match = matches[idx];
-                    if (match[0] <= i && i < match[1]) {
-                        return true;
-                    }
+            // Offsets count code points, like Python does.
+            let chars = Array.from(req.data.text || "");
+            let slice = (start, end) => chars.slice(start, end).join("");
+            // (start, end) character offsets of the matches, sorted by start.
+            let spans = req.pattern_info.spans || [];
+
+            var rendered_text = [];
+            var pos = 0;
+            for (var i = 0; i < spans.length; i++) {
+                let start = Math.max(spans[i][0], pos);
+                var end = spans[i][1];
+                // Merge the matches that overlap, they have the same color.
+                while (i + 1 < spans.length && spans[i + 1][0] <= end) {
+                    i++;
+                    end = Math.max(end, spans[i][1]);
                 }
-                return false;
-            }
-
-            for (var i = 0; i < tokens.length; i++) {
-                if (isMatch(i)) {
-                    // Current token was matched
-                    rendered_tokens.push(
-                        <span style={{ padding: '3px', display: 'inline-block', backgroundColor: "yellow", color: "black" }} key={i.toString()}>{tokens[i]}</span>
-                    );
-                } else {
-                    rendered_tokens.push(
-                        <span style={{ padding: '3px', display: 'inline-block' }} key={i.toString()}>{tokens[i]}</span>
-                    )
+                if (start >= end) {
+                    continue;
+                }
+                if (pos < start) {
+                    rendered_text.push(slice(pos, start));
                 }
+                rendered_text.push(
+                    <span style={{ backgroundColor: "yellow", color: "black" }} key={start.toString()}>{slice(start, end)}</span>
+                );
+                pos = end;
             }
+            rendered_text.push(slice(pos));
 
             content.push(
                 <div style={textStyle} key='rendered_tokens'>
-                    {rendered_tokens}
+                    {rendered_text}
                 </div>
             );
         } else {
@@ -31,6 +31,7 @@ from alchemy.db.model import (
     get_or_create,
 )
 from alchemy.shared.auth_backends import auth
+from alchemy.shared.statistics_refresh import schedule_refresh_for_labels
 
 bp = Blueprint("tasks", __name__, url_prefix="/tasks")
 
@@ -160,6 +161,14 @@ def receive_annotation():
     entity = data["req"]["entity"]
 
     context = {"data": data["req"]["data"], "pattern_info": data["req"]["pattern_info"]}
+    # Share the request's context instead of copying it, if it has one.
+    entity_context_id = (
+        db.session.query(AnnotationRequest.entity_context_id)
+        .filter(AnnotationRequest.id == ar_id)
+        .scalar()
+    )
+    if entity_context_id is not None:
+        context = None
 
     annotation_result = data["anno"]["labels"]
     annotation_logging_msg = ""
@@ -193,6 +202,7 @@ def receive_annotation():
                 label=label,
                 user_id=user_id,
                 context=context,
+                entity_context_id=entity_context_id,
                 value=value,
             )
             annotation_logging_msg = (
@@ -222,6 +232,8 @@ def receive_annotation():
         db.session.rollback()
         raise e
 
+    schedule_refresh_for_labels(db.session, annotation_result)
+
     next_ar_id = get_next_ar_id_from_db(
         dbsession=db.session, task_id=task_id, user_id=user_id, current_ar_id=ar_id
     )
@@ -299,7 +311,8 @@ def update_annotation():
         )
         if annotation:
             annotation.value = value
-            annotation.context = context
+            if annotation.entity_context_id is None:
+                annotation.context = context
         else:
             # In case the user forgot to annotate this label in the last pass.
             annotation = ClassificationAnnotation(
@@ -317,6 +330,8 @@ def update_annotation():
         db.session.rollback()
         raise
 
+    schedule_refresh_for_labels(db.session, annotation_result)
+
     return {"redirect": data.get("update_redirect_link")}
 
 
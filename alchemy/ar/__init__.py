@@ -1,12 +1,17 @@
 # Annotation Request Module
+import heapq
 import logging
 import os
-from collections import namedtuple
-from typing import Dict, List
+from collections import defaultdict, namedtuple
+from typing import Dict, List, Optional, Set, Tuple
 
 import numpy as np
+from envparse import env
 
+from alchemy.ar.example_store import EntityIndex, Example, ExampleStore
+from alchemy.ar.pattern_matches import PatternMatches
 from alchemy.db.fs import raw_data_dir
+from alchemy.db.raw_data_index import get_raw_data_index
 from alchemy.db.model import (
     AnnotationValue,
     ClassificationAnnotation,
@@ -16,21 +21,36 @@ from alchemy.db.model import (
     get_latest_model_for_label,
     _convert_to_spacy_patterns
 )
-from alchemy.inference import ITextCatModel, get_predicted
+from alchemy.inference import ITextCatModel
+from alchemy.inference.cache import (
+    get_cache_key,
+    load_cached_scores,
+    save_cached_scores,
+    start_data_file,
+)
 from alchemy.inference.nlp_model import (
+    InferenceBudget,
     NLPModel,
     NLPModelBottomResults,
     NLPModelTopResults,
 )
 from alchemy.inference.pattern_model import PatternModel
 from alchemy.inference.random_model import RandomModel
-from alchemy.shared.utils import load_jsonl
+from alchemy.shared.utils import iter_jsonl_chunks
+from alchemy.train.no_deps.raw_data_columns import DOMAIN, TEXT, load_raw_data_columns
 
-Example = namedtuple(
-    "Example", ["score", "entity_type", "entity", "label", "fname", "line_number"]
-)
 LookupKey = namedtuple("LookupKey", ["entity_type", "entity", "label", "user"])
 
+# The best examples according to a model (by name), and the proportion of the
+# ranked examples that should come from that model.
+Candidates = namedtuple("Candidates", ["model", "proportion", "examples"])
+
+# Number of picks to draw at a time when shuffling examples together.
+_SHUFFLE_BATCH_SIZE = 4096
+
+# Number of entities to look up at a time when building the blacklist.
+_BLACKLIST_QUERY_BATCH_SIZE = 500
+
 
 def get_pattern_model_for_label(dbsession, label):
     label_patterns = dbsession.query(LabelPatterns).filter_by(label=label).first()
@@ -55,74 +75,160 @@ def get_nlp_models_for_label(dbsession, label):
     latest_model = get_latest_model_for_label(dbsession=dbsession, label=label)
 
     if latest_model and latest_model.is_ready():
-        highest_entropy_model = NLPModel(dbsession, latest_model.id)
-        top_prob_model = NLPModelTopResults(dbsession, latest_model.id)
-        bottom_prob_model = NLPModelBottomResults(dbsession, latest_model.id)
+        # The models share their predictions, so they share the budget to
+        # infer the texts that don't have any yet.
+        budget = InferenceBudget()
+        highest_entropy_model = NLPModel(dbsession, latest_model.id, budget)
+        top_prob_model = NLPModelTopResults(dbsession, latest_model.id, budget)
+        bottom_prob_model = NLPModelBottomResults(dbsession, latest_model.id, budget)
 
     return highest_entropy_model, top_prob_model, bottom_prob_model
 
 
-def get_ranked_examples_for_label(dbession, label, data_filenames) -> List[Example]:
-    """Get examples in data_filenames for this label in ranked order.
-    A lower ranking means higher desire to be labeled.
-    """
-    logging.info(f"Get prediction from label={label}")
-
-    examples: List[List[Example]] = []
+def get_models_for_label(dbsession, label) -> Tuple[List[ITextCatModel], List[int]]:
+    """The models to rank examples for this label with, and the proportion of
+    the ranked examples that should come from each of them."""
+    models: List[ITextCatModel] = []
     proportions: List[int] = []
 
-    # TODO do not hard-code
-    from alchemy.db.model import EntityTypeEnum
-
-    entity_type = EntityTypeEnum.COMPANY
-
-    def get_examples_for_model(model: ITextCatModel):
-        return _get_examples(data_filenames, model, entity_type, label)
-
     # Random Examples
-    examples.append(get_examples_for_model(RandomModel()))
+    models.append(RandomModel())
     proportions.append(1)
-    logging.info("Prediction from random model finished")
 
     # Pattern-driven Examples
-    _patterns_model = get_pattern_model_for_label(dbession, label)
+    _patterns_model = get_pattern_model_for_label(dbsession, label)
     if _patterns_model:
-        examples.append(get_examples_for_model(_patterns_model))
+        models.append(_patterns_model)
         proportions.append(3)  # [1,3] -> [0.25, 0.75]
-        logging.info("Prediction from pattern model finished")
 
     # NLP-driven Examples
     highest_entropy_model, top_prob_model, bottom_prob_model = get_nlp_models_for_label(
-        dbession, label
+        dbsession, label
     )
 
     if highest_entropy_model:
-        examples.append(get_examples_for_model(highest_entropy_model))
+        models.append(highest_entropy_model)
         proportions.append(12)  # [1,3,12] -> [0.0625, 0.1875, 0.75]
-        logging.info("Prediction from highest entropy nlp model finished")
 
     if top_prob_model:
-        examples.append(get_examples_for_model(top_prob_model))
+        models.append(top_prob_model)
         proportions.append(6)  # [1,3,12,6] -> [0.05, 0.14, 0.55, 0.27]
-        logging.info("Prediction from top prob nlp model finished")
 
     if bottom_prob_model:
-        examples.append(get_examples_for_model(bottom_prob_model))
+        models.append(bottom_prob_model)
         proportions.append(6)  # [1,3,12,6,6] -> [0.04, 0.11, 0.43, 0.21, 0.21]
-        logging.info("Prediction from bottom prob nlp model finished")
 
-    ranked_examples = _shuffle_together_examples(examples, proportions=proportions)
+    return models, proportions
+
+
+def get_candidates_for_label(
+    dbsession,
+    label,
+    data_filenames,
+    limit=None,
+    chunk_size=None,
+    entity_index: Optional[EntityIndex] = None,
+    pattern_matches: Optional[PatternMatches] = None,
+) -> List[Candidates]:
+    """Get the best examples in data_filenames for this label, according to
+    each of the label's models. See get_ranked_examples_for_label for the
+    inputs.
+
+    Returns Candidates whose `model` is the name of the model, so candidates
+    from different data files can be merged with `rank_candidates`.
+    """
+    logging.info(f"Get prediction from label={label}")
+
+    # TODO do not hard-code
+    from alchemy.db.model import EntityTypeEnum
+
+    entity_type = EntityTypeEnum.COMPANY
+
+    models, proportions = get_models_for_label(dbsession, label)
+    examples = _get_examples_for_models(
+        data_filenames,
+        models,
+        entity_type,
+        label,
+        limit=limit,
+        chunk_size=chunk_size,
+        entity_index=entity_index,
+        pattern_matches=pattern_matches,
+    )
+    logging.info(f"Prediction from {len(models)} models finished")
+
+    return [
+        Candidates(type(model).__name__, proportion, ex)
+        for model, proportion, ex in zip(models, proportions, examples)
+    ]
+
+
+def rank_candidates(
+    candidates: List[Candidates], limit: Optional[int] = None
+) -> ExampleStore:
+    """Shuffle together the candidates of the models of a label, e.g. from
+    `get_candidates_for_label` on different data files, into one ranked list.
+    Candidates of the same model are merged, keeping the best `limit`.
+    """
+    examples_per_model: Dict[str, List[ExampleStore]] = {}
+    proportions: Dict[str, float] = {}
+    for x in candidates:
+        examples_per_model.setdefault(x.model, []).append(x.examples)
+        proportions[x.model] = x.proportion
+
+    examples = []
+    for stores in examples_per_model.values():
+        merged = ExampleStore.concat(stores)
+        examples.append(merged.top_k(limit) if limit is not None else merged)
+
+    ranked_examples = _shuffle_together_examples(
+        examples, proportions=list(proportions.values())
+    )
     logging.info("Shuffle together examples finished")
 
     return ranked_examples
 
 
+def get_ranked_examples_for_label(
+    dbession,
+    label,
+    data_filenames,
+    limit=None,
+    chunk_size=None,
+    entity_index: Optional[EntityIndex] = None,
+    pattern_matches: Optional[PatternMatches] = None,
+) -> ExampleStore:
+    """Get examples in data_filenames for this label in ranked order.
+    A lower ranking means higher desire to be labeled.
+
+    Inputs:
+        limit: If set, only keep the top `limit` examples per model while
+            streaming through the data, so memory is bounded by `limit`
+            instead of the size of the dataset.
+        chunk_size: Number of rows to read and score at a time.
+        entity_index: Share this across labels so their examples can be
+            consolidated by entity id.
+        pattern_matches: If set, record the matches of the label's patterns
+            on the candidate examples here.
+    """
+    candidates = get_candidates_for_label(
+        dbession,
+        label,
+        data_filenames,
+        limit=limit,
+        chunk_size=chunk_size,
+        entity_index=entity_index,
+        pattern_matches=pattern_matches,
+    )
+    return rank_candidates(candidates)
+
+
 def consolidate_ranked_examples_per_label(
-    ranked_examples_per_label: List[List[Example]]
-) -> List[Example]:
+    ranked_examples_per_label: List[ExampleStore]
+) -> ExampleStore:
     """
     Inputs:
-        ranked_examples_per_label: Each element in this list, List[Example], 
+        ranked_examples_per_label: Each element in this list, an ExampleStore,
             represents the ranked examples according to a label.
     """
     # A naive way to consolidate is just to round-robin preferences across all
@@ -139,21 +245,18 @@ def consolidate_ranked_examples_per_label(
     # Note: Our current algo assumes all labels are weighted equally - in the
     # future we can add something to favor certain labels over others.
 
-    seen = set()
-    res = []
-    i = 0
-    max_len = max([len(ls) for ls in ranked_examples_per_label])
-    while i < max_len:
-        for ls in ranked_examples_per_label:
-            if i < len(ls):
-                example = ls[i]
-                # print(example)
-                if example.entity not in seen:
-                    seen.add(example.entity)
-                    res.append(example)
-        i += 1
+    combined = ExampleStore.concat(ranked_examples_per_label)
 
-    return res
+    # Visit the rows in round-robin order, i.e. by rank first then by label,
+    # and keep the first occurrence of each entity.
+    ranks = np.concatenate([np.arange(len(ls)) for ls in ranked_examples_per_label])
+    which_list = np.concatenate(
+        [np.full(len(ls), i) for i, ls in enumerate(ranked_examples_per_label)]
+    )
+    order = np.lexsort((which_list, ranks))
+    _, first_idx = np.unique(combined.entity_ids[order], return_index=True)
+
+    return combined.take(order[np.sort(first_idx)])
 
 
 def generate_annotation_requests(
@@ -161,21 +264,69 @@ def generate_annotation_requests(
 ):
     """
     NOTE: This could be super slow, but that's okay for now!
+
+    See alchemy.ar.ar_celery for a version that ranks the examples of each
+    label and data file in parallel.
     """
     task = dbsession.query(Task).filter_by(id=task_id).one_or_none()
     assert task is not None, f"Task is missing task_id={task_id}"
 
-    # TODO Restrict each task to use only 1 file?
-    data_filenames = [
-        os.path.join(raw_data_dir(), fname)
-        for fname in task.get_data_filenames()
-    ]
+    data_filenames = get_data_filenames(task)
+    limit = get_candidate_limit(task, max_per_annotator)
+    chunk_size = get_chunk_size()
 
+    entity_index = EntityIndex()
     ranked_examples_per_label = []
+    # The pattern matches found while ranking, to decorate the examples with.
+    pattern_matches_per_label = {}
     for label in task.get_labels():
-        _res = get_ranked_examples_for_label(dbsession, label, data_filenames)
+        pattern_matches_per_label[label] = PatternMatches(data_filenames)
+        _res = get_ranked_examples_for_label(
+            dbsession,
+            label,
+            data_filenames,
+            limit=limit,
+            chunk_size=chunk_size,
+            entity_index=entity_index,
+            pattern_matches=pattern_matches_per_label[label],
+        )
         ranked_examples_per_label.append(_res)
 
+    return generate_annotation_requests_for_ranked_examples(
+        dbsession,
+        task,
+        ranked_examples_per_label,
+        max_per_annotator,
+        max_per_dp,
+        pattern_matches_per_label=pattern_matches_per_label,
+    )
+
+
+def generate_annotation_requests_for_ranked_examples(
+    dbsession,
+    task: Task,
+    ranked_examples_per_label: List[ExampleStore],
+    max_per_annotator: int,
+    max_per_dp: int,
+    pattern_matches_per_label: Optional[Dict[str, PatternMatches]] = None,
+    labels: Optional[List[str]] = None,
+):
+    """The second half of generate_annotation_requests: assign the ranked
+    examples of each label of the task to the annotators, and decorate them.
+
+    Inputs:
+        ranked_examples_per_label: From get_ranked_examples_for_label, in the
+            same order as `labels`.
+        pattern_matches_per_label: The pattern matches recorded while
+            ranking, if any.
+        labels: The labels the examples were ranked for, defaults to
+            task.get_labels().
+    """
+    if pattern_matches_per_label is None:
+        pattern_matches_per_label = {}
+    if labels is None:
+        labels = task.get_labels()
+
     ranked_examples = consolidate_ranked_examples_per_label(ranked_examples_per_label)
 
     # Blacklist whatever users have labeled already
@@ -183,26 +334,29 @@ def generate_annotation_requests(
     # be able to find if there are exisiting requests for this user and
     # entity under this task. If so, skip those.
     logging.info("Constructing blacklisting criteria...")
-    lookup = _build_blacklist_lookup(dbsession, task.get_labels())
-    blacklist_fn = _build_blacklist_fn(lookup)
+    lookup = _build_blacklist_lookup(
+        dbsession, labels, entities=ranked_examples.unique_entities()
+    )
+    blacklist_fn = _build_blacklist_fn_for_store(lookup, ranked_examples)
 
     logging.info("Assigning to annotators...")
-    assignments = _assign(
-        ranked_examples,
+    # Assign row ids of ranked_examples; they're turned back into Examples
+    # only once we know which ones are needed.
+    assigned_ids = _assign(
+        list(range(len(ranked_examples))),
         task.get_annotators(),
         blacklist_fn=blacklist_fn,
         max_per_annotator=max_per_annotator,
         max_per_dp=max_per_dp,
     )
+    assignments = {
+        annotator: [ranked_examples.example(i) for i in ids]
+        for annotator, ids in assigned_ids.items()
+    }
     logging.info("Assigning to annotators finished...")
 
     # ---- Populate Cache ----
 
-    # We will need random access for each line in each file.
-    __cache_df = {}
-    for fname in data_filenames:
-        __cache_df[fname] = load_jsonl(fname)
-
     # It's faster to get decorated examples in batch.
     __examples = set()
     for annotator, list_of_examples in assignments.items():
@@ -210,33 +364,39 @@ def generate_annotation_requests(
             __examples.add(pred)
     __examples = list(__examples)
 
+    # We will need random access for the assigned lines in each file.
+    __line_numbers = defaultdict(set)
+    for p in __examples:
+        __line_numbers[p.fname].add(p.line_number)
+    __cache_rows = {}
+    for fname, line_numbers in __line_numbers.items():
+        __cache_rows[fname] = _load_jsonl_lines(fname, line_numbers)
+
     # Basic decorations
     # Also generate a __text_list to be used for other decorators.
     __basic_decor = []
     __text_list = []
     for p in __examples:
-        row = __cache_df[p.fname].iloc[p.line_number]
-        __basic_decor.append({"text": row["text"], "meta": row["meta"]})
-        __text_list.append(row["text"])
+        row = __cache_rows[p.fname][p.line_number]
+        __basic_decor.append({"text": row.get("text"), "meta": row.get("meta")})
+        __text_list.append(row.get("text"))
 
     # Pattern decorations
-    __pattern_decor_for_all_labels = []
-    labels = task.get_labels()
+    __pattern_models = []
+    __pattern_matches = []
     for label in labels:
         pattern_model_for_label = get_pattern_model_for_label(
             dbsession=dbsession, label=label
         )
-        print(pattern_model_for_label)
         if pattern_model_for_label:
-            __pattern_decor_for_label = pattern_model_for_label.predict(
-                __text_list, fancy=True
+            __pattern_models.append(pattern_model_for_label)
+            __pattern_matches.append(
+                pattern_matches_per_label.get(label)
+                or PatternMatches(ranked_examples.fnames)
             )
-            __pattern_decor_for_all_labels.append(__pattern_decor_for_label)
 
-    __pattern_decor = _merge_pattern_decor_for_all_labels_recursive(
-        pattern_decor_for_all_labels=__pattern_decor_for_all_labels,
-        low=0,
-        high=len(__pattern_decor_for_all_labels) - 1,
+    __pattern_decor = _get_pattern_decor(
+        __examples, __text_list, __pattern_models, __pattern_matches
     )
 
     # Build up a dict for random access
@@ -259,11 +419,14 @@ def generate_annotation_requests(
     return annotation_requests
 
 
-def _merge_pattern_decor_for_all_labels_recursive(
-    pattern_decor_for_all_labels: List[List], low: int, high: int
-):
-    """Merge pattern decors from different labels into one pattern decor
-    using a recursive merge like the logic in merge sort.
+def _get_pattern_decor(
+    examples: List[Example],
+    text_list: List[str],
+    pattern_models: List[PatternModel],
+    pattern_matches: List[PatternMatches],
+) -> Optional[List[Dict]]:
+    """The pattern matches of every label on each example, merged into one
+    pattern decor per example.
 
     As discussed, we decided to show all the pattern matches from different
     labels together on the annotation server with the same color for now. This may
@@ -274,54 +437,78 @@ def _merge_pattern_decor_for_all_labels_recursive(
     9) separately. Since we use the same color, it appears as we are
     highlighting (5, 9) as one match.
 
-    :param pattern_decor_for_all_labels: A list of pattern decor lists
-    :param low: low index of the merge range
-    :param high: high index of the merge range
-    :return: A merged pattern decor list
+    Inputs:
+        examples: The examples to decorate.
+        text_list: The text of each example.
+        pattern_models: The PatternModel of each label that has patterns.
+        pattern_matches: The matches and scores each of the `pattern_models`
+            found while ranking. Examples whose matches weren't recorded are
+            matched again.
+
+    Returns:
+        None if there are no pattern models, else for each example a dict with
+        the "spans" of all the labels' matches, as sorted (start, end)
+        character offsets into the text, and the "score" of each label (or
+        just the score if there is only one label).
     """
-    if len(pattern_decor_for_all_labels) == 0:
+    if len(pattern_models) == 0:
         return None
-    if low == high:
-        return pattern_decor_for_all_labels[low]
-    if low > high:
-        return None
-
-    mid = low + (high - low) // 2
-    left_merged = _merge_pattern_decor_for_all_labels_recursive(
-        pattern_decor_for_all_labels, low, mid
-    )
-    right_merged = _merge_pattern_decor_for_all_labels_recursive(
-        pattern_decor_for_all_labels, mid + 1, high
-    )
-
-    return _merge_two_pattern_decors(left_merged, right_merged)
-
 
-def _merge_two_pattern_decors(pattern_decor1: List, pattern_decor2: List):
-    res = pattern_decor1.copy()
-    for i, item in enumerate(pattern_decor2):
-        # Tokens for the same entity are the same so need to merge them.
+    spans_per_label = []
+    scores_per_label = []
+    for model, matches in zip(pattern_models, pattern_matches):
+        spans = [matches.get(ex.fname, ex.line_number) for ex in examples]
+        scores = [matches.get_score(ex.fname, ex.line_number) for ex in examples]
+        missing = [i for i, x in enumerate(spans) if x is None]
+        if missing:
+            res = model.predict([text_list[i] for i in missing], spans=True)
+            for i, row in zip(missing, res):
+                spans[i] = row["spans"]
+                scores[i] = row["score"]
+        spans_per_label.append(spans)
+        scores_per_label.append(scores)
 
-        res[i]["matches"].extend(item["matches"])
-
-        # In case we need the scores later on, they are merged into a list
-        if not isinstance(res[i]["score"], list):
-            res[i]["score"] = [res[i]["score"]]
-
-        if isinstance(item["score"], list):
-            res[i]["score"].extend(item["score"])
-        else:
-            res[i]["score"].append(item["score"])
+    res = []
+    for i in range(len(examples)):
+        # Spans are sorted by start token, so by start character too.
+        char_spans_per_label = [
+            [(c0, c1) for _, _, c0, c1 in spans[i]] for spans in spans_per_label
+        ]
+        scores = [x[i] for x in scores_per_label]
+
+        res.append(
+            {
+                "spans": _merge_sorted_matches(char_spans_per_label),
+                # In case we need the scores later on, they are merged into a
+                # list.
+                "score": scores if len(scores) > 1 else scores[0],
+            }
+        )
+    return res
 
-    # Dedup the merged matching positions.
-    for item in res:
-        item["matches"] = sorted(list(set(item["matches"])))
 
+def _merge_sorted_matches(matches_per_label: List[List]) -> List:
+    """Merge sorted lists of matches into one sorted list without
+    duplicates."""
+    res = []
+    for match in heapq.merge(*matches_per_label):
+        if not res or res[-1] != match:
+            res.append(match)
     return res
 
 
-def _build_blacklist_lookup(dbsession, labels: List[str] = []) -> set:
-    existing_annotations_for_labels = (
+def _build_blacklist_lookup(
+    dbsession, labels: List[str] = [], entities: Optional[List[str]] = None
+) -> set:
+    """Find who has annotated what under these labels.
+
+    Inputs:
+        entities: If set, only look up annotations on these entities, i.e.
+            the candidates we're about to assign. This way the cost depends
+            on the number of candidates, not on the size of the labels'
+            annotation history.
+    """
+    query = (
         dbsession.query(
             ClassificationAnnotation.entity_type,
             ClassificationAnnotation.entity,
@@ -334,8 +521,19 @@ def _build_blacklist_lookup(dbsession, labels: List[str] = []) -> set:
             ClassificationAnnotation.label.in_(labels),
         )
         .distinct()
-        .all()
     )
+
+    if entities is None:
+        existing_annotations_for_labels = query.all()
+    else:
+        entities = list(entities)
+        existing_annotations_for_labels = []
+        for i in range(0, len(entities), _BLACKLIST_QUERY_BATCH_SIZE):
+            batch = entities[i : i + _BLACKLIST_QUERY_BATCH_SIZE]
+            existing_annotations_for_labels.extend(
+                query.filter(ClassificationAnnotation.entity.in_(batch)).all()
+            )
+
     lookup = set(
         [
             LookupKey(item[0], item[1], item[2], item[3])
@@ -369,36 +567,196 @@ def _build_blacklist_fn(lookup: set):
     return blacklist_fn
 
 
-def _get_examples(
+def _build_blacklist_fn_for_store(lookup: set, store: ExampleStore):
+    """Same as _build_blacklist_fn, but for row ids of `store`."""
+
+    def blacklist_fn(i: int, user: str):
+        return (
+            LookupKey(store.entity_type, store.entity(i), store.label(i), user)
+            in lookup
+        )
+
+    return blacklist_fn
+
+
+def get_data_filenames(task: Task) -> List[str]:
+    # TODO Restrict each task to use only 1 file?
+    return [os.path.join(raw_data_dir(), fname) for fname in task.get_data_filenames()]
+
+
+def get_candidate_limit(task: Task, max_per_annotator: int) -> int:
+    # We never hand out more than this many distinct datapoints, so each model
+    # only needs to keep its best candidates, with some headroom for
+    # blacklisted and duplicated entities.
+    return _get_candidate_limit(len(task.get_annotators()), max_per_annotator)
+
+
+def get_chunk_size() -> int:
+    """Number of rows to read and score at a time."""
+    return env.int("ANNOTATION_TOOL_AR_CHUNK_SIZE", default=10000)
+
+
+def _get_candidate_limit(n_annotators: int, max_per_annotator: int) -> int:
+    """How many of the top examples each model should keep per label."""
+    factor = env.int("ANNOTATION_TOOL_AR_CANDIDATE_FACTOR", default=5)
+    return max(1, factor * n_annotators * max_per_annotator)
+
+
+def _get_examples_for_models(
     data_filenames: List[str],
-    model: ITextCatModel,
+    models: List[ITextCatModel],
     entity_type: str,
     label: str,
-    cache=True,
-) -> List[Example]:
-    """Construct an Example based on the prediction of `model` on each of the
-    datasets."""
-    examples = []
+    limit: Optional[int] = None,
+    chunk_size: Optional[int] = None,
+    entity_index: Optional[EntityIndex] = None,
+    pattern_matches: Optional[PatternMatches] = None,
+) -> List[ExampleStore]:
+    """Construct Examples based on the prediction of each of the `models` on
+    each of the datasets.
+
+    The data is streamed in chunks of `chunk_size` rows and every chunk is
+    scored by all the models, so each file is only read once. If `limit` is
+    set, only the `limit` highest scoring examples are kept for each model
+    (for the RandomModel this amounts to reservoir sampling), so memory does
+    not grow with the size of the datasets.
+
+    If `pattern_matches` is set, the matches and scores of the PatternModel
+    among the `models` are recorded there for the examples that are kept.
+
+    Returns an ExampleStore for each model, in the same order as `models`.
+    """
+    if chunk_size is None:
+        chunk_size = 10000
+    if entity_index is None:
+        entity_index = EntityIndex()
+
+    examples = [
+        ExampleStore.empty(entity_type, label, data_filenames, entity_index)
+        for _ in models
+    ]
+    # Chunks of examples that have not been merged into `examples` yet.
+    pending: List[List[ExampleStore]] = [[] for _ in models]
+    n_pending = 0
 
     for fname in data_filenames:
-        res = get_predicted(fname, model, cache=cache)
-        # TODO remove dependency on (fname,line_number)
-        for line_number, row in enumerate(res):
-            examples.append(
-                Example(
-                    score=row["score"],
-                    entity_type=entity_type,
-                    # TODO remove dependency on meta.domain
-                    entity=row["meta"]["domain"],
-                    label=label,
-                    fname=fname,
-                    line_number=line_number,
+        # Models whose scores on this file have been cached don't need to
+        # run again, and if none of the others need the text (e.g. the
+        # RandomModel) we don't need to read it at all.
+        for model in models:
+            start_data_file(model)
+        cached_scores = [load_cached_scores(fname, model) for model in models]
+        need_text = any(
+            cached is None and _needs_text(model)
+            for cached, model in zip(cached_scores, models)
+        )
+        # Scores to save to the cache once we've seen the whole file.
+        computed_scores = [
+            [] if cached is None and get_cache_key(model) is not None else None
+            for cached, model in zip(cached_scores, models)
+        ]
+
+        line_offset = 0
+        for text_list, domains in _iter_chunks(fname, chunk_size, need_text):
+            n = len(domains)
+            # TODO remove dependency on meta.domain
+            entity_ids = entity_index.get_ids(domains)
+            if text_list is None:
+                text_list = [None] * n
+
+            for i, model in enumerate(models):
+                if cached_scores[i] is not None:
+                    scores = cached_scores[i][line_offset : line_offset + n]
+                else:
+                    if pattern_matches is not None and isinstance(
+                        model, PatternModel
+                    ):
+                        res = model.predict(text_list, spans=True)
+                        pattern_matches.add(
+                            fname,
+                            line_offset,
+                            [row["spans"] for row in res],
+                            [row["score"] for row in res],
+                        )
+                    else:
+                        res = model.predict(text_list)
+                    scores = [row["score"] for row in res]
+                    if computed_scores[i] is not None:
+                        computed_scores[i].append(np.asarray(scores, dtype=np.float64))
+
+                # TODO remove dependency on (fname,line_number)
+                pending[i].append(
+                    ExampleStore.for_chunk(
+                        entity_type,
+                        label,
+                        examples[i].fnames,
+                        entity_index,
+                        scores=scores,
+                        entity_ids=entity_ids,
+                        fname=fname,
+                        first_line_number=line_offset,
+                    )
                 )
-            )
+
+            line_offset += n
+            n_pending += n
+
+            # Prune lazily so the amortized cost of the top-k stays low.
+            if limit is not None and n_pending >= limit:
+                examples = [
+                    ExampleStore.concat([ex] + p).top_k(limit)
+                    for ex, p in zip(examples, pending)
+                ]
+                pending = [[] for _ in models]
+                n_pending = 0
+                if pattern_matches is not None:
+                    pattern_matches.keep(examples)
+
+        for model, scores in zip(models, computed_scores):
+            if scores is not None:
+                save_cached_scores(fname, model, np.concatenate([[]] + scores))
+
+    examples = [ExampleStore.concat([ex] + p) for ex, p in zip(examples, pending)]
+    if limit is not None:
+        examples = [ex.top_k(limit) for ex in examples]
+    if pattern_matches is not None:
+        pattern_matches.keep(examples)
 
     return examples
 
 
+def _needs_text(model: ITextCatModel) -> bool:
+    # Models don't have to inherit from ITextCatModel, as long as they
+    # implement predict.
+    needs_text = getattr(model, "needs_text", None)
+    return needs_text() if needs_text is not None else True
+
+
+def _iter_chunks(fname: str, chunk_size: int, need_text: bool = True):
+    """Yield the texts and entities of a data file, `chunk_size` rows at a
+    time, from the columnar cache when possible. If `need_text` is False, the
+    texts are None."""
+    raw_columns = load_raw_data_columns(fname)
+    if raw_columns is not None:
+        for start in range(0, len(raw_columns), chunk_size):
+            stop = start + chunk_size
+            text_list = raw_columns.slice(TEXT, start, stop) if need_text else None
+            yield text_list, raw_columns.slice(DOMAIN, start, stop)
+        return
+
+    for chunk in iter_jsonl_chunks(fname, chunk_size=chunk_size):
+        text_list = [row.get("text") for row in chunk] if need_text else None
+        domains = [(row.get("meta") or {}).get("domain") for row in chunk]
+        yield text_list, domains
+
+
+def _load_jsonl_lines(fname: str, line_numbers: Set[int]) -> Dict[int, Dict]:
+    """Read only the given (0-indexed) lines from a jsonl file."""
+    if not line_numbers:
+        return {}
+    return get_raw_data_index(fname).read_lines(line_numbers)
+
+
 def _assign(
     datapoints: List,
     annotators: List,
@@ -419,128 +777,210 @@ def _assign(
             annotator:  list of datapoints
             ...
         }
+
+    Each datapoint goes to the valid annotators with the fewest datapoints
+    so far, ties broken by annotator.
     """
+    if blacklist_fn is None:
 
-    def is_valid(anno, dp):
-        if anno in per_dp_queue[dp]:
-            # This datapoint already assigned to this annotator
-            return False
-        if blacklist_fn(dp, anno):
-            # User specified function to not allow this
-            return False
-        if len(per_anno_queue[anno]) >= max_per_annotator:
-            # This annotator has too many datapoints to label already
+        def blacklist_fn(datapoint, annotator):
             return False
-        return True
-
-    def get_next_anno(dp):
-        put_back = []
-        ret_anno = None
-
-        while not anno_q.empty():
-            item = anno_q.get()
-            anno = item[1]
 
-            if is_valid(anno, dp):
-                ret_anno = anno
-                break
-            else:
-                put_back.append(item)
+    # Each annotator starts off with 0 datapoint assigned. An annotator listed
+    # more than once has one entry per listing, as in the list they were
+    # given. Entries are removed from the heap for good once their annotator
+    # has max_per_annotator datapoints, since they can't be assigned anything
+    # else.
+    anno_heap = [(0, anno) for anno in annotators]
+    heapq.heapify(anno_heap)
 
-        for item in put_back:
-            anno_q.put(item)
+    per_anno_queue = defaultdict(list)
 
-        return ret_anno
+    for dp in datapoints:
+        if not anno_heap:
+            # Everyone is full.
+            break
 
-    if blacklist_fn is None:
+        # Entries of annotators that can't take this datapoint (blacklisted,
+        # or already assigned to it), to be put back once we're done with it.
+        put_back = []
+        assigned = []
 
-        def blacklist_fn(datapoint, annotator):
-            return False
+        while len(assigned) < max_per_dp and anno_heap:
+            n, anno = heapq.heappop(anno_heap)
 
-    from queue import PriorityQueue
-    from collections import defaultdict
+            if anno in assigned or blacklist_fn(dp, anno):
+                # Already assigned to this datapoint, or the user specified
+                # function doesn't allow this.
+                put_back.append((n, anno))
+                continue
 
-    anno_q = PriorityQueue()
-    for anno in annotators:
-        # Each annotator starts off with 0 datapoint assigned
-        anno_q.put((0, anno))
+            count = len(per_anno_queue.setdefault(anno, []))
+            if count >= max_per_annotator:
+                # This annotator has too many datapoints to label already.
+                continue
 
-    per_dp_queue = defaultdict(list)
-    per_anno_queue = defaultdict(list)
+            per_anno_queue[anno].append(dp)
+            assigned.append(anno)
+            if count + 1 < max_per_annotator:
+                put_back.append((count + 1, anno))
 
-    for dp in datapoints:
-        for i in range(max_per_dp):
-            anno = get_next_anno(dp)
-            # print(dp, i, anno)
-            if anno is None:
-                # No more possible users to annotate this
-                break
-            else:
-                per_dp_queue[dp].append(anno)
-                per_anno_queue[anno].append(dp)
-                anno_q.put((len(per_anno_queue[anno]), anno))
+        for item in put_back:
+            heapq.heappush(anno_heap, item)
 
     return per_anno_queue
 
 
 def _shuffle_together_examples(
-    list_of_examples: List[List[Example]], proportions: List[float]
-):
+    list_of_examples: List[ExampleStore], proportions: List[float]
+) -> ExampleStore:
     """
-    Randomly shuffle together lists of Example, such that at any length,
+    Randomly shuffle together lists of examples, such that at any length,
     the proportion of elements from each list is approximately `proportions`.
+
+    Conceptually, we repeatedly pick a list at random according to
+    `proportions` and take its best element that has not been taken yet,
+    until all the lists are exhausted. Rather than doing this one element at a
+    time, the picks are drawn in batches and resolved with array operations.
     """
 
     # Sort each list from top to bottom
-    list_of_examples = [
-        sorted(x, key=lambda pred: pred.score, reverse=True) for x in list_of_examples
-    ]
+    list_of_examples = [x.sorted() for x in list_of_examples]
+    combined = ExampleStore.concat(list_of_examples)
+    entity_ids = combined.entity_ids
+    n_lists = len(list_of_examples)
+
+    # Where each list starts and ends in `combined`.
+    offsets = np.cumsum([0] + [len(x) for x in list_of_examples])
+    ls_idx = offsets[:-1].copy()
+    ls_end = offsets[1:]
+
+    proportions = np.array(proportions, dtype=np.float64)
+    # Empty lists can never be picked.
+    proportions[ls_idx == ls_end] = 0
+
+    # We can't take more elements than there are distinct entities.
+    seen = np.zeros(len(combined.entity_index), dtype=bool)
+    seen[entity_ids[entity_ids >= 0]] = True
+    n_remaining = np.count_nonzero(seen)
+    seen[:] = False
 
     res = []
-    seen = set()
-    # Current index into each list
-    ls_idx = [0 for _ in range(len(list_of_examples))]
-
-    # Normalize proportions
-    proportions = np.array(proportions)
-    proportions = proportions / np.sum(proportions)
-
-    # Note this is "worst case" O(total_n = total number of items in all lists)
-    # Where "worst case" means if we have a bug in the loop.
-    # We can actually expect this to run in O(number of unique filename:linenum pairs)
-
-    total_n = sum([len(x) for x in list_of_examples])
-
-    for _ in range(total_n):
-        which_list = np.argmax(np.random.multinomial(1, proportions, size=1), axis=1)[0]
-        ls = list_of_examples[which_list]
-
-        # Try our best to add 1 element from ls to res.
-        while ls_idx[which_list] < len(ls):
-            pred = ls[ls_idx[which_list]]
-            ls_idx[which_list] += 1
-            # TODO could name and/or domain be null? How would that affect
-            #  the tuple as a key? Can we just skip it?
-            if pred.entity is None:
-                continue
-
-            if pred.entity not in seen:
-                # We've found an element from ls that can be added to res!
-                # TODO keep track of which list the pred comes from; for easier debugging
-                seen.add(pred.entity)
-                res.append(pred)
-                break
+    # Which list an entity has been given to in the current batch.
+    owner = np.full(len(combined.entity_index), -1, dtype=np.int64)
+    # Picks from the previous batch that didn't get an element.
+    carry_over = np.empty(0, dtype=np.int64)
+
+    while n_remaining > 0 and np.sum(proportions) > 0:
+        # Normalize
+        proportions = proportions / np.sum(proportions)
+
+        # Don't draw more picks than can be satisfied, else the later picks
+        # would take elements away from the earlier ones.
+        batch_size = min(_SHUFFLE_BATCH_SIZE, n_remaining)
+        n_draws = max(batch_size - len(carry_over), 0)
+        picks = np.concatenate(
+            [carry_over, np.random.choice(n_lists, size=n_draws, p=proportions)]
+        )
+        # Ignore picks of exhausted lists. Since the picks are independent,
+        # the remaining ones are distributed as if they had been drawn from
+        # the renormalized proportions.
+        picks = picks[proportions[picks] > 0]
+        picked_lists = np.unique(picks)
+        owned = []
+
+        # The k-th pick of a list gets the k-th element of that list that is
+        # neither seen nor given to another list. When several picks want the
+        # same entity the earliest one gets it, and the other lists have to
+        # look further down. Repeat until there are no more such conflicts.
+        while True:
+            candidates = np.full(len(picks), -1, dtype=np.int64)
+            for which_list in picked_lists:
+                pick_idx = np.flatnonzero(picks == which_list)
+                _candidates = _next_available(
+                    entity_ids,
+                    seen,
+                    owner,
+                    which_list,
+                    ls_idx[which_list],
+                    ls_end[which_list],
+                    len(pick_idx),
+                )
+                candidates[pick_idx[: len(_candidates)]] = _candidates
 
-        if ls_idx[which_list] == len(ls):
-            # We've exhausted the selected list. Time to reshuffle the proportions.
-            proportions[which_list] = 0
+            has_candidate = np.flatnonzero(candidates >= 0)
+            _, first_idx = np.unique(
+                entity_ids[candidates[has_candidate]], return_index=True
+            )
+            won = np.zeros(len(picks), dtype=bool)
+            won[has_candidate[first_idx]] = True
 
-            if np.isclose(np.sum(proportions), 0):
-                # We're done! Nothing more to sample.
+            won_entities = entity_ids[candidates[won]]
+            new_owners = owner[won_entities] < 0
+            if len(has_candidate) == len(first_idx) or not np.any(new_owners):
                 break
-            else:
-                # Normalize
-                proportions = proportions / np.sum(proportions)
-
-    # assert np.isclose(np.sum(proportions), 0) # Should be always true, but not needed...
-    return res
+            owner[won_entities] = picks[won]
+            owned.append(won_entities)
+
+        for x in owned:
+            owner[x] = -1
+        res.append(candidates[won])
+        seen[entity_ids[candidates[won]]] = True
+        n_remaining -= np.sum(won)
+        np.maximum.at(ls_idx, picks[won], candidates[won] + 1)
+
+        # Lists that ran out of elements for some of their picks are either
+        # exhausted, or have lost elements to other lists in this batch and
+        # need to try again.
+        carry_over = picks[~won]
+        for which_list in np.unique(carry_over):
+            remaining = _next_available(
+                entity_ids,
+                seen,
+                owner,
+                which_list,
+                ls_idx[which_list],
+                ls_end[which_list],
+                1,
+            )
+            if len(remaining) == 0:
+                # We've exhausted the selected list. Time to reshuffle the proportions.
+                proportions[which_list] = 0
+
+    res = np.concatenate(res) if res else np.empty(0, dtype=np.int64)
+    return combined.take(res)
+
+
+def _next_available(
+    entity_ids: np.ndarray,
+    seen: np.ndarray,
+    owner: np.ndarray,
+    which_list: int,
+    start: int,
+    end: int,
+    n: int,
+) -> np.ndarray:
+    """Find the positions of the next `n` elements in entity_ids[start:end]
+    whose entities are neither seen nor owned by another list, skipping
+    missing and repeated entities. Fewer positions are returned if there
+    aren't enough of them.
+    """
+    window_size = 2 * n + 16
+    while True:
+        stop = min(start + window_size, end)
+        window = entity_ids[start:stop]
+
+        # TODO could name and/or domain be null? How would that affect
+        #  the tuple as a key? Can we just skip it?
+        ok = window >= 0
+        _window = window[ok]
+        ok[ok] = ~seen[_window] & ((owner[_window] < 0) | (owner[_window] == which_list))
+        idx = np.flatnonzero(ok)
+        # Only the first occurrence of an entity counts.
+        _, first_idx = np.unique(window[idx], return_index=True)
+        idx = idx[np.sort(first_idx)]
+
+        if len(idx) >= n or stop == end:
+            return start + idx[:n]
+
+        window_size *= 2
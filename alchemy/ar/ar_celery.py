@@ -1,13 +1,40 @@
+import json
 import logging
+import os
+import shutil
+import uuid
+from typing import Dict
 
-from celery import Celery
+from celery import Celery, chord
+from celery.signals import task_postrun, worker_init
 from envparse import env
 
-from alchemy.ar import generate_annotation_requests as _generate_annotation_requests
+from alchemy.ar import (
+    Candidates,
+    EntityIndex,
+    ExampleStore,
+    generate_annotation_requests_for_ranked_examples,
+    get_candidate_limit,
+    get_candidates_for_label,
+    get_chunk_size,
+    get_data_filenames,
+    rank_candidates,
+)
+from alchemy.ar import worker
+from alchemy.ar.pattern_matches import PatternMatches
+from alchemy.ar.data import refresh_task_statistics as refresh_task_statistics_db
 from alchemy.ar.data import save_new_ar_for_user_db
 from alchemy.db.config import DevelopmentConfig
-from alchemy.db.model import Database, Task, get_or_create
-from alchemy.shared.celery_job_status import JobStatus, set_status
+from alchemy.db.engines import get_pool_stats
+from alchemy.db.fs import ar_candidates_dir
+from alchemy.db.model import Database, EntityTypeEnum, Task, get_or_create
+from alchemy.shared import heartbeat, statistics_refresh
+from alchemy.shared.celery_job_status import (
+    JobStatus,
+    count_step_done,
+    set_status,
+    sweep_stale_statuses,
+)
 
 celery_broker = env("CELERY_BROKER_URL", default="redis://localhost:6379/0")
 app = Celery(
@@ -27,6 +54,17 @@ def hello():
 
 @app.task
 def generate_annotation_requests(task_id, max_per_annotator, max_per_dp, entity_type):
+    """Rank the examples of every (label, data file) pair of the task in
+    parallel, then assign them to the annotators once they're all done, in
+    a chord of rank_examples_for_label and assign_annotation_requests.
+
+    Progress is reported under the id of this task, until
+    assign_annotation_requests sets it to DONE.
+
+    The candidates are passed to assign_annotation_requests through files in
+    the filestore, see _save_candidates, since they're too big for the
+    result backend.
+    """
     celery_id = str(generate_annotation_requests.request.id)
     set_status(celery_id, JobStatus.STARTED, progress=0.0)
 
@@ -36,14 +74,190 @@ def generate_annotation_requests(task_id, max_per_annotator, max_per_dp, entity_
     )
 
     db = Database.from_config(DevelopmentConfig)
-    res = _generate_annotation_requests(
-        db.session, task_id, max_per_annotator, max_per_dp
+    try:
+        task = get_or_create(dbsession=db.session, model=Task, id=task_id)
+        labels = task.get_labels()
+        data_filenames = get_data_filenames(task)
+        limit = get_candidate_limit(task, max_per_annotator)
+    finally:
+        db.session.close()
+
+    if not labels:
+        logging.info(f"Task {task_id} has no labels, nothing to assign")
+        set_status(celery_id, JobStatus.DONE, progress=1.0)
+        return
+
+    # The labels are passed along, in case the task changes in the meantime.
+    callback = assign_annotation_requests.s(
+        celery_id, task_id, labels, max_per_annotator, max_per_dp, entity_type
+    )
+    if not data_filenames:
+        # Nothing to rank, like the serial version.
+        callback([])
+        return
+
+    # One step per subtask, plus one for the assignment.
+    n_steps = len(labels) * len(data_filenames) + 1
+    header = [
+        rank_examples_for_label.s(celery_id, n_steps, label, fname, limit)
+        for label in labels
+        for fname in data_filenames
+    ]
+    chord(header)(callback.on_error(annotation_requests_failed.s(celery_id=celery_id)))
+
+
+@app.task
+def rank_examples_for_label(celery_id, n_steps, label, fname, limit):
+    """The candidates of a label's models on a data file, and the matches of
+    the label's patterns on them."""
+    pattern_matches = PatternMatches([fname])
+    db = Database.from_config(DevelopmentConfig)
+    try:
+        candidates = get_candidates_for_label(
+            db.session,
+            label,
+            [fname],
+            limit=limit,
+            chunk_size=get_chunk_size(),
+            pattern_matches=pattern_matches,
+        )
+    finally:
+        db.session.close()
+
+    fname = _save_candidates(
+        celery_id,
+        {
+            "candidates": [
+                x._replace(examples=x.examples.to_dict())._asdict()
+                for x in candidates
+            ],
+            "pattern_matches": pattern_matches.to_dict(),
+        },
     )
+    count_step_done(celery_id, n_steps)
+    return {"label": label, "limit": limit, "fname": fname}
+
+
+@app.task
+def assign_annotation_requests(
+    results, celery_id, task_id, labels, max_per_annotator, max_per_dp, entity_type
+):
+    """Merge the candidates and pattern matches from rank_examples_for_label
+    for each of the `labels`, and assign them to the annotators."""
+    db = Database.from_config(DevelopmentConfig)
+    try:
+        task = get_or_create(dbsession=db.session, model=Task, id=task_id)
+
+        # The examples of all the labels are consolidated by entity id.
+        entity_index = EntityIndex()
+        candidates_per_label = {label: [] for label in labels}
+        pattern_matches_per_label = {label: [] for label in labels}
+        limit = None
+        for res in results:
+            limit = res["limit"]
+            saved = _load_candidates(res["fname"])
+            pattern_matches_per_label[res["label"]].append(
+                PatternMatches.from_dict(saved["pattern_matches"])
+            )
+            for row in saved["candidates"]:
+                x = Candidates(**row)
+                candidates_per_label[res["label"]].append(
+                    x._replace(
+                        examples=ExampleStore.from_dict(x.examples, entity_index)
+                    )
+                )
+
+        ranked_examples_per_label = [
+            rank_candidates(candidates, limit=limit)
+            if candidates
+            # No data files.
+            else ExampleStore.empty(EntityTypeEnum.COMPANY, label, [], entity_index)
+            for label, candidates in candidates_per_label.items()
+        ]
+        res = generate_annotation_requests_for_ranked_examples(
+            db.session,
+            task,
+            ranked_examples_per_label,
+            max_per_annotator,
+            max_per_dp,
+            pattern_matches_per_label={
+                label: PatternMatches.concat(matches)
+                for label, matches in pattern_matches_per_label.items()
+                if matches
+            },
+            labels=labels,
+        )
+
+        _save_annotation_requests(db.session, task, res, entity_type)
+    finally:
+        db.session.close()
+        _delete_candidates(celery_id)
+
+    set_status(celery_id, JobStatus.DONE, progress=1.0)
+    statistics_refresh.schedule_refresh([task_id])
+
+
+@app.task
+def refresh_task_statistics(task_id):
+    """Recompute the statistics shown on the admin page of a task, see
+    alchemy.shared.statistics_refresh."""
+    statistics_refresh.mark_started(task_id)
+
+    db = Database.from_config(DevelopmentConfig)
+    try:
+        task = db.session.query(Task).filter_by(id=task_id).one_or_none()
+        if task is not None:
+            refresh_task_statistics_db(db.session, task)
+    finally:
+        db.session.close()
+
+
+@app.task
+def sweep_job_statuses():
+    """Delete the statuses of stale jobs, run periodically by celery beat."""
+    sweep_stale_statuses()
+
+
+@app.task
+def annotation_requests_failed(*args, celery_id):
+    """Error callback of the chord in generate_annotation_requests."""
+    logging.error(f"Failed to generate annotation requests for job {celery_id}")
+    set_status(celery_id, JobStatus.FAILED)
+    _delete_candidates(celery_id)
+
+
+def _get_candidates_dir(celery_id) -> str:
+    return os.path.join(ar_candidates_dir(), celery_id)
+
+
+def _save_candidates(celery_id, candidates: Dict) -> str:
+    """Save the output of a rank_examples_for_label in the filestore, which
+    the workers share, and return the path to pass to
+    assign_annotation_requests."""
+    d = _get_candidates_dir(celery_id)
+    os.makedirs(d, exist_ok=True)
+    fname = os.path.join(d, f"{uuid.uuid4().hex}.json")
+    tmp_fname = f"{fname}.tmp.{os.getpid()}"
+    with open(tmp_fname, "w") as f:
+        json.dump(candidates, f)
+    os.replace(tmp_fname, fname)
+    return fname
 
-    task = get_or_create(dbsession=db.session, model=Task, id=task_id)
 
+def _load_candidates(fname: str) -> Dict:
+    with open(fname) as f:
+        return json.load(f)
+
+
+def _delete_candidates(celery_id):
+    shutil.rmtree(_get_candidates_dir(celery_id), ignore_errors=True)
+
+
+def _save_annotation_requests(dbsession, task, res, entity_type):
     # TODO Defaulting to the first label of the task.
     label = task.get_labels()[0]
+    # Only update what changed since the last assignment.
+    incremental = env.bool("ANNOTATION_TOOL_AR_INCREMENTAL_REFRESH", default=True)
 
     count = 0
     for username, annotation_requests in res.items():
@@ -51,29 +265,57 @@ def generate_annotation_requests(task_id, max_per_annotator, max_per_dp, entity_
         #  Here we have a user and a list of request in the form of a
         #  dictionary and we want to save it for this user in db.
         save_new_ar_for_user_db(
-            db.session,
-            task_id,
+            dbsession,
+            task.id,
             username,
             annotation_requests,
             label,
             entity_type,
             clean_existing=True,
+            incremental=incremental,
         )
         count += len(annotation_requests)
     print(f"Done")
     print("The number of requests processed: {}".format(count))
 
-    set_status(celery_id, JobStatus.DONE, progress=1.0)
 
-    db.session.close()
+app.conf.task_routes = {"*.ar_celery.*": {"queue": "ar_celery"}}
+app.conf.beat_schedule = {
+    "sweep-job-statuses": {
+        "task": "alchemy.ar.ar_celery.sweep_job_statuses",
+        "schedule": env.float(
+            "ANNOTATION_TOOL_JOB_STATUS_SWEEP_INTERVAL", default=10 * 60
+        ),
+    }
+}
+# Replace a pool process after a job if it grew too large, see
+# alchemy.ar.worker.
+app.conf.worker_max_memory_per_child = worker.get_max_memory_per_child()
+heartbeat.install(app)
+
 
+# Signals are sent for every app in the process, not just this one.
+
+
+@worker_init.connect
+def _preload(sender=None, **kwargs):
+    if sender is not None and sender.app is app:
+        worker.preload()
+
+
+@task_postrun.connect
+def _after_task(sender=None, **kwargs):
+    if sender is not None and sender.app is app:
+        worker.maybe_evict_caches()
+        logging.info(f"Database connection pools: {get_pool_stats()}")
 
-app.conf.task_routes = {"*.ar_celery.*": {"queue": "ar_celery"}}
 
 """
-celery --app=ar.ar_celery worker -Q ar_celery -c 1 -l info --max-tasks-per-child 1 -n ar_celery
+celery --app=ar.ar_celery worker -Q ar_celery -c 1 -l info -n ar_celery
+
+celery --app=ar.ar_celery beat -l info
 
-celery --app=ar.ar_celery worker -Q ar_celery -c 2 --autoscale=100,2 -l info --max-tasks-per-child 1 -n ar_celery
+celery --app=ar.ar_celery worker -Q ar_celery -c 2 --autoscale=100,2 -l info -n ar_celery
 
-celery --app=ar.ar_celery worker -c 2 --autoscale=100,2 -l info --max-tasks-per-child 1 -n ar_celery
+celery --app=ar.ar_celery worker -c 2 --autoscale=100,2 -l info -n ar_celery
 """
@@ -1,13 +1,19 @@
+import csv
+import io
 import itertools
+import json
 import logging
 from collections import namedtuple
-from typing import Dict, List
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 import pandas as pd
+from envparse import env
 from pandas import DataFrame
 from sklearn.metrics import cohen_kappa_score
-from sqlalchemy import distinct, func
+from sqlalchemy import bindparam, distinct, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 from alchemy.db.model import (
     AnnotationRequest,
@@ -15,11 +21,12 @@ from alchemy.db.model import (
     AnnotationType,
     AnnotationValue,
     ClassificationAnnotation,
+    EntityContext,
 )
 from alchemy.db.model import Task as NewTask
 from alchemy.db.model import (
+    TaskStatistics,
     User,
-    db,
     delete_requests_for_user_under_task,
     update_instance,
 )
@@ -36,6 +43,29 @@ EntityAndAnnotationValuePair = namedtuple(
     "EntityAndAnnotationValuePair", ["entity", "value"]
 )
 
+# The columns we fill when saving annotation requests; the rest have server
+# defaults or stay NULL.
+_AR_COLUMNS = [
+    "user_id",
+    "entity_type",
+    "entity",
+    "label",
+    "annotation_type",
+    "status",
+    "task_id",
+    "order",
+    "context",
+    "entity_context_id",
+]
+
+# The parts of a request's context that are the same for every request for
+# the entity, which are stored once in an EntityContext.
+_ENTITY_CONTEXT_KEYS = ["data", "pattern_info"]
+
+# How many values to pass to an IN clause at a time, SQLite only supports 999
+# parameters per query.
+_MAX_IN_VALUES = 500
+
 
 def save_new_ar_for_user_db(
     dbsession,
@@ -45,14 +75,32 @@ def save_new_ar_for_user_db(
     label,
     entity_type,
     clean_existing=True,
+    batch_size=None,
+    incremental=False,
 ):
+    """Save the annotation requests for a user, replacing the existing ones
+    for the task if `clean_existing`.
+
+    The requests are inserted in bulk and committed every `batch_size`
+    requests (ANNOTATION_TOOL_AR_INSERT_BATCH_SIZE by default), using COPY on
+    PostgreSQL. The parts of their contexts shared by the requests for the
+    same entity are stored once, see save_entity_contexts.
+
+    If `incremental` (and `clean_existing`), the existing requests are
+    updated in place of being replaced, see _refresh_requests_for_user, and
+    everything is committed at once so the annotator never sees a partial
+    queue.
+    """
+    if batch_size is None:
+        batch_size = env.int("ANNOTATION_TOOL_AR_INSERT_BATCH_SIZE", default=1000)
+
     user = (dbsession.query(User)
             .filter_by(username=username)
             .one_or_none())
     if not user:
         # Should not happen since the annotator usernames are not arbitrary anymore
         raise ValueError(f"Annotator {user} is not registered on the website.")
-    if clean_existing:
+    if clean_existing and not incremental:
         try:
             delete_requests_for_user_under_task(
                 dbsession=dbsession, username=username, task_id=task_id
@@ -66,38 +114,52 @@ def save_new_ar_for_user_db(
             logging.error(e)
             raise
 
-    try:
-        # TODO requests were generated in reverse order.
-        for i, req in enumerate(annotation_requests[::-1]):
-            """
-            Currently the full request looks like:
-            {
-                "fname": "myfile.jsonl",             <-- (optional)
-                "line_number": 78,                   <-- (optional)
-                "score": 0.11627906976744186,
-                "entity": "blah",
-                "data": {
-                    "text": "Blah blah ...",
-                    "meta": {"name": "Blah", "domain": "blah"}
-                },
-                "pattern_info": {                    <-- (optional)
-                    "tokens": ["Blah", "blah", ...],
-                    "matches": [(1, 2, "Blah"), ...],
-                    "score": 0.11627906976744186
-                }
+    # TODO requests were generated in reverse order.
+    rows = []
+    for i, req in enumerate(annotation_requests[::-1]):
+        """
+        Currently the full request looks like:
+        {
+            "fname": "myfile.jsonl",             <-- (optional)
+            "line_number": 78,                   <-- (optional)
+            "score": 0.11627906976744186,
+            "entity": "blah",
+            "data": {
+                "text": "Blah blah ...",
+                "meta": {"name": "Blah", "domain": "blah"}
+            },
+            "pattern_info": {                    <-- (optional)
+                "spans": [(0, 4), ...],
+                "score": 0.11627906976744186
             }
-            """
-            new_request = AnnotationRequest(
+        }
+        """
+        rows.append(
+            dict(
                 user_id=user.id,
                 entity_type=entity_type,
                 entity=req["entity"],
                 label=label,
                 annotation_type=AnnotationType.ClassificationAnnotation,
+                status=AnnotationRequestStatus.Pending,
                 task_id=task_id,
-                context=req,
                 order=i,
+                context=req,
+            )
+        )
+
+    refresh = clean_existing and incremental
+    try:
+        if refresh:
+            rows = _refresh_requests_for_user(
+                dbsession, user.id, task_id, entity_type, rows, batch_size
             )
-            dbsession.add(new_request)
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start : start + batch_size]
+            _set_entity_contexts(dbsession, entity_type, batch)
+            _insert_annotation_requests(dbsession, batch)
+            if not refresh:
+                dbsession.commit()
         dbsession.commit()
     except Exception as e:
         logging.error(e)
@@ -105,6 +167,262 @@ def save_new_ar_for_user_db(
         raise
 
 
+def _refresh_requests_for_user(
+    dbsession, user_id, task_id, entity_type, rows: List[Dict], batch_size: int
+) -> List[Dict]:
+    """Bring a user's existing requests under a task in line with `rows`
+    (see save_new_ar_for_user_db), matching them by (entity, label):
+
+    - Pending requests that are still wanted are kept, and their `order` and
+      context (e.g. the new score and pattern matches) are updated if they
+      changed.
+    - The other requests are deleted.
+
+    Returns the rows that don't have a request yet, which still need to be
+    inserted. Doesn't commit.
+    """
+    new_rows = {}
+    for row in rows:
+        new_rows.setdefault((row["entity"], row["label"]), row)
+
+    existing = (
+        dbsession.query(
+            AnnotationRequest.id,
+            AnnotationRequest.entity,
+            AnnotationRequest.label,
+            AnnotationRequest.status,
+        )
+        .filter_by(user_id=user_id, task_id=task_id)
+        .order_by(AnnotationRequest.id)
+        .all()
+    )
+
+    to_delete = []
+    kept = {}
+    for _id, entity, label, status in existing:
+        key = (entity, label)
+        if (
+            key not in new_rows
+            or key in kept
+            or status != AnnotationRequestStatus.Pending
+        ):
+            to_delete.append(_id)
+        else:
+            kept[key] = _id
+
+    table = AnnotationRequest.__table__
+    for start in range(0, len(to_delete), batch_size):
+        batch = to_delete[start : start + batch_size]
+        dbsession.execute(table.delete().where(table.c.id.in_(batch)))
+
+    update = (
+        table.update()
+        .where(table.c.id == bindparam("_id"))
+        .values(
+            order=bindparam("_order"),
+            context=bindparam("_context", type_=table.c.context.type),
+            entity_context_id=bindparam("_entity_context_id"),
+        )
+    )
+    kept_ids = list(kept.values())
+    kept_rows = [new_rows[key] for key in kept]
+    n_updated = 0
+    for start in range(0, len(kept_ids), batch_size):
+        batch = kept_ids[start : start + batch_size]
+        batch_rows = kept_rows[start : start + batch_size]
+        current = {
+            _id: (order, context, entity_context_id)
+            for _id, order, context, entity_context_id in dbsession.query(
+                AnnotationRequest.id,
+                AnnotationRequest.order,
+                AnnotationRequest.context,
+                AnnotationRequest.entity_context_id,
+            ).filter(AnnotationRequest.id.in_(batch))
+        }
+        _set_entity_contexts(dbsession, entity_type, batch_rows)
+
+        to_update = []
+        for _id, row in zip(batch, batch_rows):
+            values = (row["order"], row["context"], row["entity_context_id"])
+            if current[_id] != values:
+                to_update.append(
+                    {
+                        "_id": _id,
+                        "_order": values[0],
+                        "_context": values[1],
+                        "_entity_context_id": values[2],
+                    }
+                )
+        if to_update:
+            dbsession.execute(update, to_update)
+        n_updated += len(to_update)
+
+    to_insert = [row for key, row in new_rows.items() if key not in kept]
+    logging.info(
+        f"Refreshing requests for user {user_id} under task {task_id}: "
+        f"{len(to_delete)} deleted, {n_updated} updated, "
+        f"{len(to_insert)} new"
+    )
+    return to_insert
+
+
+def split_context(context: Dict) -> Tuple[Dict, Optional[Dict]]:
+    """Split the context of a request into the parts specific to the request
+    (e.g. its score) and the parts shared by every request for the entity,
+    which are None if there aren't any."""
+    own = {k: v for k, v in context.items() if k not in _ENTITY_CONTEXT_KEYS}
+    shared = {k: context[k] for k in _ENTITY_CONTEXT_KEYS if k in context}
+    return own, shared or None
+
+
+def merge_context(context, entity_context: Optional[Dict]):
+    """The opposite of split_context."""
+    if entity_context is None:
+        return context
+    if not isinstance(context, dict):
+        context = {}
+    return {**context, **entity_context}
+
+
+def read_pattern_info(pattern_info, data) -> Optional[Dict]:
+    """The `pattern_info` of a request, converting the format of requests
+    made before the matches were stored as character spans:
+
+        {"tokens": [...], "matches": [(start token, end token, text), ...]}
+
+    Inputs:
+        pattern_info: As stored in the context.
+        data: The data of the request, whose "text" the tokens came from.
+    """
+    if not isinstance(pattern_info, dict) or "tokens" not in pattern_info:
+        return pattern_info
+
+    text = data.get("text") if isinstance(data, dict) else None
+    text = text or ""
+    # Tokens are substrings of the text, in order.
+    offsets = []
+    pos = 0
+    for token in pattern_info["tokens"]:
+        start = text.find(token, pos)
+        if start < 0:
+            # The text changed, the next matches can't be highlighted.
+            break
+        pos = start + len(token)
+        offsets.append((start, pos))
+
+    spans = set()
+    for start, end, _ in pattern_info.get("matches") or []:
+        if 0 <= start < end <= len(offsets):
+            spans.add((offsets[start][0], offsets[end - 1][1]))
+    return {"spans": sorted(spans), "score": pattern_info.get("score")}
+
+
+def save_entity_contexts(
+    dbsession, entity_type, contexts: List[Tuple[str, Dict]]
+) -> List[int]:
+    """The ids of the EntityContexts with the given (entity, context), creating
+    the ones that don't exist yet. Doesn't commit."""
+    keys = [
+        (entity, EntityContext.hash_context(context)) for entity, context in contexts
+    ]
+    ids = _fetch_entity_context_ids(dbsession, entity_type, keys)
+
+    missing = {}
+    for key, (entity, context) in zip(keys, contexts):
+        if key not in ids and key not in missing:
+            missing[key] = dict(
+                entity_type=entity_type,
+                entity=entity,
+                content_hash=key[1],
+                context=context,
+            )
+    if missing:
+        table = EntityContext.__table__
+        if dbsession.get_bind().dialect.name == "postgresql":
+            # Another job could be saving the same context.
+            insert = pg_insert(table).on_conflict_do_nothing()
+        else:
+            insert = table.insert()
+        dbsession.execute(insert, list(missing.values()))
+        ids.update(_fetch_entity_context_ids(dbsession, entity_type, list(missing)))
+
+    return [ids[key] for key in keys]
+
+
+def _fetch_entity_context_ids(
+    dbsession, entity_type, keys: List[Tuple[str, str]]
+) -> Dict[Tuple[str, str], int]:
+    """The ids of the existing EntityContexts, by (entity, content hash)."""
+    keys = set(keys)
+    entities = sorted({entity for entity, _ in keys})
+
+    res = {}
+    for start in range(0, len(entities), _MAX_IN_VALUES):
+        query = dbsession.query(
+            EntityContext.id, EntityContext.entity, EntityContext.content_hash
+        ).filter(
+            EntityContext.entity_type == entity_type,
+            EntityContext.entity.in_(entities[start : start + _MAX_IN_VALUES]),
+        )
+        for _id, entity, content_hash in query:
+            if (entity, content_hash) in keys:
+                res[(entity, content_hash)] = _id
+    return res
+
+
+def _set_entity_contexts(dbsession, entity_type, rows: List[Dict]):
+    """Move the shared parts of the contexts of annotation requests, given as
+    dicts of `_AR_COLUMNS`, to EntityContexts."""
+    split = [split_context(row["context"]) for row in rows]
+    with_shared = [i for i, (_, shared) in enumerate(split) if shared is not None]
+    ids = save_entity_contexts(
+        dbsession,
+        entity_type,
+        [(rows[i]["entity"], split[i][1]) for i in with_shared],
+    )
+    for row in rows:
+        row["entity_context_id"] = None
+    for i, _id in zip(with_shared, ids):
+        rows[i]["context"] = split[i][0]
+        rows[i]["entity_context_id"] = _id
+
+
+def _insert_annotation_requests(dbsession, rows: List[Dict]):
+    """Insert AnnotationRequests given as dicts of `_AR_COLUMNS`, without
+    going through the ORM."""
+    if not rows:
+        return
+    if dbsession.get_bind().dialect.name == "postgresql":
+        _copy_annotation_requests(dbsession, rows)
+    else:
+        dbsession.execute(AnnotationRequest.__table__.insert(), rows)
+
+
+def _copy_annotation_requests(dbsession, rows: List[Dict]):
+    """Same as _insert_annotation_requests, with PostgreSQL's COPY."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow(
+            [json.dumps(row[c]) if c == "context" else row[c] for c in _AR_COLUMNS]
+        )
+    buf.seek(0)
+
+    columns = ", ".join(f'"{c}"' for c in _AR_COLUMNS)
+    # Empty strings are NULL in the csv format, except in these columns.
+    not_null = ", ".join(f'"{c}"' for c in ["entity_type", "entity", "label"])
+    sql = (
+        f"COPY {AnnotationRequest.__tablename__} ({columns}) FROM STDIN "
+        f"WITH (FORMAT csv, FORCE_NOT_NULL ({not_null}))"
+    )
+    # Use the session's connection, so the COPY is part of its transaction.
+    cursor = dbsession.connection().connection.cursor()
+    try:
+        cursor.copy_expert(sql, buf)
+    finally:
+        cursor.close()
+
+
 def fetch_tasks_for_user_from_db(dbsession, username):
     res = (
         dbsession.query(AnnotationRequest.task_id, NewTask.name)
@@ -166,17 +484,23 @@ def count_completed_ar_under_task_and_user(dbsession, task_id, username):
 # TODO refactor this piece since it's a duplicate of the ar_request function.
 def construct_annotation_dict(dbsession, annotation_id) -> Dict:
     # TODO possible destructing of None
-    annotation_id, entity, entity_type, label, context = (
+    annotation_id, entity, entity_type, label, context, entity_context = (
         dbsession.query(
             ClassificationAnnotation.id,
             ClassificationAnnotation.entity,
             ClassificationAnnotation.entity_type,
             ClassificationAnnotation.label,
             ClassificationAnnotation.context,
+            EntityContext.context,
+        )
+        .outerjoin(
+            EntityContext,
+            ClassificationAnnotation.entity_context_id == EntityContext.id,
         )
         .filter(ClassificationAnnotation.id == annotation_id)
         .one_or_none()
     )
+    context = merge_context(context, entity_context)
 
     result = {
         # Essential fields
@@ -199,9 +523,11 @@ def construct_annotation_dict(dbsession, annotation_id) -> Dict:
                 "line_number": context.get("line_number"),
                 "score": context.get("score"),
                 "data": context.get("data") if "data" in context else context,
-                "pattern_info": context.get("pattern_info"),
             }
         )
+        result["pattern_info"] = read_pattern_info(
+            context.get("pattern_info"), result["data"]
+        )
     else:
         # TODO this is a temporarily workaround since some entities only
         #  have annotations but not annotation requests in my local db and
@@ -214,17 +540,22 @@ def construct_annotation_dict(dbsession, annotation_id) -> Dict:
 
 
 def construct_ar_request_dict(dbsession, ar_id) -> Dict:
-    request_id, entity, entity_type, label, context = (
+    request_id, entity, entity_type, label, context, entity_context = (
         dbsession.query(
             AnnotationRequest.id,
             AnnotationRequest.entity,
             AnnotationRequest.entity_type,
             AnnotationRequest.label,
             AnnotationRequest.context,
+            EntityContext.context,
+        )
+        .outerjoin(
+            EntityContext, AnnotationRequest.entity_context_id == EntityContext.id
         )
         .filter(AnnotationRequest.id == ar_id)
         .one_or_none()
     )
+    context = merge_context(context, entity_context)
 
     result = {
         # Essential fields
@@ -247,7 +578,9 @@ def construct_ar_request_dict(dbsession, ar_id) -> Dict:
                 "line_number": context.get("line_number"),
                 "score": context.get("score"),
                 "data": context.get("data"),
-                "pattern_info": context.get("pattern_info"),
+                "pattern_info": read_pattern_info(
+                    context.get("pattern_info"), context.get("data")
+                ),
             }
         )
 
@@ -403,7 +736,7 @@ def compute_annotation_statistics_db(dbsession, label, task_id):
     )
 
     kappa_stats_raw_data = _construct_kappa_stats_raw_data(
-        db.session, distinct_users, label
+        dbsession, distinct_users, label
     )
 
     kappa_matrices = _compute_kappa_matrix(kappa_stats_raw_data)
@@ -422,6 +755,106 @@ def compute_annotation_statistics_db(dbsession, label, task_id):
     }
 
 
+def compute_task_statistics(dbsession, task) -> Dict:
+    """The statistics of `compute_annotation_statistics_db` for each label of
+    the task, and of `compute_annotation_request_statistics`, in a form that
+    can be stored as JSON, see `load_task_statistics`.
+    """
+    statistics_per_label = {}
+    for label in task.get_labels():
+        statistics = compute_annotation_statistics_db(dbsession, label, task.id)
+        statistics_per_label[label] = {
+            "total_annotations": statistics["total_annotations"],
+            "total_distinct_annotated_entities": statistics[
+                "total_distinct_annotated_entities"
+            ],
+            # JSON keys are strings, keep the values as ints.
+            "n_annotations_per_value": [
+                [value, n] for value, n in statistics["n_annotations_per_value"].items()
+            ],
+            "n_annotations_per_user": dict(statistics["n_annotations_per_user"]),
+            "kappa_table": {
+                k: _kappa_dataframe_to_dict(df)
+                for k, df in statistics["kappa_table"].items()
+            },
+        }
+
+    return {
+        "labels": statistics_per_label,
+        "requests": compute_annotation_request_statistics(dbsession, task.id),
+    }
+
+
+def load_task_statistics(statistics: Dict, task_id) -> Tuple[Dict, Dict]:
+    """The statistics per label and of the requests, as returned by
+    `compute_annotation_statistics_db` and
+    `compute_annotation_request_statistics`, from the output of
+    `compute_task_statistics`.
+    """
+    statistics_per_label = {}
+    for label, row in statistics["labels"].items():
+        n_annotations_per_value = PrettyDefaultDict(lambda: 0)
+        for value, n in row["n_annotations_per_value"]:
+            n_annotations_per_value[value] = n
+
+        kappa_matrices = PrettyDefaultDict(DataFrame)
+        for k, table in row["kappa_table"].items():
+            kappa_matrices[k] = _kappa_dict_to_dataframe(table)
+
+        statistics_per_label[label] = {
+            "total_annotations": row["total_annotations"],
+            "total_distinct_annotated_entities": row[
+                "total_distinct_annotated_entities"
+            ],
+            "n_annotations_per_value": n_annotations_per_value,
+            "n_annotations_per_user": row["n_annotations_per_user"],
+            "kappa_table": kappa_matrices,
+            # The links are cheap to build, and depend on the configured
+            # annotation server.
+            "kappa_analysis_link_dict": _construct_kappa_analysis_link_dict(
+                kappa_matrices=kappa_matrices, task_id=task_id
+            ),
+        }
+
+    return statistics_per_label, statistics["requests"]
+
+
+def refresh_task_statistics(dbsession, task) -> TaskStatistics:
+    """Compute and store the statistics of a task."""
+    computed_at = datetime.now(timezone.utc)
+    statistics = compute_task_statistics(dbsession, task)
+
+    snapshot = fetch_task_statistics(dbsession, task.id)
+    if snapshot is None:
+        snapshot = TaskStatistics(task_id=task.id)
+        dbsession.add(snapshot)
+    snapshot.statistics = statistics
+    snapshot.computed_at = computed_at
+    dbsession.commit()
+    return snapshot
+
+
+def fetch_task_statistics(dbsession, task_id) -> Optional[TaskStatistics]:
+    return dbsession.query(TaskStatistics).filter_by(task_id=task_id).one_or_none()
+
+
+def _kappa_dataframe_to_dict(df: DataFrame) -> Dict:
+    # NaN (no overlapping annotations) isn't valid JSON.
+    return {
+        "index": list(df.index),
+        "columns": list(df.columns),
+        "data": [
+            [None if pd.isna(x) else float(x) for x in row] for row in df.values
+        ],
+    }
+
+
+def _kappa_dict_to_dataframe(table: Dict) -> DataFrame:
+    return pd.DataFrame(
+        table["data"], index=table["index"], columns=table["columns"], dtype=float
+    )
+
+
 def _compute_num_of_annotations_per_value(dbsession, label):
     res = (
         dbsession.query(
@@ -0,0 +1,309 @@
+from collections import namedtuple
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+Example = namedtuple(
+    "Example", ["score", "entity_type", "entity", "label", "fname", "line_number"]
+)
+
+
+class EntityIndex:
+    """Interns entity names into dense integer ids, so examples can be
+    compared and deduplicated with array operations.
+
+    A missing entity (None) is always mapped to the id -1.
+    """
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self.entities: List[str] = []
+
+    def __len__(self):
+        return len(self.entities)
+
+    def get_id(self, entity) -> int:
+        if entity is None:
+            return -1
+        _id = self._ids.get(entity)
+        if _id is None:
+            _id = len(self.entities)
+            self._ids[entity] = _id
+            self.entities.append(entity)
+        return _id
+
+    def get_ids(self, entities: Sequence) -> np.ndarray:
+        return np.array([self.get_id(x) for x in entities], dtype=np.int64)
+
+    def get_entity(self, entity_id: int):
+        if entity_id < 0:
+            return None
+        return self.entities[entity_id]
+
+
+class ExampleStore:
+    """A columnar list of scored examples.
+
+    This stores the same information as a list of `Example`s, but as NumPy
+    arrays, with the entities, labels and filenames replaced by integer ids
+    into `entity_index`, `labels` and `fnames` respectively. Rows are kept in
+    the order they were added, unless explicitly sorted.
+    """
+
+    def __init__(
+        self,
+        entity_type: str,
+        labels: List[str],
+        fnames: List[str],
+        entity_index: EntityIndex,
+        scores: np.ndarray,
+        entity_ids: np.ndarray,
+        label_ids: np.ndarray,
+        fname_ids: np.ndarray,
+        line_numbers: np.ndarray,
+    ):
+        self.entity_type = entity_type
+        self.labels = labels
+        self.fnames = fnames
+        self.entity_index = entity_index
+
+        self.scores = np.asarray(scores, dtype=np.float64)
+        self.entity_ids = np.asarray(entity_ids, dtype=np.int64)
+        self.label_ids = np.asarray(label_ids, dtype=np.int32)
+        self.fname_ids = np.asarray(fname_ids, dtype=np.int32)
+        self.line_numbers = np.asarray(line_numbers, dtype=np.int64)
+
+        n = len(self.scores)
+        assert (
+            len(self.entity_ids) == n
+            and len(self.label_ids) == n
+            and len(self.fname_ids) == n
+            and len(self.line_numbers) == n
+        ), "All columns must have the same length"
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __repr__(self):
+        return f"<ExampleStore labels={self.labels} n={len(self)}>"
+
+    @staticmethod
+    def empty(
+        entity_type: str,
+        label: str,
+        fnames: List[str],
+        entity_index: Optional[EntityIndex] = None,
+    ) -> "ExampleStore":
+        return ExampleStore(
+            entity_type,
+            labels=[label],
+            fnames=list(fnames),
+            entity_index=entity_index or EntityIndex(),
+            scores=np.empty(0),
+            entity_ids=np.empty(0),
+            label_ids=np.empty(0),
+            fname_ids=np.empty(0),
+            line_numbers=np.empty(0),
+        )
+
+    @staticmethod
+    def for_chunk(
+        entity_type: str,
+        label: str,
+        fnames: List[str],
+        entity_index: EntityIndex,
+        scores: Sequence[float],
+        entity_ids: np.ndarray,
+        fname: str,
+        first_line_number: int,
+    ) -> "ExampleStore":
+        """Build a store from the scores of consecutive lines of a file.
+        `entity_ids` come from `entity_index.get_ids`."""
+        n = len(scores)
+        return ExampleStore(
+            entity_type,
+            labels=[label],
+            fnames=fnames,
+            entity_index=entity_index,
+            scores=np.asarray(scores, dtype=np.float64),
+            entity_ids=entity_ids,
+            label_ids=np.zeros(n),
+            fname_ids=np.full(n, fnames.index(fname)),
+            line_numbers=np.arange(first_line_number, first_line_number + n),
+        )
+
+    @staticmethod
+    def from_examples(
+        examples: List[Example], entity_index: Optional[EntityIndex] = None
+    ) -> "ExampleStore":
+        if entity_index is None:
+            entity_index = EntityIndex()
+
+        entity_types = set(ex.entity_type for ex in examples)
+        assert len(entity_types) <= 1, "Examples must have the same entity type"
+        entity_type = entity_types.pop() if entity_types else None
+
+        labels = _unique_in_order(ex.label for ex in examples)
+        fnames = _unique_in_order(ex.fname for ex in examples)
+        label_lookup = {x: i for i, x in enumerate(labels)}
+        fname_lookup = {x: i for i, x in enumerate(fnames)}
+
+        return ExampleStore(
+            entity_type,
+            labels=labels,
+            fnames=fnames,
+            entity_index=entity_index,
+            scores=[ex.score for ex in examples],
+            entity_ids=entity_index.get_ids([ex.entity for ex in examples]),
+            label_ids=[label_lookup[ex.label] for ex in examples],
+            fname_ids=[fname_lookup[ex.fname] for ex in examples],
+            line_numbers=[ex.line_number for ex in examples],
+        )
+
+    @staticmethod
+    def concat(stores: List["ExampleStore"]) -> "ExampleStore":
+        """Concatenate stores, remapping their ids if their vocabularies
+        differ."""
+        assert len(stores) > 0, "Need at least one store to concatenate"
+
+        first = stores[0]
+        entity_index = first.entity_index
+        labels = _unique_in_order(x for s in stores for x in s.labels)
+        fnames = _unique_in_order(x for s in stores for x in s.fnames)
+        label_lookup = {x: i for i, x in enumerate(labels)}
+        fname_lookup = {x: i for i, x in enumerate(fnames)}
+
+        entity_ids, label_ids, fname_ids = [], [], []
+        for s in stores:
+            if s.entity_index is entity_index:
+                entity_ids.append(s.entity_ids)
+            else:
+                entity_ids.append(
+                    entity_index.get_ids(
+                        [s.entity_index.get_entity(x) for x in s.entity_ids]
+                    )
+                )
+            label_map = np.array([label_lookup[x] for x in s.labels], dtype=np.int32)
+            fname_map = np.array([fname_lookup[x] for x in s.fnames], dtype=np.int32)
+            label_ids.append(label_map[s.label_ids])
+            fname_ids.append(fname_map[s.fname_ids])
+
+        return ExampleStore(
+            first.entity_type,
+            labels=labels,
+            fnames=fnames,
+            entity_index=entity_index,
+            scores=np.concatenate([s.scores for s in stores]),
+            entity_ids=np.concatenate(entity_ids),
+            label_ids=np.concatenate(label_ids),
+            fname_ids=np.concatenate(fname_ids),
+            line_numbers=np.concatenate([s.line_numbers for s in stores]),
+        )
+
+    def to_dict(self) -> Dict:
+        """A JSON serializable version of the store, e.g. to pass it between
+        Celery tasks. Only the entities in the store are included."""
+        entity_ids, inverse = np.unique(self.entity_ids, return_inverse=True)
+        return {
+            "entity_type": self.entity_type,
+            "labels": self.labels,
+            "fnames": self.fnames,
+            "entities": [self.entity_index.get_entity(x) for x in entity_ids],
+            "scores": self.scores.tolist(),
+            "entity_ids": inverse.tolist(),
+            "label_ids": self.label_ids.tolist(),
+            "fname_ids": self.fname_ids.tolist(),
+            "line_numbers": self.line_numbers.tolist(),
+        }
+
+    @staticmethod
+    def from_dict(
+        d: Dict, entity_index: Optional[EntityIndex] = None
+    ) -> "ExampleStore":
+        """The inverse of `to_dict`. Entities are interned in `entity_index`."""
+        if entity_index is None:
+            entity_index = EntityIndex()
+        entity_map = entity_index.get_ids(d["entities"])
+
+        return ExampleStore(
+            d["entity_type"],
+            labels=d["labels"],
+            fnames=d["fnames"],
+            entity_index=entity_index,
+            scores=d["scores"],
+            entity_ids=entity_map[np.asarray(d["entity_ids"], dtype=np.int64)],
+            label_ids=d["label_ids"],
+            fname_ids=d["fname_ids"],
+            line_numbers=d["line_numbers"],
+        )
+
+    def take(self, idx: np.ndarray) -> "ExampleStore":
+        """A new store with only the rows at `idx`, in that order."""
+        return ExampleStore(
+            self.entity_type,
+            labels=self.labels,
+            fnames=self.fnames,
+            entity_index=self.entity_index,
+            scores=self.scores[idx],
+            entity_ids=self.entity_ids[idx],
+            label_ids=self.label_ids[idx],
+            fname_ids=self.fname_ids[idx],
+            line_numbers=self.line_numbers[idx],
+        )
+
+    def sorted(self) -> "ExampleStore":
+        """Sort from highest to lowest score. Ties keep their order."""
+        return self.take(np.argsort(-self.scores, kind="stable"))
+
+    def top_k(self, k: int) -> "ExampleStore":
+        """Same as self.sorted() truncated to k rows, but only the k selected
+        rows are fully sorted."""
+        n = len(self)
+        if k >= n:
+            return self.sorted()
+        if k <= 0:
+            return self.take(np.empty(0, dtype=np.int64))
+
+        # argpartition is free to break ties at the boundary arbitrarily, so
+        # we only use it to find the k-th highest score, and then pick the
+        # earliest of the tied rows to remain consistent with a stable sort.
+        kth = np.argpartition(-self.scores, k - 1)[k - 1]
+        threshold = self.scores[kth]
+        above = np.flatnonzero(self.scores > threshold)
+        ties = np.flatnonzero(self.scores == threshold)[: k - len(above)]
+        idx = np.sort(np.concatenate([above, ties]))
+        return self.take(idx[np.argsort(-self.scores[idx], kind="stable")])
+
+    def unique_entities(self) -> List[str]:
+        """The distinct entities in this store, ignoring missing ones."""
+        entity_ids = np.unique(self.entity_ids)
+        return [self.entity_index.get_entity(x) for x in entity_ids if x >= 0]
+
+    def entity(self, i: int):
+        return self.entity_index.get_entity(self.entity_ids[i])
+
+    def label(self, i: int) -> str:
+        return self.labels[self.label_ids[i]]
+
+    def example(self, i: int) -> Example:
+        return Example(
+            score=float(self.scores[i]),
+            entity_type=self.entity_type,
+            entity=self.entity(i),
+            label=self.label(i),
+            fname=self.fnames[self.fname_ids[i]],
+            line_number=int(self.line_numbers[i]),
+        )
+
+    def to_examples(self) -> List[Example]:
+        return [self.example(i) for i in range(len(self))]
+
+
+def _unique_in_order(items) -> List:
+    res = []
+    seen = set()
+    for x in items:
+        if x not in seen:
+            seen.add(x)
+            res.append(x)
+    return res
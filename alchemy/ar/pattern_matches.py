@@ -0,0 +1,198 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from alchemy.ar.example_store import ExampleStore
+
+# Rows are keyed by (file id << _LINE_BITS) | line number.
+_LINE_BITS = 40
+
+# (start token, end token, start char, end char) of a match, see
+# PatternModel.predict.
+Span = Tuple[int, int, int, int]
+
+
+def _get_keys(fname_ids, line_numbers) -> np.ndarray:
+    fname_ids = np.asarray(fname_ids, dtype=np.int64)
+    line_numbers = np.asarray(line_numbers, dtype=np.int64)
+    return (fname_ids << _LINE_BITS) | line_numbers
+
+
+def _remap_keys(keys: np.ndarray, fname_map: np.ndarray) -> np.ndarray:
+    """Keys with their file ids mapped through `fname_map`."""
+    return _get_keys(fname_map[keys >> _LINE_BITS], keys & ((1 << _LINE_BITS) - 1))
+
+
+class PatternMatches:
+    """The matches a label's PatternModel found while ranking the examples,
+    and the scores they gave, so they can be reused to decorate the examples
+    we end up assigning instead of matching the patterns again.
+
+    Only the matches of candidate rows (see `keep`) are kept, as flat arrays
+    with one entry per match, so rows without a match take no space.
+    """
+
+    def __init__(self, fnames: List[str]):
+        self.fnames = list(fnames)
+        self._fname_lookup = {x: i for i, x in enumerate(self.fnames)}
+
+        # Whether the matches of each file were recorded, i.e. its scores
+        # weren't read from the inference cache.
+        self._recorded = np.zeros(len(self.fnames), dtype=bool)
+        # Sorted row keys, one per match, the span of each match and the
+        # score of its row.
+        self._keys = np.empty(0, dtype=np.int64)
+        self._spans = np.empty((0, 4), dtype=np.int64)
+        self._scores = np.empty(0, dtype=np.float64)
+        # Matches added since the last call to `keep`.
+        self._pending: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+        # Sorted keys of the rows whose matches we kept, or None to keep all.
+        self._candidates: Optional[np.ndarray] = None
+
+    def add(
+        self,
+        fname: str,
+        first_line_number: int,
+        spans: List[List[Span]],
+        scores: List[float],
+    ):
+        """Record the spans and scores of consecutive lines of a file, as
+        returned by `PatternModel.predict(..., spans=True)`."""
+        fname_id = self._fname_lookup[fname]
+        self._recorded[fname_id] = True
+
+        line_numbers = []
+        flat_spans = []
+        flat_scores = []
+        for i, (row, score) in enumerate(zip(spans, scores)):
+            line_numbers += [first_line_number + i] * len(row)
+            flat_spans += row
+            flat_scores += [score] * len(row)
+        if flat_spans:
+            self._pending.append(
+                (
+                    _get_keys(fname_id, line_numbers),
+                    np.array(flat_spans, dtype=np.int64),
+                    np.array(flat_scores, dtype=np.float64),
+                )
+            )
+
+    def keep(self, stores: Sequence[ExampleStore]):
+        """Only keep the matches of the rows in `stores`, i.e. the candidates
+        that are still in the running to be assigned."""
+        candidate_keys = []
+        for store in stores:
+            fname_map = np.array(
+                [self._fname_lookup[x] for x in store.fnames], dtype=np.int64
+            )
+            candidate_keys.append(
+                _get_keys(fname_map[store.fname_ids], store.line_numbers)
+            )
+        candidates = np.unique(
+            np.concatenate([np.empty(0, dtype=np.int64)] + candidate_keys)
+        )
+
+        keys = np.concatenate([self._keys] + [k for k, _, _ in self._pending])
+        spans = np.concatenate([self._spans] + [s for _, s, _ in self._pending])
+        scores = np.concatenate([self._scores] + [s for _, _, s in self._pending])
+        self._pending = []
+
+        mask = np.isin(keys, candidates)
+        # Stable, so the spans of a row stay sorted.
+        order = np.argsort(keys[mask], kind="stable")
+        self._keys = keys[mask][order]
+        self._spans = spans[mask][order]
+        self._scores = scores[mask][order]
+        self._candidates = candidates
+
+    def to_dict(self) -> Dict:
+        """A JSON serializable version of the matches, e.g. to pass them
+        between Celery tasks."""
+        assert not self._pending, "Call keep() before serializing the matches"
+        return {
+            "fnames": self.fnames,
+            "recorded": self._recorded.tolist(),
+            "keys": self._keys.tolist(),
+            "spans": self._spans.tolist(),
+            "scores": self._scores.tolist(),
+            "candidates": (
+                self._candidates.tolist() if self._candidates is not None else None
+            ),
+        }
+
+    @staticmethod
+    def from_dict(d: Dict) -> "PatternMatches":
+        """The inverse of `to_dict`."""
+        res = PatternMatches(d["fnames"])
+        res._recorded = np.asarray(d["recorded"], dtype=bool)
+        res._keys = np.asarray(d["keys"], dtype=np.int64)
+        res._spans = np.asarray(d["spans"], dtype=np.int64).reshape(-1, 4)
+        res._scores = np.asarray(d["scores"], dtype=np.float64)
+        if d["candidates"] is not None:
+            res._candidates = np.asarray(d["candidates"], dtype=np.int64)
+        return res
+
+    @staticmethod
+    def concat(matches: List["PatternMatches"]) -> "PatternMatches":
+        """Merge the matches recorded on different data files, e.g. by
+        different Celery tasks."""
+        fnames = list(dict.fromkeys(x for m in matches for x in m.fnames))
+        res = PatternMatches(fnames)
+
+        keys, spans, scores, candidates = [], [], [], []
+        for m in matches:
+            assert not m._pending, "Call keep() before merging the matches"
+            assert m._candidates is not None, "Call keep() before merging the matches"
+            fname_map = np.array(
+                [res._fname_lookup[x] for x in m.fnames], dtype=np.int64
+            )
+            res._recorded[fname_map] |= m._recorded
+            keys.append(_remap_keys(m._keys, fname_map))
+            spans.append(m._spans)
+            scores.append(m._scores)
+            candidates.append(_remap_keys(m._candidates, fname_map))
+
+        keys = np.concatenate([res._keys] + keys)
+        # Stable, so the spans of a row stay sorted.
+        order = np.argsort(keys, kind="stable")
+        res._keys = keys[order]
+        res._spans = np.concatenate([res._spans] + spans)[order]
+        res._scores = np.concatenate([res._scores] + scores)[order]
+        res._candidates = np.unique(
+            np.concatenate([np.empty(0, dtype=np.int64)] + candidates)
+        )
+        return res
+
+    def get(self, fname: str, line_number: int) -> Optional[List[Span]]:
+        """The spans of a row, or None if they weren't recorded."""
+        res = self._get_range(fname, line_number)
+        if res is None:
+            return None
+        start, end = res
+        return [tuple(int(x) for x in span) for span in self._spans[start:end]]
+
+    def get_score(self, fname: str, line_number: int) -> Optional[float]:
+        """The score of a row, or None if it wasn't recorded."""
+        res = self._get_range(fname, line_number)
+        if res is None:
+            return None
+        start, end = res
+        # Rows without a match score 0.
+        return float(self._scores[start]) if end > start else 0.0
+
+    def _get_range(self, fname: str, line_number: int) -> Optional[Tuple[int, int]]:
+        """Where the matches of a row are in the flat arrays, or None if they
+        weren't recorded."""
+        fname_id = self._fname_lookup.get(fname)
+        if fname_id is None or not self._recorded[fname_id]:
+            return None
+
+        assert not self._pending, "Call keep() before reading the matches"
+        key = _get_keys(fname_id, line_number)
+        if self._candidates is not None:
+            idx = np.searchsorted(self._candidates, key)
+            if idx == len(self._candidates) or self._candidates[idx] != key:
+                return None
+
+        start, end = np.searchsorted(self._keys, [key, key + 1])
+        return int(start), int(end)
@@ -0,0 +1,86 @@
+"""
+Long-lived ar_celery workers.
+
+Instead of starting a fresh process for every job, the worker loads the heavy
+resources (spaCy and its tokenizer) once when it starts, before forking its
+pool processes, so every job can reuse them. Each pool process keeps its
+database connections open between jobs, see alchemy.db.engines.
+
+Memory is bounded in two steps:
+
+- After each job, if the process uses more than
+  ANNOTATION_TOOL_AR_WORKER_EVICT_MB, the in-memory caches are evicted.
+- If it still grows past ANNOTATION_TOOL_AR_WORKER_MAX_MEMORY_MB, Celery
+  replaces the process after its current job (worker_max_memory_per_child).
+"""
+import gc
+import logging
+import os
+import resource
+from typing import Optional
+
+from envparse import env
+
+from alchemy.inference.cache import clear_file_hashes
+from alchemy.inference.nlp_model import clear_loaded_model
+from alchemy.inference.pattern_matchers import (
+    SPACY,
+    clear_matchers,
+    get_backend,
+    get_nlp,
+)
+from alchemy.inference.prob_index import clear_loaded_indexes
+
+
+def preload():
+    """Load what every job needs once, before the pool processes are
+    forked."""
+    if get_backend() == SPACY:
+        try:
+            get_nlp()
+        except Exception as e:
+            # Jobs will try again, and report the error.
+            logging.error(f"Could not preload the spaCy model: {e}")
+
+
+def get_rss_mb() -> float:
+    """The current resident memory of this process."""
+    try:
+        with open("/proc/self/statm") as f:
+            n_pages = int(f.read().split()[1])
+        return n_pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        # Not on Linux, use the peak instead.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def evict_caches():
+    """Drop the in-memory caches, they are rebuilt (mostly from the disk
+    caches) as needed."""
+    clear_matchers()
+    clear_loaded_indexes()
+    clear_loaded_model()
+    clear_file_hashes()
+    gc.collect()
+
+
+def maybe_evict_caches() -> bool:
+    """Evict the caches if this process uses too much memory.
+
+    Returns whether they were evicted.
+    """
+    max_mb = env.int("ANNOTATION_TOOL_AR_WORKER_EVICT_MB", default=2048)
+    rss_mb = get_rss_mb()
+    if max_mb <= 0 or rss_mb <= max_mb:
+        return False
+
+    evict_caches()
+    logging.info(f"Evicted caches at {rss_mb:.0f}MB, now {get_rss_mb():.0f}MB")
+    return True
+
+
+def get_max_memory_per_child() -> Optional[int]:
+    """Celery's worker_max_memory_per_child, in KB, or None to never replace
+    the pool processes."""
+    max_mb = env.int("ANNOTATION_TOOL_AR_WORKER_MAX_MEMORY_MB", default=4096)
+    return max_mb * 1024 if max_mb > 0 else None
@@ -0,0 +1,183 @@
+"""
+Process-wide registry of SQLAlchemy engines, one per database URI, so Celery
+tasks and scripts share a warm connection pool instead of creating an engine
+(and connecting) every time they need the database.
+
+Engines are configured from the environment:
+
+    ANNOTATION_TOOL_DB_POOL_SIZE        Connections to keep open.
+    ANNOTATION_TOOL_DB_MAX_OVERFLOW     Extra connections to open under load.
+    ANNOTATION_TOOL_DB_POOL_TIMEOUT     Seconds to wait for a connection.
+    ANNOTATION_TOOL_DB_POOL_RECYCLE     Seconds after which to reconnect.
+    ANNOTATION_TOOL_DB_POOL_PRE_PING    Whether to check connections are alive
+                                        before using them.
+
+The pool settings only apply to databases with a connection pool, i.e. not
+SQLite.
+"""
+import os
+import threading
+import time
+from typing import Dict
+
+from envparse import env
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+_lock = threading.Lock()
+# The process the engines were created in, they can't be shared with a
+# forked process.
+_pid = None
+# URI -> (engine, scoped session factory, PoolStats)
+_engines: Dict[str, tuple] = {}
+
+
+class PoolStats:
+    """Counters of a connection pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def add_wait(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def incr(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            return {
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_seconds_total": self.wait_seconds_total,
+                "wait_seconds_max": self.wait_seconds_max,
+            }
+
+
+class _TimedQueuePool(QueuePool):
+    """A QueuePool that records how long it takes to get a connection."""
+
+    # Set once the engine is created, see _create_engine.
+    _stats = None
+
+    def recreate(self):
+        # Used by Engine.dispose.
+        pool = super().recreate()
+        pool._stats = self._stats
+        return pool
+
+    def _do_get(self):
+        if self._stats is None:
+            return super()._do_get()
+
+        start = time.monotonic()
+        try:
+            conn = super()._do_get()
+        except PoolTimeoutError:
+            self._stats.add_wait(time.monotonic() - start, timed_out=True)
+            raise
+        self._stats.add_wait(time.monotonic() - start)
+        return conn
+
+
+def get_engine(db_uri: str):
+    """The engine of a database, created once per process."""
+    return _get(db_uri)[0]
+
+
+def get_scoped_session(db_uri: str) -> scoped_session:
+    """The session factory of a database, shared by the whole process, which
+    gives each thread its own session."""
+    return _get(db_uri)[1]
+
+
+def get_pool_stats() -> Dict[str, Dict]:
+    """The counters of the connection pool of each database, and how many
+    connections are open and in use, by URI (without the password)."""
+    with _lock:
+        engines = dict(_engines) if _pid == os.getpid() else {}
+
+    res = {}
+    for db_uri, (engine, _, stats) in engines.items():
+        row = stats.to_dict()
+        pool = engine.pool
+        if isinstance(pool, QueuePool):
+            row.update(
+                {
+                    "size": pool.size(),
+                    "checked_in": pool.checkedin(),
+                    "checked_out": pool.checkedout(),
+                    "overflow": pool.overflow(),
+                }
+            )
+        res[repr(make_url(db_uri))] = row
+    return res
+
+
+def dispose_engines():
+    """Close the connections of every engine and forget them."""
+    global _pid
+    with _lock:
+        engines = list(_engines.values()) if _pid == os.getpid() else []
+        _engines.clear()
+        _pid = None
+    for engine, session, _ in engines:
+        session.remove()
+        engine.dispose()
+
+
+def _get(db_uri: str):
+    global _pid
+    with _lock:
+        if _pid != os.getpid():
+            # Forked: the parent's connections belong to the parent.
+            _engines.clear()
+            _pid = os.getpid()
+
+        res = _engines.get(db_uri)
+        if res is None:
+            stats = PoolStats()
+            engine = _create_engine(db_uri, stats)
+            res = (engine, scoped_session(sessionmaker(bind=engine)), stats)
+            _engines[db_uri] = res
+        return res
+
+
+def _create_engine(db_uri: str, stats: PoolStats):
+    kwargs = {}
+    if make_url(db_uri).get_backend_name() != "sqlite":
+        kwargs = dict(
+            poolclass=_TimedQueuePool,
+            pool_size=env.int("ANNOTATION_TOOL_DB_POOL_SIZE", default=5),
+            max_overflow=env.int("ANNOTATION_TOOL_DB_MAX_OVERFLOW", default=10),
+            pool_timeout=env.int("ANNOTATION_TOOL_DB_POOL_TIMEOUT", default=30),
+            pool_recycle=env.int("ANNOTATION_TOOL_DB_POOL_RECYCLE", default=1800),
+            pool_pre_ping=env.bool("ANNOTATION_TOOL_DB_POOL_PRE_PING", default=True),
+        )
+    engine = create_engine(db_uri, **kwargs)
+    if isinstance(engine.pool, _TimedQueuePool):
+        engine.pool._stats = stats
+
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        stats.incr("connects")
+
+    @event.listens_for(engine, "checkout")
+    def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+        stats.incr("checkouts")
+
+    return engine
@@ -6,6 +6,7 @@ from envparse import env
 RAW_DATA_DIR = "raw_data"
 TRAINING_DATA_DIR = "training_data"
 MODELS_DIR = "models"
+AR_CANDIDATES_DIR = "ar_candidates"
 
 PathT = Union[Path, str]
 
@@ -48,3 +49,7 @@ def models_dir(base: Optional[PathT] = None, as_path: bool = False) -> PathT:
 
 def training_data_dir(base: Optional[PathT] = None, as_path: bool = False) -> PathT:
     return _make_path(base, as_path, TRAINING_DATA_DIR)
+
+
+def ar_candidates_dir(base: Optional[PathT] = None, as_path: bool = False) -> PathT:
+    return _make_path(base, as_path, AR_CANDIDATES_DIR)
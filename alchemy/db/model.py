@@ -1,22 +1,26 @@
 import copy
+import hashlib
+import json
 import logging
 import os
 import pickle
 import urllib.parse
+from datetime import datetime, timezone
 from typing import List, Optional, Union
 
 import flask_login
 import pandas as pd
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Boolean, MetaData, UniqueConstraint, create_engine, desc, inspect
+from sqlalchemy import Boolean, MetaData, UniqueConstraint, desc, inspect
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, scoped_session, sessionmaker
+from sqlalchemy.orm import relationship
 from sqlalchemy.orm.attributes import flag_modified
 from sqlalchemy.schema import Column, ForeignKey
 from sqlalchemy.sql import func
 from sqlalchemy.types import JSON, DateTime, Float, Integer, String
 from werkzeug.utils import secure_filename
 
+from alchemy.db.engines import get_engine, get_scoped_session
 from alchemy.db.fs import raw_data_dir, training_data_dir, filestore_base_dir
 from alchemy.shared.config import Config
 from alchemy.shared.utils import (
@@ -30,6 +34,12 @@ from alchemy.shared.utils import (
 )
 from alchemy.train.no_deps.inference_results import InferenceResults
 from alchemy.train.no_deps.metrics import compute_metrics as _compute_metrics
+from alchemy.train.no_deps.raw_data_columns import (
+    DOMAIN,
+    NAME,
+    TEXT,
+    load_raw_data_columns,
+)
 from alchemy.train.no_deps.paths import (
     _get_all_inference_fnames,
     _get_all_plots,
@@ -69,18 +79,17 @@ metadata = db.Model.metadata
 
 
 class Database:
-    """For accessing database outside of Flask."""
+    """For accessing database outside of Flask.
 
-    def __init__(self, db_uri):
-        engine = create_engine(db_uri)
-        session_factory = sessionmaker(bind=engine)
+    All the instances for the same database in a process share an engine
+    (and its connection pool) and session factory, see alchemy.db.engines.
+    """
 
+    def __init__(self, db_uri):
         # scoped_session makes sure the factory returns a singleton session
         # instance per scope, until you explicitly call session.remove().
-        session = scoped_session(session_factory)
-
-        self.session = session
-        self.engine = engine
+        self.session = get_scoped_session(db_uri)
+        self.engine = get_engine(db_uri)
 
     @staticmethod
     def from_config(config):
@@ -211,6 +220,11 @@ class ClassificationAnnotation(Base):
     }
     """
 
+    # The context shared with the annotation request this annotation was made
+    # from, if any, see EntityContext.
+    entity_context_id = Column(Integer, ForeignKey("entity_context.id"), index=True)
+    entity_context = relationship("EntityContext")
+
     def __repr__(self):
         return """
         Classification Annotation {}:
@@ -696,6 +710,38 @@ class Task(Base):
         )
 
 
+class TaskStatistics(Base):
+    """A snapshot of the annotation statistics shown on the admin page of a
+    task, refreshed in the background when its annotations change, see
+    alchemy.shared.statistics_refresh.
+    """
+
+    __tablename__ = "task_statistics"
+
+    id = Column(Integer, primary_key=True)
+
+    task_id = Column(
+        Integer, ForeignKey("task.id"), index=True, unique=True, nullable=False
+    )
+    task = relationship("Task")
+
+    # See alchemy.ar.data.compute_task_statistics.
+    statistics = Column(JSON, nullable=False)
+
+    # When we started computing the statistics, so changes made while they
+    # were computed are picked up by the next refresh.
+    computed_at = Column(DateTime(timezone=True), nullable=False)
+
+    def get_computed_at_utc(self) -> datetime:
+        if self.computed_at.tzinfo is None:
+            # SQLite drops the timezone, we store UTC.
+            return self.computed_at.replace(tzinfo=timezone.utc)
+        return self.computed_at.astimezone(timezone.utc)
+
+    def get_age_seconds(self) -> float:
+        return (datetime.now(timezone.utc) - self.get_computed_at_utc()).total_seconds()
+
+
 class AnnotationRequest(Base):
     __tablename__ = "annotation_request"
 
@@ -742,8 +788,44 @@ class AnnotationRequest(Base):
     # What aspect of the Entity is presented to the user and why.
     # ** This is meant to be copied over to the Annotation **
     # Includes: text, images, probability scores, source etc.
+    # The parts shared by all the requests for the entity (its data and
+    # pattern matches) are stored once in `entity_context` instead.
+    context = Column(JSON)
+
+    entity_context_id = Column(Integer, ForeignKey("entity_context.id"), index=True)
+    entity_context = relationship("EntityContext")
+
+
+class EntityContext(Base):
+    """The context of an entity that doesn't depend on who it's shown to, e.g.
+    its text, meta and pattern matches, stored once per distinct content and
+    referenced by AnnotationRequests and ClassificationAnnotations.
+    """
+
+    __tablename__ = "entity_context"
+
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    entity = Column(String, nullable=False)
+    entity_type = Column(String, nullable=False)
+
+    # See `hash_context`.
+    content_hash = Column(String(32), nullable=False)
+
     context = Column(JSON)
 
+    __table_args__ = (
+        UniqueConstraint(
+            "entity_type", "entity", "content_hash", name="_entity_context_uc"
+        ),
+    )
+
+    @staticmethod
+    def hash_context(context) -> str:
+        context = json.dumps(context, sort_keys=True)
+        return hashlib.md5(context.encode()).hexdigest()
+
 
 class AnnotationGuide(Base):
     __tablename__ = "annotation_guide"
@@ -1000,24 +1082,34 @@ def load_inference(
     ir = InferenceResults.load(path)
 
     # Load Original Data
-    # This already includes the column "text"
     # TODO This function needs to be outside of the version_dir because the
     # original data is not in the version_dir!
-    df = load_jsonl(_raw_data_file_path(dataset_filename), to_df=True)
+    raw_data_path = _raw_data_file_path(dataset_filename)
+    raw_columns = load_raw_data_columns(raw_data_path)
+
+    if raw_columns is not None:
+        # Only decode the columns we need.
+        df = pd.DataFrame(index=range(len(raw_columns)))
+        for col, raw_col in [("text", TEXT), ("name", NAME), ("domain", DOMAIN)]:
+            if col in columns:
+                df[col] = raw_columns.get(raw_col)
+    else:
+        # This already includes the column "text"
+        df = load_jsonl(raw_data_path, to_df=True)
+        assert df is not None, f"Raw data not found: {dataset_filename}"
+
+        if "domain" in columns:
+            df["domain"] = df["meta"].apply(lambda x: x.get("domain"))
+
+        if "name" in columns:
+            df["name"] = df["meta"].apply(lambda x: x.get("name"))
 
-    # Check they exist and are the same size
-    assert df is not None, f"Raw data not found: {dataset_filename}"
+    # Check they are the same size
     assert len(df) == len(ir.probs), "Inference size != Raw data size"
 
     # Combine the two together.
     df["probs"] = ir.probs
 
-    if "domain" in columns:
-        df["domain"] = df["meta"].apply(lambda x: x.get("domain"))
-
-    if "name" in columns:
-        df["name"] = df["meta"].apply(lambda x: x.get("name"))
-
     return df[columns]
 
 
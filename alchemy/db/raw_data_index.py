@@ -0,0 +1,220 @@
+"""
+A sidecar index for the jsonl files in the raw data directory, so we can read
+individual rows without parsing the whole file.
+
+For a data file `raw_data/myfile.jsonl`, the index lives in the hidden
+directory `raw_data/.myfile.jsonl.index/` and contains:
+
+    offsets.npy         Byte offset of each line, plus the size of the file.
+    entity_hashes.npy   Sorted hashes of each line's entity (meta.domain).
+    entity_lines.npy    The line number for each hash in entity_hashes.npy.
+    meta.json           Size and mtime of the data file the index was built
+                        from; the index is rebuilt if they don't match.
+
+The arrays are memory-mapped and the data file is read through `mmap`, so
+only the requested rows are ever parsed.
+"""
+import json
+import logging
+import mmap
+import os
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from alchemy.shared.utils import generate_md5_hash, json_lookup
+
+INDEX_VERSION = 1
+
+# The key of the entity name in each row.
+ENTITY_KEY = "meta.domain"
+
+_OFFSETS_FNAME = "offsets.npy"
+_ENTITY_HASHES_FNAME = "entity_hashes.npy"
+_ENTITY_LINES_FNAME = "entity_lines.npy"
+_META_FNAME = "meta.json"
+
+
+def index_dir(fname: str) -> str:
+    """Where the index of the data file `fname` is stored."""
+    dirname, basename = os.path.split(os.path.abspath(fname))
+    return os.path.join(dirname, f".{basename}.index")
+
+
+def hash_entity(entity) -> int:
+    return int(generate_md5_hash(str(entity))[:16], 16)
+
+
+class RawDataIndex:
+    def __init__(
+        self,
+        fname: str,
+        offsets: np.ndarray,
+        entity_hashes: np.ndarray,
+        entity_lines: np.ndarray,
+    ):
+        """
+        Inputs:
+            fname: Path to the data file.
+            offsets: Byte offset of each line, followed by the file size.
+            entity_hashes: Sorted hashes of the entity of each line.
+            entity_lines: The line number for each entry of entity_hashes.
+        """
+        self.fname = fname
+        self.offsets = offsets
+        self.entity_hashes = entity_hashes
+        self.entity_lines = entity_lines
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @staticmethod
+    def build(fname: str) -> "RawDataIndex":
+        """Scan the data file once and save its index next to it."""
+        # Stat before reading, so the index looks stale if the file changes
+        # while we're reading it.
+        stat = os.stat(fname)
+
+        offsets = [0]
+        hashes = []
+        lines = []
+        with open(fname, "rb") as f:
+            for line_number, line in enumerate(f):
+                offsets.append(offsets[-1] + len(line))
+                entity = _get_entity(json.loads(line))
+                if entity:
+                    hashes.append(hash_entity(entity))
+                    lines.append(line_number)
+
+        hashes = np.array(hashes, dtype=np.uint64)
+        lines = np.array(lines, dtype=np.int64)
+        order = np.argsort(hashes, kind="stable")
+
+        index = RawDataIndex(
+            fname,
+            offsets=np.array(offsets, dtype=np.int64),
+            entity_hashes=hashes[order],
+            entity_lines=lines[order],
+        )
+
+        try:
+            index.save(stat)
+        except OSError as e:
+            # We can still use the index, it just won't be cached.
+            logging.error(f"Could not save the index of {fname}: {e}")
+
+        return index
+
+    def save(self, stat: os.stat_result):
+        """
+        Inputs:
+            stat: The os.stat of the data file at the time it was indexed.
+        """
+        d = index_dir(self.fname)
+        os.makedirs(d, exist_ok=True)
+
+        # meta.json is written last, so a partially written index is never
+        # considered valid.
+        meta_fname = os.path.join(d, _META_FNAME)
+        if os.path.exists(meta_fname):
+            os.remove(meta_fname)
+
+        for name, arr in [
+            (_OFFSETS_FNAME, self.offsets),
+            (_ENTITY_HASHES_FNAME, self.entity_hashes),
+            (_ENTITY_LINES_FNAME, self.entity_lines),
+        ]:
+            tmp_fname = os.path.join(d, f"tmp.{os.getpid()}.{name}")
+            np.save(tmp_fname, arr)
+            os.replace(tmp_fname, os.path.join(d, name))
+
+        tmp_fname = os.path.join(d, f"tmp.{os.getpid()}.{_META_FNAME}")
+        with open(tmp_fname, "w") as f:
+            json.dump(
+                {
+                    "version": INDEX_VERSION,
+                    "size": stat.st_size,
+                    "mtime_ns": stat.st_mtime_ns,
+                },
+                f,
+            )
+        os.replace(tmp_fname, meta_fname)
+
+    @staticmethod
+    def load(fname: str) -> Optional["RawDataIndex"]:
+        """Load the index of a data file, or None if it's missing or stale."""
+        d = index_dir(fname)
+        try:
+            with open(os.path.join(d, _META_FNAME)) as f:
+                meta = json.load(f)
+            stat = os.stat(fname)
+        except (OSError, ValueError):
+            return None
+
+        if (
+            meta.get("version") != INDEX_VERSION
+            or meta.get("size") != stat.st_size
+            or meta.get("mtime_ns") != stat.st_mtime_ns
+        ):
+            return None
+
+        try:
+            return RawDataIndex(
+                fname,
+                offsets=np.load(os.path.join(d, _OFFSETS_FNAME), mmap_mode="r"),
+                entity_hashes=np.load(
+                    os.path.join(d, _ENTITY_HASHES_FNAME), mmap_mode="r"
+                ),
+                entity_lines=np.load(
+                    os.path.join(d, _ENTITY_LINES_FNAME), mmap_mode="r"
+                ),
+            )
+        except (OSError, ValueError):
+            return None
+
+    def read_lines(self, line_numbers: Iterable[int]) -> Dict[int, Dict]:
+        """Read the given (0-indexed) lines. Line numbers past the end of the
+        file are ignored."""
+        line_numbers = sorted(set(x for x in line_numbers if 0 <= x < len(self)))
+        if not line_numbers:
+            return {}
+
+        res = {}
+        with open(self.fname, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for line_number in line_numbers:
+                    start = self.offsets[line_number]
+                    end = self.offsets[line_number + 1]
+                    res[line_number] = json.loads(mm[start:end])
+        return res
+
+    def get_lines_for_entity(self, entity) -> List[int]:
+        """Line numbers of the rows about this entity, in file order."""
+        h = np.uint64(hash_entity(entity))
+        lo = np.searchsorted(self.entity_hashes, h, side="left")
+        hi = np.searchsorted(self.entity_hashes, h, side="right")
+        return sorted(int(x) for x in self.entity_lines[lo:hi])
+
+    def get_row_for_entity(self, entity) -> Optional[Dict]:
+        """The last row about this entity, or None if there isn't one."""
+        if not entity:
+            return None
+        rows = self.read_lines(self.get_lines_for_entity(entity))
+        # Different entities could have the same hash.
+        for line_number in sorted(rows, reverse=True):
+            if _get_entity(rows[line_number]) == entity:
+                return rows[line_number]
+        return None
+
+
+def get_raw_data_index(fname: str) -> RawDataIndex:
+    """Load the index of a data file, building it if needed."""
+    index = RawDataIndex.load(fname)
+    if index is None:
+        logging.info(f"Building index for {fname}")
+        index = RawDataIndex.build(fname)
+    return index
+
+
+def _get_entity(row: Dict):
+    return json_lookup(row, ENTITY_KEY)
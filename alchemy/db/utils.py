@@ -5,6 +5,9 @@ from alchemy.db.fs import raw_data_dir
 
 
 def is_data_file(fname):
+    if not os.path.isfile(fname):
+        # e.g. the hidden index directories next to the data files.
+        return False
     with open(fname) as f:
         try:
             data = json.loads(f.readline())
@@ -14,6 +17,8 @@ def is_data_file(fname):
 
 
 def is_pattern_file(fname):
+    if not os.path.isfile(fname):
+        return False
     with open(fname) as f:
         try:
             data = json.loads(f.readline())
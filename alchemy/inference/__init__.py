@@ -1,51 +1,63 @@
-import os
-from pathlib import Path
 from typing import Dict, List
 
 from alchemy.inference.base import ITextCatModel
-from alchemy.shared.config import Config
-from alchemy.shared.utils import load_jsonl, mkf, save_jsonl
+from alchemy.inference.cache import (
+    load_cached_scores,
+    save_cached_scores,
+    start_data_file,
+)
+from alchemy.shared.utils import load_jsonl
+from alchemy.train.no_deps.raw_data_columns import TEXT, load_raw_data_columns
 
 
 def _predict(data_fname, model) -> List[Dict]:
-    df = load_jsonl(data_fname)
-    results = model.predict(df["text"])
+    raw_columns = load_raw_data_columns(data_fname)
+    if raw_columns is None:
+        df = load_jsonl(data_fname)
+        results = model.predict(df["text"])
+        # Attaching the meta data for an entity (e.g., name and domain)
+        for i, res in enumerate(results):
+            res.update({"meta": df["meta"][i]})
+        return results
+
+    results = model.predict(raw_columns.get(TEXT))
     # Attaching the meta data for an entity (e.g., name and domain)
-    for i, res in enumerate(results):
-        res.update({"meta": df["meta"][i]})
+    for res, meta in zip(results, raw_columns.get_meta()):
+        res.update({"meta": meta})
     return results
 
 
-def get_predicted(data_fname, model: ITextCatModel, cache=True):
+def _load_meta(data_fname) -> List[Dict]:
+    raw_columns = load_raw_data_columns(data_fname)
+    if raw_columns is None:
+        return list(load_jsonl(data_fname)["meta"])
+    return raw_columns.get_meta()
 
-    # TODO cache key is not unique, and we need a way to expire the cache.
-    #  Also, it's unclear if caching helps, unless we move to a real-time
-    #  active learning strategy.
-    #  For now, we'll turn off cache.
 
-    # TODO since we always turn off the cache, we can safely assume we run
-    #  the prediction on every call, which means we can change the format of
-    #  the result without worrying breaking the code of loading cached result.
+def get_predicted(data_fname, model: ITextCatModel, cache=True):
+    """Run the model on every row of data_fname.
 
-    cache = False
+    If cache is True, the scores are read from (and saved to) the inference
+    cache, see `alchemy.inference.cache`.
 
+    Returns a list of dicts with the keys 'score' and 'meta'. Other keys
+    returned by the model's predict (e.g. 'prob') are only present when the
+    scores were not read from the cache.
+    """
     print(f"get_predicted model={model} data_fname={data_fname} (cache={cache})")
 
-    if not cache:
-        return _predict(data_fname, model)
-    else:
-        # Get cache filename
-        stem = Path(data_fname).stem
-        fname = f"{stem}__inferred_by__{model}.jsonl"
-        path = [Config.get_inference_cache_dir(), fname]
-        fname = os.path.join(*path)
-
-        if not os.path.isfile(fname):
-            res = _predict(data_fname, model)
-
-            # Save results to cache
-            mkf(*path)
-            save_jsonl(fname, res)
-
-        print(f"Reading from cache: {fname}")
-        return load_jsonl(fname, to_df=False)
+    start_data_file(model)
+    if cache:
+        scores = load_cached_scores(data_fname, model)
+        if scores is not None:
+            print("Reading scores from cache")
+            metas = _load_meta(data_fname)
+            return [
+                {"score": float(score), "meta": meta}
+                for score, meta in zip(scores, metas)
+            ]
+
+    res = _predict(data_fname, model)
+    if cache:
+        save_cached_scores(data_fname, model, [x["score"] for x in res])
+    return res
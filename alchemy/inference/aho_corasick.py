@@ -0,0 +1,132 @@
+"""
+A pattern matcher that doesn't need spaCy: texts are split into tokens with a
+regex, and the phrases are matched against the tokens with an Aho-Corasick
+automaton, in a single pass over each text no matter how many phrases there
+are.
+
+`AhoCorasickMatcher` and `RegexDoc` mimic the parts of spaCy's PhraseMatcher
+and Doc that PatternModel uses, so they can be used in their place.
+"""
+import re
+from collections import namedtuple
+from typing import Dict, List, Sequence, Tuple
+
+# Runs of letters, digits and underscores, or any other single non-space
+# character, which is close enough to spaCy's tokenizer for plain phrases.
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+Span = namedtuple("Span", ["text", "start_char", "end_char"])
+
+
+def regex_tokenize(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text)
+
+
+class RegexDoc:
+    """The tokens of a text, split with `regex_tokenize`."""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.tokens = _TOKEN_RE.findall(text)
+        # Character offsets of the tokens, only computed if needed.
+        self._offsets = None
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __iter__(self):
+        return iter(self.tokens)
+
+    def __getitem__(self, key):
+        """Only supports slices, e.g. doc[start:end].text"""
+        start, stop, _ = key.indices(len(self))
+        if start >= stop:
+            return Span("", 0, 0)
+        if self._offsets is None:
+            self._offsets = [m.span() for m in _TOKEN_RE.finditer(self.text)]
+        start_char = self._offsets[start][0]
+        end_char = self._offsets[stop - 1][1]
+        return Span(self.text[start_char:end_char], start_char, end_char)
+
+
+class AhoCorasickMatcher:
+    def __init__(self, phrases: Sequence[Tuple[str, Sequence[str]]]):
+        """
+        Inputs:
+            phrases: The label and tokens of each phrase to match.
+        """
+        self.labels: List[str] = []
+        label_ids: Dict[str, int] = {}
+
+        # The trie: transitions out of each node, and the phrases that end at
+        # each node, as (label id, number of tokens).
+        self._goto: List[Dict[str, int]] = [{}]
+        self._outputs: List[set] = [set()]
+
+        for label, tokens in phrases:
+            if not tokens:
+                continue
+            if label not in label_ids:
+                label_ids[label] = len(self.labels)
+                self.labels.append(label)
+
+            node = 0
+            for token in tokens:
+                next_node = self._goto[node].get(token)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][token] = next_node
+                    self._goto.append({})
+                    self._outputs.append(set())
+                node = next_node
+            self._outputs[node].add((label_ids[label], len(tokens)))
+
+        self._build_failure_links()
+
+    def _build_failure_links(self):
+        # Breadth first, so the failure link of a node's parent is always
+        # computed before the node's.
+        self._fail = [0] * len(self._goto)
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for token, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and token not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(token, 0)
+                # The phrases that end at the longest proper suffix of this
+                # node also end here.
+                self._outputs[child] |= self._outputs[self._fail[child]]
+
+        # Outputs are immutable from now on.
+        self._outputs = [tuple(sorted(x)) for x in self._outputs]
+        # Every match starts with one of these.
+        self._first_tokens = frozenset(self._goto[0])
+
+    def __call__(self, doc) -> List[Tuple[int, int, int]]:
+        """Find all the occurrences of the phrases in the tokens of `doc`.
+
+        Returns a list of (label id, start, end) like spaCy's matchers, where
+        start and end are token indices and `self.labels[label id]` is the
+        label.
+        """
+        tokens = doc.tokens if isinstance(doc, RegexDoc) else list(doc)
+        # Most texts don't match anything, so first check (quickly) whether
+        # they could.
+        if self._first_tokens.isdisjoint(tokens):
+            return []
+
+        goto = self._goto
+        fail = self._fail
+        outputs = self._outputs
+
+        res = []
+        node = 0
+        for i, token in enumerate(tokens):
+            while node and token not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(token, 0)
+            for label_id, length in outputs[node]:
+                res.append((label_id, i + 1 - length, i + 1))
+        return res
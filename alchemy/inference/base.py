@@ -17,3 +17,27 @@ class ITextCatModel(abc.ABC):
         Higher scores are more likely to be selected for annotation.
         """
         pass
+
+    def cache_key(self):
+        """
+        A string that identifies the scores this model gives, used to cache
+        predictions. Two models with the same key must give the same scores
+        to the same texts.
+
+        Returns None if the predictions should not be cached.
+        """
+        return None
+
+    def start_data_file(self):
+        """
+        Called before the model scores the rows of another data file, e.g. to
+        reset the state its `cache_key` depends on.
+        """
+        pass
+
+    def needs_text(self):
+        """
+        Whether the scores depend on the texts. If not, `predict` is given a
+        list of None, one per text, so we can skip reading the texts.
+        """
+        return True
@@ -0,0 +1,128 @@
+"""
+Cache the scores a model gives to every row of a raw data file, so repeated
+runs on the same data don't have to score it again.
+
+Scores are stored as .npy arrays under `Config.get_inference_cache_dir()`,
+keyed by a hash of the data file's content and the model's `cache_key()`.
+Models without a cache key (e.g. the RandomModel) are never cached.
+
+The cache is bounded by ANNOTATION_TOOL_INFERENCE_CACHE_MAX_MB; the least
+recently used entries are evicted first.
+"""
+import hashlib
+import logging
+import os
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+from envparse import env
+
+from alchemy.inference.base import ITextCatModel
+from alchemy.shared.config import Config
+
+_SUFFIX = ".scores.npy"
+
+# (path, size, mtime) -> content hash, so we only hash each file once.
+_file_hashes: Dict[Tuple[str, int, int], str] = {}
+
+
+def get_file_hash(fname: str) -> str:
+    """A hash of the content of a file."""
+    stat = os.stat(fname)
+    key = (os.path.abspath(fname), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        h = hashlib.md5()
+        with open(fname, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        _file_hashes[key] = h.hexdigest()
+    return _file_hashes[key]
+
+
+def clear_file_hashes():
+    _file_hashes.clear()
+
+
+def get_cache_key(model: ITextCatModel) -> Optional[str]:
+    """The model's cache key, or None if it can't be cached."""
+    # Models don't have to inherit from ITextCatModel, as long as they
+    # implement predict.
+    cache_key = getattr(model, "cache_key", None)
+    return cache_key() if cache_key is not None else None
+
+
+def start_data_file(model: ITextCatModel):
+    """Let the model know it's about to score another data file, before its
+    cached scores are looked up."""
+    start = getattr(model, "start_data_file", None)
+    if start is not None:
+        start()
+
+
+def _get_cache_fname(data_fname: str, model: ITextCatModel) -> Optional[str]:
+    model_key = get_cache_key(model)
+    if model_key is None:
+        return None
+    model_hash = hashlib.md5(model_key.encode()).hexdigest()
+    fname = f"{get_file_hash(data_fname)}__{model_hash}{_SUFFIX}"
+    return os.path.join(Config.get_inference_cache_dir(), fname)
+
+
+def load_cached_scores(data_fname: str, model: ITextCatModel) -> Optional[np.ndarray]:
+    """The scores of `model` on each line of `data_fname`, or None if they
+    haven't been cached."""
+    fname = _get_cache_fname(data_fname, model)
+    if fname is None or not os.path.isfile(fname):
+        return None
+
+    try:
+        scores = np.load(fname, mmap_mode="r")
+    except (OSError, ValueError) as e:
+        logging.error(f"Could not load cached scores {fname}: {e}")
+        return None
+
+    # Mark as recently used.
+    os.utime(fname)
+    return scores
+
+
+def save_cached_scores(data_fname: str, model: ITextCatModel, scores: Sequence[float]):
+    """Cache the scores of `model` on each line of `data_fname`. Does nothing
+    if the model can't be cached."""
+    fname = _get_cache_fname(data_fname, model)
+    if fname is None:
+        return
+
+    cache_dir = os.path.dirname(fname)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_fname = os.path.join(cache_dir, f"tmp.{os.getpid()}{_SUFFIX}")
+    np.save(tmp_fname, np.asarray(scores, dtype=np.float64))
+    os.replace(tmp_fname, fname)
+
+    max_bytes = env.int("ANNOTATION_TOOL_INFERENCE_CACHE_MAX_MB", default=1024) << 20
+    evict(cache_dir, max_bytes)
+
+
+def evict(cache_dir: str, max_bytes: int):
+    """Delete the least recently used scores until the cache fits in
+    `max_bytes`."""
+    entries = []
+    for f in os.listdir(cache_dir):
+        if f.endswith(_SUFFIX) and not f.startswith("tmp."):
+            path = os.path.join(cache_dir, f)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        logging.info(f"Evicting cached scores {path}")
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
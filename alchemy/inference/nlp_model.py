@@ -1,14 +1,20 @@
-import hashlib
+import functools
+import logging
+import os
+from typing import List, Optional
 
 import numpy as np
+from envparse import env
 
 from alchemy.db.model import Model
 from alchemy.inference import ITextCatModel
-
-
-def _hash_text(text):
-    text = text or ""
-    return hashlib.md5(text.strip().encode()).hexdigest()
+from alchemy.inference.prob_index import (
+    add_probs,
+    get_inference_fingerprint,
+    get_prob_index,
+)
+from alchemy.train.no_deps.paths import _get_model_output_dir
+from alchemy.train.no_deps.raw_data_columns import hash_text
 
 
 def _get_uncertainty(pred, eps=1e-6):
@@ -17,56 +23,161 @@ def _get_uncertainty(pred, eps=1e-6):
     return float(-np.sum(pred * np.log(pred + eps)))
 
 
+@functools.lru_cache(maxsize=1)
+def _load_local_model(version_dir):
+    # Only import the heavy dependencies (torch, transformers) when needed.
+    from alchemy.train.no_deps.run import load_model
+
+    return load_model(version_dir)
+
+
+def clear_loaded_model():
+    """Unload the model used for local inference, e.g. to free memory in a
+    long-lived worker."""
+    _load_local_model.cache_clear()
+
+
+def _infer(version_dir: str, text_list: List[str]) -> np.ndarray:
+    """Run the model in version_dir on text_list, on this machine."""
+    from alchemy.train.no_deps.utils import raw_to_pos_prob
+
+    _, raw = _load_local_model(version_dir).predict(text_list)
+    return np.array(raw_to_pos_prob(raw), dtype=np.float32)
+
+
+class InferenceBudget:
+    """How many more texts without inference results we can run inference on,
+    e.g. during a job. Share one between the NLPModels of the same model, so
+    each text is only counted once."""
+
+    def __init__(self, remaining: Optional[int] = None):
+        if remaining is None:
+            remaining = env.int(
+                "ANNOTATION_TOOL_NLP_MODEL_INFERENCE_BUDGET", default=1000
+            )
+        self.remaining = remaining
+
+    def take(self, n: int) -> int:
+        """Spend up to `n` texts of the budget, returns how many we got."""
+        n = max(0, min(n, self.remaining))
+        self.remaining -= n
+        return n
+
+    def exhaust(self):
+        self.remaining = 0
+
+
 class NLPModel(ITextCatModel):
-    def __init__(self, dbsession, model_id):
+    def __init__(self, dbsession, model_id, budget: Optional[InferenceBudget] = None):
         self.dbsession = dbsession
         self.model_id = model_id
+        self._model = None
         self._cache = None
+        if budget is None:
+            budget = InferenceBudget()
+        self._inference_budget = budget
+        # True once we've given a text of the current data file a default
+        # score because it had no inference results.
+        self._incomplete = False
 
     def __str__(self):
-        # Note: This is also used as a cache key.
         return f"{self.__class__.__name__}-model_id={self.model_id}"
 
+    def start_data_file(self):
+        self._incomplete = False
+
+    def cache_key(self):
+        if self._incomplete:
+            # Texts without results will get real scores once they're inferred.
+            return None
+
+        model = self.dbsession.query(Model).filter_by(id=self.model_id).one_or_none()
+        if model is None:
+            return None
+
+        # The predictions change when more inference results are added.
+        fingerprint = get_inference_fingerprint(model.dir(abs=True))
+        return f"{self.__class__.__name__}:{model.uuid}:{model.version}:{fingerprint}"
+
     def _warm_up_cache(self):
         if self._cache is None:
             print("Warming up NLPModel cache...")
 
-            self._cache = {}
-
-            model = (
+            self._model = (
                 self.dbsession.query(Model).filter_by(id=self.model_id).one_or_none()
             )
 
-            for fname in model.get_inference_fnames():
-                df = model.export_inference(fname, include_text=True)
-                df["hashed_text"] = df["text"].apply(_hash_text)
-                self._cache.update(dict(zip(df["hashed_text"], df["probs"])))
+            # The index is shared with the other NLPModels of the same model.
+            self._cache = get_prob_index(self._model)
 
         return self._cache
 
     def predict(self, text_list):
         self._warm_up_cache()
 
+        text_hashes = np.array([hash_text(text) for text in text_list], dtype=np.uint64)
+        probs, found = self._cache.lookup(text_hashes)
+        if not np.all(found):
+            probs, found = self._infer_missing(text_list, text_hashes)
+
+        probs = probs.astype(np.float64)
+        scores = self._score_fn(probs)
+
         res = []
-        for text in text_list:
-            prob = self._cache.get(_hash_text(text))
-            if prob is None:
-                # TODO run any inferences that have not been ran, instead of silently erroring out
+        for prob, score, is_found in zip(probs.tolist(), scores.tolist(), found):
+            if not is_found:
+                self._incomplete = True
                 res.append({"score": 0.0, "prob": None})
             else:
-                res.append({"score": self._score_fn(prob), "prob": prob})
+                res.append({"score": score, "prob": prob})
 
         return res
 
-    def _score_fn(self, prob):
-        return _get_uncertainty(prob)
+    def _infer_missing(self, text_list, text_hashes):
+        """Run inference on the texts that don't have results yet, up to the
+        inference budget, and add the results to the index."""
+        # Another NLPModel may have inferred some of them already.
+        self._cache = get_prob_index(self._model)
+        probs, found = self._cache.lookup(text_hashes)
+        if self._inference_budget.remaining <= 0:
+            return probs, found
+
+        version_dir = self._model.dir(abs=True)
+        if not os.path.isdir(_get_model_output_dir(version_dir)):
+            logging.info(f"{self}: Model assets not found, can't run inference")
+            self._inference_budget.exhaust()
+            return probs, found
+
+        # Infer each distinct text once, in the order they appear.
+        missing = np.flatnonzero(~found)
+        _, first = np.unique(text_hashes[missing], return_index=True)
+        idx = missing[np.sort(first)]
+        idx = idx[: self._inference_budget.take(len(idx))]
+        if len(idx) == 0:
+            return probs, found
+
+        logging.info(f"{self}: Running inference on {len(idx)} new texts")
+        try:
+            new_probs = _infer(version_dir, [text_list[i] for i in idx])
+        except Exception:
+            logging.exception(f"{self}: Inference failed")
+            # Don't try again, it's likely to fail the same way.
+            self._inference_budget.exhaust()
+            return probs, found
+
+        self._cache = add_probs(self._model, text_hashes[idx], new_probs)
+        return self._cache.lookup(text_hashes)
+
+    def _score_fn(self, probs: np.ndarray) -> np.ndarray:
+        # Same as _get_uncertainty on each prob.
+        return -probs * np.log(probs + 1e-6)
 
 
 class NLPModelTopResults(NLPModel):
-    def _score_fn(self, prob):
-        return prob
+    def _score_fn(self, probs):
+        return probs
 
 
 class NLPModelBottomResults(NLPModel):
-    def _score_fn(self, prob):
-        return -prob
+    def _score_fn(self, probs):
+        return -probs
@@ -0,0 +1,206 @@
+"""
+Process-wide registry of spaCy pipelines and compiled pattern matchers, so
+PatternModels with the same patterns don't load spaCy and compile the same
+matcher over and over.
+
+Compiled matchers are also persisted as the tokens of each phrase, under
+`Config.get_inference_cache_dir()`, so a fresh process only has to load
+spaCy and not tokenize every pattern again.
+
+spaCy is only imported when it's used, so the aho_corasick backend works
+without it.
+"""
+import functools
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from envparse import env
+
+from alchemy.inference.aho_corasick import AhoCorasickMatcher, regex_tokenize
+from alchemy.shared.config import Config
+
+SPACY_MODEL = "en_core_web_sm"
+
+# How to match patterns, see get_backend.
+SPACY = "spacy"
+AHO_CORASICK = "aho_corasick"
+BACKENDS = [SPACY, AHO_CORASICK]
+
+# How many compiled matchers to keep in memory at a time.
+_MAX_LOADED_MATCHERS = 64
+
+_lock = threading.Lock()
+# (spaCy model name or backend, patterns hash) -> matcher, least recently
+# used first.
+_matchers: "OrderedDict[Tuple[str, str], Any]" = OrderedDict()
+
+
+def get_nlp(name: Optional[str] = None):
+    """Load the tokenizer of a spaCy model once per process.
+
+    Inputs:
+        name: The spaCy model, defaults to ANNOTATION_TOOL_PATTERN_MODEL_SPACY_MODEL.
+            Use "blank:<lang>", e.g. "blank:en", for a blank pipeline of a
+            language, which doesn't have to load a trained model.
+    """
+    return _load_nlp(get_spacy_model_name(name))
+
+
+@functools.lru_cache(maxsize=None)
+def _load_nlp(name: str):
+    import spacy
+
+    logging.info(f"Loading spaCy model {name}")
+    if name.startswith("blank:"):
+        return spacy.blank(name[len("blank:") :])
+    # Matching phrases only needs the tokenizer, so don't load the rest.
+    return spacy.load(name, disable=["tagger", "parser", "ner"])
+
+
+def get_spacy_model_name(name: Optional[str] = None) -> str:
+    """The given spaCy model name, or the default one if it's None."""
+    if name is None:
+        name = env("ANNOTATION_TOOL_PATTERN_MODEL_SPACY_MODEL", default=SPACY_MODEL)
+    return name
+
+
+def get_backend() -> str:
+    """The pattern matcher backend to use, from
+    ANNOTATION_TOOL_PATTERN_MATCHER_BACKEND:
+
+        spacy           Tokenize with spaCy and match with its PhraseMatcher.
+        aho_corasick    Tokenize with a regex and match with an Aho-Corasick
+                        automaton, see alchemy.inference.aho_corasick. This
+                        doesn't need to load spaCy at all, but the tokens can
+                        differ slightly from spaCy's.
+    """
+    backend = env("ANNOTATION_TOOL_PATTERN_MATCHER_BACKEND", default=SPACY)
+    if backend not in BACKENDS:
+        raise Exception(f"Unknown pattern matcher backend: {backend}")
+    return backend
+
+
+def hash_patterns(spacy_patterns: List[Dict]) -> str:
+    patterns = json.dumps(spacy_patterns, sort_keys=True)
+    return hashlib.md5(patterns.encode()).hexdigest()
+
+
+def get_phrase_matcher(spacy_patterns: List[Dict], name: Optional[str] = None):
+    """A PhraseMatcher for the patterns, over the vocab of `get_nlp(name)`.
+
+    Inputs:
+        spacy_patterns: See PatternModel. Only patterns of the form
+            [{"lower": "my phrase"}] are supported.
+        name: The spaCy model the matcher will be used with, see get_nlp.
+    """
+    from spacy.matcher import PhraseMatcher
+    from spacy.tokens import Doc
+
+    name = get_spacy_model_name(name)
+    key = (name, hash_patterns(spacy_patterns))
+    with _lock:
+        matcher = _matchers.get(key)
+        if matcher is not None:
+            _matchers.move_to_end(key)
+            return matcher
+
+    nlp = get_nlp(name)
+    fname = os.path.join(_cache_dir(name), f"{key[1]}.json")
+
+    phrases = _load_phrases(fname)
+    if phrases is None:
+        phrases = _tokenize_patterns(
+            lambda text: [token.text for token in nlp.make_doc(text)], spacy_patterns
+        )
+        try:
+            _save_phrases(fname, phrases)
+        except OSError as e:
+            # We can still use the matcher, it just won't be cached.
+            logging.error(f"Could not save the pattern matcher {fname}: {e}")
+
+    matcher = PhraseMatcher(nlp.vocab)
+    for label, words in phrases:
+        matcher.add(label, None, Doc(nlp.vocab, words=words))
+
+    _set_matcher(key, matcher)
+    return matcher
+
+
+def get_aho_corasick_matcher(spacy_patterns: List[Dict]) -> AhoCorasickMatcher:
+    """An AhoCorasickMatcher for the patterns, to match against RegexDocs.
+
+    Inputs:
+        spacy_patterns: See get_phrase_matcher.
+    """
+    key = (AHO_CORASICK, hash_patterns(spacy_patterns))
+    with _lock:
+        matcher = _matchers.get(key)
+        if matcher is not None:
+            _matchers.move_to_end(key)
+            return matcher
+
+    # Compiling the automaton is fast enough that it's not worth persisting.
+    matcher = AhoCorasickMatcher(_tokenize_patterns(regex_tokenize, spacy_patterns))
+    _set_matcher(key, matcher)
+    return matcher
+
+
+def clear_matchers():
+    """Unload the compiled matchers, e.g. to free memory in a long-lived
+    worker. They are loaded again from their persisted phrases as needed."""
+    with _lock:
+        _matchers.clear()
+
+
+def _set_matcher(key: Tuple[str, str], matcher):
+    with _lock:
+        _matchers[key] = matcher
+        while len(_matchers) > _MAX_LOADED_MATCHERS:
+            _matchers.popitem(last=False)
+
+
+def _tokenize_patterns(
+    tokenize: Callable[[str], List[str]], spacy_patterns: List[Dict]
+) -> List[Tuple[str, List[str]]]:
+    """The label and tokens of each phrase."""
+    res = []
+    for row in spacy_patterns:
+        # TODO temporary fix:
+        # Assuming it's of the form "pattern": [{"lower": "my phrase"}]
+        if len(row["pattern"]) == 1 and "lower" in row["pattern"][0]:
+            res.append((row["label"], tokenize(row["pattern"][0]["lower"].lower())))
+        else:
+            raise Exception(f"Cannot load pattern: {row['pattern']}")
+    return res
+
+
+def _cache_dir(name: str) -> str:
+    import spacy
+
+    # Tokenization can change between spaCy versions.
+    return os.path.join(
+        Config.get_inference_cache_dir(),
+        "pattern_matchers",
+        f"{name}-{spacy.about.__version__}",
+    )
+
+
+def _load_phrases(fname: str) -> Optional[List[Tuple[str, List[str]]]]:
+    try:
+        with open(fname) as f:
+            return [(label, words) for label, words in json.load(f)]
+    except (OSError, ValueError):
+        return None
+
+
+def _save_phrases(fname: str, phrases: List[Tuple[str, List[str]]]):
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmp_fname = f"{fname}.tmp.{os.getpid()}"
+    with open(tmp_fname, "w") as f:
+        json.dump(phrases, f)
+    os.replace(tmp_fname, fname)
@@ -1,79 +1,137 @@
-from functools import cmp_to_key
-from typing import List
+import functools
+import itertools
+import multiprocessing
+from typing import Dict, List, Optional, Tuple
 
-import spacy
-
-# from spacy.matcher import Matcher
-from spacy.matcher import PhraseMatcher
+import numpy as np
+from envparse import env
 
+from .aho_corasick import RegexDoc
 from .base import ITextCatModel
+from .pattern_matchers import (
+    AHO_CORASICK,
+    get_aho_corasick_matcher,
+    get_backend,
+    get_nlp,
+    get_phrase_matcher,
+    get_spacy_model_name,
+    hash_patterns,
+)
 
 
-def _compare_matches(item1, item2):
-    """Compare two matches from the Pattern Matcher by match length.
+def _maximize_non_overlapping_matches(matches):
+    """Select non-overlapping matches of a single document, see
+    _select_non_overlapping_matches.
 
-    :param item1: first matched item
-    :param item2: second matched item
-    :return: comparison result where -1 means item1 < item2, 1 means item1 >
-    item2 and 0 means item1 == item2
+    :param matches: (match id, start, end) of each match
+    :return: the set of selected matches
     """
-    if item1[1] < item2[1]:
-        return -1
-    elif item1[1] > item2[1]:
-        return 1
-    else:
-        return _compare_match_length(item1, item2)
+    if len(matches) == 0:
+        return {}
+    starts = [m[1] for m in matches]
+    ends = [m[2] for m in matches]
+    selected = _select_non_overlapping_matches(np.zeros(len(matches)), starts, ends)
+    return set(matches[i] for i in selected)
 
 
-def _compare_match_length(item1, item2):
-    """Compare two matches from the Pattern Matcher by the last matching index.
+def _select_non_overlapping_matches(doc_ids, starts, ends) -> np.ndarray:
+    """Select non-overlapping matches, in each document independently.
 
-    :param item1: first matches item
-    :param item2: second matches item
-    :return: comparison result where -1 means item1 < item2, 1 means item1 >
-    item2 and 0 means item1 == item2
+    The matches of a document are visited in ascending order by their first
+    matching index and then by the length of the match. A match is kept
+    unless it overlaps the next one, in which case only the longer of the
+    two (or the later one, if they have the same length) stays in the
+    running.
+
+    :param doc_ids: the document of each match
+    :param starts: the first token of each match
+    :param ends: the end (exclusive) of each match
+    :return: the indices of the selected matches, sorted by document and
+    start
     """
-    if (item1[2] - item1[1]) < (item2[2] - item2[1]):
-        return -1
-    elif (item1[2] - item1[1]) > (item2[2] - item2[1]):
-        return 1
-    else:
-        return 0
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    n = len(doc_ids)
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
 
+    lengths = ends - starts
+    # lexsort is stable, so ties keep their order.
+    order = np.lexsort((lengths, starts, doc_ids))
+    doc_ids = doc_ids[order]
 
-def _maximize_non_overlapping_matches(matches):
-    # All matches are sorted in ascending order by their first matching index
-    # and then by the length of the match.
-    if len(matches) == 0:
-        return {}
-    matches.sort(key=cmp_to_key(_compare_matches))
-    len_of_matches = [m[2] - m[1] for m in matches]
-
-    selected_matches = set()
-    i = 0
-    j = i + 1
-    while i < len(matches) - 1 and j < len(matches):
-        match_left = matches[i]
-        match_right = matches[j]
-        if len_of_matches[i] <= len_of_matches[j]:
-            if match_left[2] <= match_right[1]:
-                # [1, 2) vs [3, 5) then we can safely add [1, 2)
-                # [1, 2) vs [2, 5) we can still safely add [1. 2)
-                selected_matches.add(match_left)
-            i = j
-        else:
-            if match_left[2] <= match_right[1]:
-                # [1, 2) vs [3, 5) then we can safely add [1, 2)
-                # [1, 2) vs [2, 5) we can still safely add [1. 2)
-                selected_matches.add(match_left)
+    first = np.ones(n, dtype=bool)
+    first[1:] = doc_ids[1:] != doc_ids[:-1]
+    last = np.ones(n, dtype=bool)
+    last[:-1] = first[1:]
+
+    # Documents whose matches don't overlap (most of them, e.g. the ones with
+    # a single match) keep all of them. The rest need a greedy pass, one
+    # match at a time.
+    starts = starts[order]
+    ends = ends[order]
+    overlaps_next = np.zeros(n, dtype=bool)
+    overlaps_next[:-1] = ~last[:-1] & (ends[:-1] > starts[1:])
+    group = np.cumsum(first) - 1
+    has_overlap = np.bincount(group, weights=overlaps_next) > 0
+
+    selected = ~has_overlap[group]
+    multi = np.flatnonzero(~selected)
+    if len(multi) > 0:
+        _starts = starts[multi].tolist()
+        _ends = ends[multi].tolist()
+        _lengths = lengths[order][multi].tolist()
+        _first = first[multi].tolist()
+        _last = last[multi].tolist()
+        keep = [False] * len(multi)
+
+        i = 0
+        for j in range(len(multi)):
+            if _first[j]:
+                i = j
+                continue
+            if _ends[i] <= _starts[j]:
+                # [1, 2) vs [3, 5) then we can safely keep [1, 2)
+                # [1, 2) vs [2, 5) we can still safely keep [1. 2)
+                keep[i] = True
                 i = j
-        j += 1
-    selected_matches.add(matches[i])
-    return selected_matches
+            elif _lengths[i] <= _lengths[j]:
+                i = j
+            if _last[j]:
+                keep[i] = True
+
+        selected[multi] = keep
+
+    return order[selected]
+
+
+def _score_matches(doc_ids, starts, ends, n_tokens) -> Tuple[np.ndarray, np.ndarray]:
+    """Score documents by the fraction of their tokens covered by the
+    selected matches, see _select_non_overlapping_matches.
+
+    :param doc_ids: the document of each match, an index into `n_tokens`
+    :param starts: the first token of each match
+    :param ends: the end (exclusive) of each match
+    :param n_tokens: the number of tokens of each document
+    :return: the score of each document, and the indices of the selected
+    matches
+    """
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    lengths = np.asarray(ends, dtype=np.int64) - np.asarray(starts, dtype=np.int64)
+    n_tokens = np.asarray(n_tokens, dtype=np.int64)
+
+    selected = _select_non_overlapping_matches(doc_ids, starts, ends)
+    coverage = np.bincount(
+        doc_ids[selected], weights=lengths[selected], minlength=len(n_tokens)
+    )
+    scores = np.zeros(len(n_tokens))
+    np.divide(coverage, n_tokens, out=scores, where=n_tokens > 0)
+    return scores, selected
 
 
 class PatternModel(ITextCatModel):
-    def __init__(self, spacy_patterns):
+    def __init__(self, spacy_patterns, spacy_model: Optional[str] = None):
         """
         Inputs:
             spacy_patterns: A list of json patterns Spacy understands.
@@ -81,72 +139,159 @@ class PatternModel(ITextCatModel):
                     {"label": "POSITIVE_CLASS", "pattern": [{"lower": "hello"}]},
                     {"label": "POSITIVE_CLASS", "pattern": [{"lower": "world"}]}
                 ]
+            spacy_model: The spaCy model whose tokenizer to use, see
+                pattern_matchers.get_nlp. Not used by the aho_corasick
+                backend.
         """
         self.spacy_patterns = spacy_patterns or []
+        self.spacy_model = spacy_model
         self._loaded = False
 
     def __str__(self):
-        # Note: This is also used as a cache key.
         return f"PatternModel <{len(self.spacy_patterns)} patterns>"
 
+    def cache_key(self):
+        # Different backends and tokenizers can give different scores.
+        backend = get_backend()
+        if backend != AHO_CORASICK:
+            backend = f"{backend}:{get_spacy_model_name(self.spacy_model)}"
+        return f"PatternModel:{backend}:{hash_patterns(self.spacy_patterns)}"
+
     def _load(self):
         if not self._loaded:
-            nlp = spacy.load("en_core_web_sm")
-            # matcher = Matcher(nlp.vocab)
-            matcher = PhraseMatcher(nlp.vocab)
-
-            for row in self.spacy_patterns:
-                # matcher.add(row['label'], None, row['pattern'])
-
-                # TODO temporary fix:
-                # Assuming it's of the form "pattern": [{"lower": "my phrase"}]
-                if len(row["pattern"]) == 1 and "lower" in row["pattern"][0]:
-                    matcher.add(
-                        row["label"], None, nlp(row["pattern"][0]["lower"].lower())
-                    )
-                else:
-                    raise Exception(f"Cannot load pattern: {row['pattern']}")
-
-            self.matcher = matcher
-            self.nlp = nlp
+            # Shared with the other PatternModels in this process.
+            self.backend = get_backend()
+            if self.backend == AHO_CORASICK:
+                self.nlp = None
+                self.matcher = get_aho_corasick_matcher(self.spacy_patterns)
+            else:
+                self.nlp = get_nlp(self.spacy_model)
+                self.matcher = get_phrase_matcher(self.spacy_patterns, self.spacy_model)
 
             self._loaded = True
 
-    def predict(self, text_list: List[str], fancy=False) -> List:
+    def predict(
+        self,
+        text_list: List[str],
+        fancy=False,
+        n_process: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        spans=False,
+    ) -> List:
         """Predict the match and score given the provided patterns.
 
         :param text_list: a list of text
         :param fancy: whether to return token and matched text in addition to a
         matching score
+        :param n_process: number of processes to spread the texts across,
+        defaults to ANNOTATION_TOOL_PATTERN_MODEL_N_PROCESS
+        :param batch_size: number of texts to tokenize at a time, defaults to
+        ANNOTATION_TOOL_PATTERN_MODEL_BATCH_SIZE
+        :param spans: whether to also return the matches as "spans", a list of
+        (start token, end token, start char, end char) sorted by start
         :return: the longest and last match
         """
-        self._load()
+        if n_process is None:
+            n_process = env.int("ANNOTATION_TOOL_PATTERN_MODEL_N_PROCESS", default=1)
+        batch_size = _get_batch_size(batch_size)
+
+        text_list = ["" if x is None else x for x in text_list]
+
+        if (
+            n_process > 1
+            and len(text_list) > batch_size
+            # Daemonic processes (e.g. multiprocessing workers) can't have
+            # children.
+            and not multiprocessing.current_process().daemon
+        ):
+            return self._predict_parallel(
+                text_list, fancy, n_process, batch_size, spans
+            )
 
+        docs = self._tokenize(text_list, batch_size)
         res = []
+        while True:
+            batch = list(itertools.islice(docs, batch_size))
+            if not batch:
+                return res
+            res += self._predict_docs(batch, fancy, spans)
 
-        text_list = ["" if x is None else x for x in text_list]
+    def _tokenize(self, text_list: List[str], batch_size: int):
+        self._load()
+        if self.backend == AHO_CORASICK:
+            return (RegexDoc(text) for text in text_list)
+        else:
+            # Matching phrases only needs the tokens, so we only run the
+            # tokenizer.
+            return self.nlp.tokenizer.pipe(text_list, batch_size=batch_size)
+
+    def _predict_parallel(self, text_list, fancy, n_process, batch_size, spans):
+        batches = [
+            text_list[i : i + batch_size] for i in range(0, len(text_list), batch_size)
+        ]
+        with multiprocessing.Pool(
+            n_process,
+            initializer=_init_worker,
+            initargs=(self.spacy_patterns, self.spacy_model),
+        ) as pool:
+            res = []
+            for batch_res in pool.imap(
+                functools.partial(_predict_in_worker, fancy=fancy, spans=spans),
+                batches,
+            ):
+                res += batch_res
+        return res
 
-        # TODO disable the right things for speed
-        for doc in self.nlp.pipe(text_list, disable=["tagger", "parser"]):
-            matches = self.matcher(doc)
-            selected_matches = _maximize_non_overlapping_matches(matches)
-            # m[2] and m[1] are start and end of matches
-            len_of_matches = [m[2] - m[1] for m in selected_matches]
-            score = sum(len_of_matches) / len(doc) if len(doc) > 0 else 0.0
+    def _predict_docs(self, docs, fancy, spans=False) -> List[Dict]:
+        doc_ids = []
+        matches = []
+        for i, doc in enumerate(docs):
+            doc_matches = self.matcher(doc)
+            doc_ids += [i] * len(doc_matches)
+            matches += doc_matches
+        starts = [m[1] for m in matches]
+        ends = [m[2] for m in matches]
 
-            if fancy:
-                _matches = []
-                for match_id, start, end in selected_matches:
-                    span = doc[start:end]
-                    _matches.append((start, end, span.text))
-                res.append(
-                    {
-                        "tokens": [str(x) for x in list(doc)],
-                        "matches": _matches,
-                        "score": score,
-                    }
-                )
-            else:
-                res.append({"score": score})
+        scores, selected = _score_matches(doc_ids, starts, ends, [len(d) for d in docs])
+        res = [{"score": score} for score in scores.tolist()]
+        if not fancy and not spans:
+            return res
 
+        # Selected matches are sorted by document then start.
+        selected_per_doc = [[] for _ in docs]
+        for idx in selected.tolist():
+            selected_per_doc[doc_ids[idx]].append((starts[idx], ends[idx]))
+
+        for doc, row, selected_matches in zip(docs, res, selected_per_doc):
+            doc_spans = [doc[start:end] for start, end in selected_matches]
+            if fancy:
+                row["tokens"] = [str(x) for x in list(doc)]
+                row["matches"] = [
+                    (start, end, span.text)
+                    for (start, end), span in zip(selected_matches, doc_spans)
+                ]
+            if spans:
+                row["spans"] = [
+                    (start, end, span.start_char, span.end_char)
+                    for (start, end), span in zip(selected_matches, doc_spans)
+                ]
         return res
+
+
+# The PatternModel of a worker process in PatternModel._predict_parallel.
+_worker_model: Optional[PatternModel] = None
+
+
+def _init_worker(spacy_patterns, spacy_model):
+    global _worker_model
+    _worker_model = PatternModel(spacy_patterns, spacy_model)
+
+
+def _predict_in_worker(text_list, fancy, spans):
+    return _worker_model.predict(text_list, fancy=fancy, n_process=1, spans=spans)
+
+
+def _get_batch_size(batch_size: Optional[int]) -> int:
+    if batch_size is None:
+        batch_size = env.int("ANNOTATION_TOOL_PATTERN_MODEL_BATCH_SIZE", default=1000)
+    return batch_size
@@ -0,0 +1,280 @@
+"""
+An index from text to the probability a model gave it, built from the
+model's inference results and shared by all the NLPModel variants.
+
+The index is stored in the model's inference directory:
+
+    prob_index.hashes.npy   Sorted 64 bit hashes of the texts, see
+                            `raw_data_columns.hash_text`.
+    prob_index.probs.npy    The (float32) probability for each hash.
+    prob_index.online.npz   Probabilities inferred outside of the inference
+                            jobs, for texts that had no inference yet, see
+                            `add_probs`.
+    prob_index.json         The state of the inference and raw data files
+                            the index was built from; the index is rebuilt
+                            when they change.
+
+Loaded indexes are also kept in memory, so they're only read once per
+process.
+"""
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from alchemy.db.model import Model, _raw_data_file_path
+from alchemy.shared.utils import stem
+from alchemy.train.no_deps.inference_results import InferenceResults
+from alchemy.train.no_deps.paths import (
+    _get_all_inference_fnames,
+    _get_inference_dir,
+    _get_inference_fname,
+)
+from alchemy.train.no_deps.raw_data_columns import hash_text, load_raw_data_columns
+
+_HASHES_FNAME = "prob_index.hashes.npy"
+_PROBS_FNAME = "prob_index.probs.npy"
+_META_FNAME = "prob_index.json"
+_ONLINE_FNAME = "prob_index.online.npz"
+
+# How many indexes to keep in memory at a time.
+_MAX_LOADED_INDEXES = 16
+
+_lock = threading.Lock()
+# version_dir -> (fingerprint, index), least recently used first.
+_loaded: "OrderedDict[str, Tuple[List, ProbIndex]]" = OrderedDict()
+
+
+def get_inference_fingerprint(version_dir: str) -> List:
+    """Size and mtime of every inference file of a model and the raw data
+    file it was run on. This changes whenever the inference results do."""
+    res = []
+    for fname in sorted(_get_all_inference_fnames(version_dir)):
+        data_fname = stem(fname) + ".jsonl"
+        row = [os.path.basename(fname)]
+        for path in [fname, _raw_data_file_path(data_fname)]:
+            try:
+                stat = os.stat(path)
+                row += [stat.st_size, stat.st_mtime_ns]
+            except OSError:
+                row += [None, None]
+        res.append(row)
+
+    online_fname = os.path.join(_get_inference_dir(version_dir), _ONLINE_FNAME)
+    if os.path.isfile(online_fname):
+        stat = os.stat(online_fname)
+        res.append([_ONLINE_FNAME, stat.st_size, stat.st_mtime_ns])
+
+    return res
+
+
+class ProbIndex:
+    def __init__(self, hashes: np.ndarray, probs: np.ndarray):
+        """
+        Inputs:
+            hashes: Sorted, unique text hashes.
+            probs: The probability of each hash.
+        """
+        self.hashes = hashes
+        self.probs = probs
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def lookup(self, text_hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns:
+            probs: The probability of each text, 0 if it's not in the index.
+            found: Whether each text is in the index.
+        """
+        text_hashes = np.asarray(text_hashes, dtype=np.uint64)
+        if len(self) == 0:
+            n = len(text_hashes)
+            return np.zeros(n, dtype=np.float32), np.zeros(n, dtype=bool)
+
+        idx = np.searchsorted(self.hashes, text_hashes)
+        idx = np.minimum(idx, len(self) - 1)
+        found = self.hashes[idx] == text_hashes
+        probs = np.where(found, self.probs[idx], 0).astype(np.float32)
+        return probs, found
+
+    @staticmethod
+    def build(model: Model) -> "ProbIndex":
+        # Results from the inference jobs come last, so they take precedence
+        # over the ones inferred online.
+        online = _load_online_probs(model.dir(abs=True))
+        all_hashes = [online[0]]
+        all_probs = [online[1]]
+        for fname in model.get_inference_fnames():
+            res = _load_hashes_and_probs(model, fname)
+            if res is not None:
+                all_hashes.append(res[0])
+                all_probs.append(res[1])
+
+        hashes, probs = _dedupe(np.concatenate(all_hashes), np.concatenate(all_probs))
+        return ProbIndex(hashes, probs)
+
+    def save(self, version_dir: str, fingerprint: List):
+        d = _get_inference_dir(version_dir)
+
+        # The meta file is written last, so a partially written index is
+        # never considered valid.
+        meta_fname = os.path.join(d, _META_FNAME)
+        if os.path.exists(meta_fname):
+            os.remove(meta_fname)
+
+        for name, arr in [(_HASHES_FNAME, self.hashes), (_PROBS_FNAME, self.probs)]:
+            tmp_fname = os.path.join(d, f"tmp.{os.getpid()}.{name}")
+            np.save(tmp_fname, arr)
+            os.replace(tmp_fname, os.path.join(d, name))
+
+        tmp_fname = os.path.join(d, f"tmp.{os.getpid()}.{_META_FNAME}")
+        with open(tmp_fname, "w") as f:
+            json.dump({"fingerprint": fingerprint}, f)
+        os.replace(tmp_fname, meta_fname)
+
+    @staticmethod
+    def load(version_dir: str, fingerprint: List) -> Optional["ProbIndex"]:
+        """Load the index, or None if it's missing or was built from
+        different inference results."""
+        d = _get_inference_dir(version_dir)
+        try:
+            with open(os.path.join(d, _META_FNAME)) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if meta.get("fingerprint") != fingerprint:
+            return None
+
+        try:
+            return ProbIndex(
+                hashes=np.load(os.path.join(d, _HASHES_FNAME)),
+                probs=np.load(os.path.join(d, _PROBS_FNAME)),
+            )
+        except (OSError, ValueError):
+            return None
+
+
+def get_prob_index(model: Model) -> ProbIndex:
+    """The probability index of a model, loading or building it if needed."""
+    version_dir = model.dir(abs=True)
+    # Fingerprint before reading, so the index looks stale if the inference
+    # results change while we're building it.
+    fingerprint = get_inference_fingerprint(version_dir)
+
+    with _lock:
+        loaded = _loaded.get(version_dir)
+        if loaded is not None and loaded[0] == fingerprint:
+            _loaded.move_to_end(version_dir)
+            return loaded[1]
+
+    index = ProbIndex.load(version_dir, fingerprint)
+    if index is None:
+        logging.info(f"Building probability index for {model}")
+        index = ProbIndex.build(model)
+        try:
+            index.save(version_dir, fingerprint)
+        except OSError as e:
+            # We can still use the index, it just won't be cached.
+            logging.error(f"Could not save the probability index of {model}: {e}")
+
+    _set_loaded(version_dir, fingerprint, index)
+    return index
+
+
+def add_probs(model: Model, hashes: np.ndarray, probs: np.ndarray) -> ProbIndex:
+    """Add the probabilities of texts that were inferred outside of the
+    inference jobs, e.g. by the NLPModel for texts it had no inference for.
+
+    Returns the updated index.
+    """
+    version_dir = model.dir(abs=True)
+    index = get_prob_index(model)
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    probs = np.asarray(probs, dtype=np.float32)
+
+    # Note: Concurrent writers can lose each other's results, in which case
+    # they'll just be inferred again.
+    online = _load_online_probs(version_dir)
+    online_hashes, online_probs = _dedupe(
+        np.concatenate([online[0], hashes]), np.concatenate([online[1], probs])
+    )
+    d = _get_inference_dir(version_dir)
+    tmp_fname = os.path.join(d, f"tmp.{os.getpid()}.{_ONLINE_FNAME}")
+    np.savez(tmp_fname, hashes=online_hashes, probs=online_probs)
+    os.replace(tmp_fname, os.path.join(d, _ONLINE_FNAME))
+
+    # Update the index in place of rebuilding it from scratch.
+    index = ProbIndex(
+        *_dedupe(
+            np.concatenate([index.hashes, hashes]),
+            np.concatenate([index.probs, probs]),
+        )
+    )
+    fingerprint = get_inference_fingerprint(version_dir)
+    try:
+        index.save(version_dir, fingerprint)
+    except OSError as e:
+        logging.error(f"Could not save the probability index of {model}: {e}")
+
+    _set_loaded(version_dir, fingerprint, index)
+    return index
+
+
+def clear_loaded_indexes():
+    """Unload the indexes, e.g. to free memory in a long-lived worker."""
+    with _lock:
+        _loaded.clear()
+
+
+def _set_loaded(version_dir: str, fingerprint: List, index: ProbIndex):
+    with _lock:
+        _loaded[version_dir] = (fingerprint, index)
+        _loaded.move_to_end(version_dir)
+        while len(_loaded) > _MAX_LOADED_INDEXES:
+            _loaded.popitem(last=False)
+
+
+def _dedupe(hashes: np.ndarray, probs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Sort by hash. When a hash appears more than once, the last probability
+    wins."""
+    hashes, idx = np.unique(hashes[::-1], return_index=True)
+    return hashes, probs[::-1][idx]
+
+
+def _load_online_probs(version_dir: str) -> Tuple[np.ndarray, np.ndarray]:
+    fname = os.path.join(_get_inference_dir(version_dir), _ONLINE_FNAME)
+    if os.path.isfile(fname):
+        try:
+            with np.load(fname) as data:
+                return data["hashes"], data["probs"]
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"Could not load {fname}: {e}")
+    return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.float32)
+
+
+def _load_hashes_and_probs(
+    model: Model, fname: str
+) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """The text hashes and probabilities of the inference results on the
+    data file `fname`."""
+    ir = InferenceResults.load(_get_inference_fname(model.dir(abs=True), fname))
+    if ir is None:
+        logging.warning(f"Could not load the inference of {model} on {fname}")
+        return None
+    probs = np.array(ir.probs, dtype=np.float32)
+
+    raw_columns = load_raw_data_columns(_raw_data_file_path(fname))
+    if raw_columns is not None:
+        hashes = np.asarray(raw_columns.text_hash, dtype=np.uint64)
+    else:
+        df = model.export_inference(fname, include_text=True)
+        hashes = np.array([hash_text(x) for x in df["text"]], dtype=np.uint64)
+
+    assert len(hashes) == len(probs), "Inference size != Raw data size"
+    return hashes, probs
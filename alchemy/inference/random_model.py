@@ -10,3 +10,6 @@ class RandomModel(ITextCatModel):
         res = list(np.random.uniform(size=len(text_list)))
         res = [{"score": s} for s in res]
         return res
+
+    def needs_text(self):
+        return False
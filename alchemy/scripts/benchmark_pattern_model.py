@@ -0,0 +1,128 @@
+"""
+Compare the tokenizer-only `PatternModel.predict` (in one or more processes)
+against the original implementation, which ran the whole spaCy pipeline
+except the tagger and parser, and check they give the same results.
+
+Also times the aho_corasick backend, which tokenizes with a regex and so can
+give slightly different scores.
+
+    python -m alchemy.scripts.benchmark_pattern_model -n 1000000 --n-process 4
+
+Use `--data` to benchmark on a real data file instead of random text.
+"""
+import os
+import time
+
+import numpy as np
+import spacy
+from spacy.matcher import PhraseMatcher
+
+from alchemy.inference.pattern_matchers import AHO_CORASICK, SPACY_MODEL
+from alchemy.inference.pattern_model import (
+    PatternModel,
+    _maximize_non_overlapping_matches,
+)
+from alchemy.shared.utils import iter_jsonl_chunks
+
+WORDS = [f"word{i}" for i in range(2000)] + ["health", "dog", "is", "healthy", "."]
+
+
+def _predict_full_pipeline(nlp, spacy_patterns, text_list):
+    """The original implementation of PatternModel.predict."""
+    matcher = PhraseMatcher(nlp.vocab)
+    for row in spacy_patterns:
+        matcher.add(row["label"], None, nlp(row["pattern"][0]["lower"].lower()))
+
+    res = []
+    text_list = ["" if x is None else x for x in text_list]
+    for doc in nlp.pipe(text_list, disable=["tagger", "parser"]):
+        matches = matcher(doc)
+        selected_matches = _maximize_non_overlapping_matches(matches)
+        len_of_matches = [m[2] - m[1] for m in selected_matches]
+        score = sum(len_of_matches) / len(doc) if len(doc) > 0 else 0.0
+        res.append({"score": score})
+    return res
+
+
+def build_texts(n: int, n_words: int = 30):
+    words = np.random.choice(WORDS, size=(n, n_words))
+    return [" ".join(row) for row in words]
+
+
+def build_patterns():
+    phrases = ["health", "dog is healthy"] + [f"word{i}" for i in range(0, 2000, 100)]
+    return [{"label": "POSITIVE", "pattern": [{"lower": x}]} for x in phrases]
+
+
+def load_texts(fname: str):
+    text_list = []
+    for chunk in iter_jsonl_chunks(fname):
+        text_list += [row.get("text") for row in chunk]
+    return text_list
+
+
+def timed(fn):
+    start = time.time()
+    res = fn()
+    return time.time() - start, res
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark pattern scoring")
+    parser.add_argument("-n", type=int, default=1000000, help="number of texts")
+    parser.add_argument("--data", help="a jsonl data file to use instead")
+    parser.add_argument("--n-process", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--spacy-model", default=SPACY_MODEL)
+    parser.add_argument(
+        "--skip-full-pipeline",
+        action="store_true",
+        help="don't run the (slow) original implementation",
+    )
+    args = parser.parse_args()
+
+    text_list = load_texts(args.data) if args.data else build_texts(args.n)
+    patterns = build_patterns()
+    print(f"{len(text_list)} texts, {len(patterns)} patterns")
+
+    # Load the models up front, so we only time the scoring.
+    model = PatternModel(patterns, spacy_model=args.spacy_model)
+    model._load()
+
+    elapsed, expected = timed(
+        lambda: model.predict(text_list, n_process=1, batch_size=args.batch_size)
+    )
+    print(f"Tokenizer only:           {elapsed:.2f}s")
+
+    elapsed, res = timed(
+        lambda: model.predict(
+            text_list, n_process=args.n_process, batch_size=args.batch_size
+        )
+    )
+    print(f"Tokenizer only, {args.n_process} procs:  {elapsed:.2f}s")
+    assert res == expected, "Results differ"
+
+    if not args.skip_full_pipeline:
+        if args.spacy_model.startswith("blank:"):
+            nlp = spacy.blank(args.spacy_model[len("blank:") :])
+        else:
+            nlp = spacy.load(args.spacy_model)
+        elapsed, res = timed(
+            lambda: _predict_full_pipeline(nlp, patterns, text_list)
+        )
+        print(f"Full pipeline:            {elapsed:.2f}s")
+        assert res == expected, "Results differ"
+
+    print("Results are identical")
+
+    os.environ["ANNOTATION_TOOL_PATTERN_MATCHER_BACKEND"] = AHO_CORASICK
+    model = PatternModel(patterns)
+    model._load()
+    elapsed, res = timed(
+        lambda: model.predict(text_list, n_process=1, batch_size=args.batch_size)
+    )
+    same = np.mean([x["score"] == y["score"] for x, y in zip(res, expected)])
+    print(f"Aho-Corasick:             {elapsed:.2f}s")
+    print(f"  same score as spaCy:    {same:.1%}")
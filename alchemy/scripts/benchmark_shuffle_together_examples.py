@@ -0,0 +1,146 @@
+"""
+Compare the batched `_shuffle_together_examples` against the original
+one-pick-at-a-time implementation, on lists shaped like the ones we get when
+generating annotation requests (random, pattern, entropy, top and bottom).
+
+    python -m alchemy.scripts.benchmark_shuffle_together_examples -n 1000000
+"""
+import time
+
+import numpy as np
+
+from alchemy.ar import _shuffle_together_examples
+from alchemy.ar.example_store import EntityIndex, ExampleStore
+
+PROPORTIONS = [1, 3, 12, 6, 6]
+
+
+def _shuffle_together_examples_one_at_a_time(
+    list_of_examples, proportions
+) -> ExampleStore:
+    """The original implementation, which picks one list per iteration."""
+    list_of_examples = [x.sorted() for x in list_of_examples]
+    combined = ExampleStore.concat(list_of_examples)
+    offsets = np.cumsum([0] + [len(x) for x in list_of_examples])
+    entity_ids = combined.entity_ids
+
+    res = []
+    seen = np.zeros(len(combined.entity_index), dtype=bool)
+    ls_idx = [0 for _ in list_of_examples]
+    ls_len = [len(x) for x in list_of_examples]
+
+    proportions = np.array(proportions, dtype=np.float64)
+    proportions = proportions / np.sum(proportions)
+
+    for _ in range(len(combined)):
+        which_list = np.argmax(np.random.multinomial(1, proportions, size=1), axis=1)[0]
+
+        while ls_idx[which_list] < ls_len[which_list]:
+            i = offsets[which_list] + ls_idx[which_list]
+            ls_idx[which_list] += 1
+            entity_id = entity_ids[i]
+            if entity_id < 0:
+                continue
+            if not seen[entity_id]:
+                seen[entity_id] = True
+                res.append(i)
+                break
+
+        if ls_idx[which_list] == ls_len[which_list]:
+            proportions[which_list] = 0
+            if np.isclose(np.sum(proportions), 0):
+                break
+            else:
+                proportions = proportions / np.sum(proportions)
+
+    return combined.take(np.array(res, dtype=np.int64))
+
+
+def build_lists(n: int):
+    """Every list ranks the same n entities, like every model scoring the
+    same data file."""
+    entity_index = EntityIndex()
+    entity_ids = entity_index.get_ids([f"{i}.com" for i in range(n)])
+
+    random_scores = np.random.random(n)
+    # Most texts don't match any pattern.
+    pattern_scores = (np.random.random(n) < 0.05) * np.random.random(n)
+    probs = np.random.beta(0.5, 0.5, size=n)
+
+    all_scores = [
+        random_scores,
+        pattern_scores,
+        -np.abs(probs - 0.5),
+        probs,
+        1 - probs,
+    ]
+
+    return [
+        ExampleStore(
+            "company",
+            labels=["foo"],
+            fnames=["data.jsonl"],
+            entity_index=entity_index,
+            scores=scores,
+            entity_ids=entity_ids,
+            label_ids=np.zeros(n),
+            fname_ids=np.zeros(n),
+            line_numbers=np.arange(n),
+        )
+        for scores in all_scores
+    ]
+
+
+def _which_list(res: ExampleStore, lists):
+    """Which of the lists each element of res came from, identified by the
+    score it was given."""
+    which = np.full(len(res), -1)
+    for i, ls in enumerate(lists):
+        which[ls.scores[res.line_numbers] == res.scores] = i
+    return which
+
+
+def run(fn, lists, check_at):
+    start = time.time()
+    res = fn(lists, PROPORTIONS)
+    elapsed = time.time() - start
+
+    which = _which_list(res, lists)[:check_at]
+    observed = np.bincount(which[which >= 0], minlength=len(lists)) / len(which)
+    return elapsed, len(res), observed
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark example shuffling")
+    parser.add_argument("-n", type=int, default=1000000, help="examples per list")
+    parser.add_argument(
+        "--check-at",
+        type=int,
+        default=10000,
+        help="check the proportions over this many leading examples",
+    )
+    parser.add_argument(
+        "--skip-one-at-a-time",
+        action="store_true",
+        help="don't run the (slow) original implementation",
+    )
+    args = parser.parse_args()
+
+    lists = build_lists(args.n)
+    expected = np.array(PROPORTIONS) / np.sum(PROPORTIONS)
+    print(f"{len(lists)} lists of {args.n} examples")
+    print(f"Expected proportions: {np.round(expected, 3)}")
+
+    elapsed, n_res, observed = run(_shuffle_together_examples, lists, args.check_at)
+    print(f"Batched:          {elapsed:.2f}s, {n_res} examples")
+    print(f"  proportions:    {np.round(observed, 3)}")
+
+    if not args.skip_one_at_a_time:
+        base_elapsed, base_n_res, observed = run(
+            _shuffle_together_examples_one_at_a_time, lists, args.check_at
+        )
+        print(f"One at a time:    {base_elapsed:.2f}s, {base_n_res} examples")
+        print(f"  proportions:    {np.round(observed, 3)}")
+        print(f"Speedup: {base_elapsed / elapsed:.1f}x")
@@ -0,0 +1,154 @@
+"""
+Move the parts of the contexts of existing annotation requests and annotations
+that are shared by every request for an entity to EntityContexts, so each
+distinct context is only stored once, with their pattern matches converted to
+character spans (see read_pattern_info). Run this after upgrading the
+database to alembic revision b3e5c1f0a2d4.
+
+    python -m alchemy.scripts.deduplicate_entity_contexts
+
+Use `--restore` to copy the contexts back before downgrading that revision.
+"""
+import logging
+from collections import defaultdict
+
+from sqlalchemy import bindparam
+
+from alchemy.ar.data import (
+    merge_context,
+    read_pattern_info,
+    save_entity_contexts,
+    split_context,
+)
+from alchemy.db.config import DevelopmentConfig
+from alchemy.db.model import (
+    AnnotationRequest,
+    ClassificationAnnotation,
+    Database,
+    EntityContext,
+)
+
+BATCH_SIZE = 1000
+
+
+def _update_query(model):
+    table = model.__table__
+    return (
+        table.update()
+        .where(table.c.id == bindparam("_id"))
+        .values(
+            context=bindparam("_context"),
+            entity_context_id=bindparam("_entity_context_id"),
+        )
+    )
+
+
+def deduplicate(dbsession, model, batch_size=BATCH_SIZE) -> int:
+    """Deduplicate the contexts of the AnnotationRequests or
+    ClassificationAnnotations that don't reference an EntityContext yet.
+
+    Returns how many were updated.
+    """
+    update = _update_query(model)
+    n_updated = 0
+    last_id = 0
+    while True:
+        rows = (
+            dbsession.query(model.id, model.entity_type, model.entity, model.context)
+            .filter(model.id > last_id, model.entity_context_id.is_(None))
+            .order_by(model.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        by_entity_type = defaultdict(list)
+        for _id, entity_type, entity, context in rows:
+            # Some annotations only have a text as context.
+            if isinstance(context, dict):
+                own, shared = split_context(context)
+                if shared is not None:
+                    if "pattern_info" in shared:
+                        shared["pattern_info"] = read_pattern_info(
+                            shared["pattern_info"], shared.get("data")
+                        )
+                    by_entity_type[entity_type].append((_id, entity, own, shared))
+
+        params = []
+        for entity_type, items in by_entity_type.items():
+            ids = save_entity_contexts(
+                dbsession,
+                entity_type,
+                [(entity, shared) for _, entity, _, shared in items],
+            )
+            for (_id, _, own, _), entity_context_id in zip(items, ids):
+                params.append(
+                    {
+                        "_id": _id,
+                        "_context": own or None,
+                        "_entity_context_id": entity_context_id,
+                    }
+                )
+        if params:
+            dbsession.execute(update, params)
+        dbsession.commit()
+
+        n_updated += len(params)
+        logging.info(f"{model.__tablename__}: {n_updated} deduplicated so far")
+    return n_updated
+
+
+def restore(dbsession, model, batch_size=BATCH_SIZE) -> int:
+    """The opposite of `deduplicate`."""
+    update = _update_query(model)
+    n_updated = 0
+    while True:
+        # Updated rows don't match the join anymore.
+        rows = (
+            dbsession.query(model.id, model.context, EntityContext.context)
+            .join(EntityContext, model.entity_context_id == EntityContext.id)
+            .order_by(model.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            break
+
+        params = [
+            {
+                "_id": _id,
+                "_context": merge_context(context, entity_context),
+                "_entity_context_id": None,
+            }
+            for _id, context, entity_context in rows
+        ]
+        dbsession.execute(update, params)
+        dbsession.commit()
+
+        n_updated += len(params)
+        logging.info(f"{model.__tablename__}: {n_updated} restored so far")
+    return n_updated
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Deduplicate entity contexts")
+    parser.add_argument(
+        "--restore",
+        action="store_true",
+        help="copy the entity contexts back to the requests and annotations",
+    )
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    logging.root.setLevel(logging.INFO)
+
+    db = Database(DevelopmentConfig.SQLALCHEMY_DATABASE_URI)
+    fn = restore if args.restore else deduplicate
+    for model in [AnnotationRequest, ClassificationAnnotation]:
+        n = fn(db.session, model, batch_size=args.batch_size)
+        logging.info(f"{model.__tablename__}: {n} updated")
+    db.session.close()
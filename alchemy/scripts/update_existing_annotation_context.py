@@ -15,19 +15,27 @@ if __name__ == "__main__":
     )
     entities = [annotation.entity for annotation in annotations]
     annotation_request_context_and_entity = (
-        db.session.query(AnnotationRequest.context, AnnotationRequest.entity)
+        db.session.query(
+            AnnotationRequest.context,
+            AnnotationRequest.entity_context_id,
+            AnnotationRequest.entity,
+        )
         .filter(AnnotationRequest.entity.in_(entities))
         .all()
     )
     entity_to_context = {
-        item[1]: item[0] for item in annotation_request_context_and_entity
+        item[2]: (item[0], item[1]) for item in annotation_request_context_and_entity
     }
 
     to_update = []
     for annotation in annotations:
         if annotation.entity in entity_to_context:
             logging.info("Updating Entity {}".format(annotation.entity))
-            annotation.context = entity_to_context[annotation.entity]
+            # Only the reference to the shared part of the context is copied.
+            (
+                annotation.context,
+                annotation.entity_context_id,
+            ) = entity_to_context[annotation.entity]
             to_update.append(annotation)
         else:
             logging.info("Did not find request for entity {}".format(annotation.entity))
@@ -1,8 +1,25 @@
+import logging
+import threading
 import time
+from typing import Dict, List, Optional
 
 import redis
 from envparse import env
 
+# The status of a job is stored in the hash `cjs:{celery_id}`, with fields:
+#   s: state, p: progress, n: steps done, see count_step_done,
+#   c: created at, u: updated at, x: context id.
+# The ids of the jobs of a context are in the set `cjss:{context_id}`.
+# Statuses used to be stored in one key per field, e.g. `cjs:{celery_id}:s`.
+_FIELDS = ["s", "p", "n", "c", "u", "x"]
+# Statuses expire on their own a day after they were last set, in case they
+# are never swept, see sweep_stale_statuses.
+_TTL = 60 * 60 * 24
+
+_lock = threading.Lock()
+# URL -> ConnectionPool, shared by all the clients of the process.
+_pools: Dict[str, redis.ConnectionPool] = {}
+
 
 # Don't use enum here because it's easier to serialize and compare strings.
 class JobStatus:
@@ -15,7 +32,12 @@ class JobStatus:
 
 def get_redis():
     redis_url = env("CELERY_BROKER_URL", default="redis://localhost:6379/0")
-    return redis.Redis.from_url(redis_url)
+    with _lock:
+        pool = _pools.get(redis_url)
+        if pool is None:
+            # The pool reconnects on its own in a forked process.
+            pool = _pools[redis_url] = redis.ConnectionPool.from_url(redis_url)
+    return redis.Redis(connection_pool=pool)
 
 
 def create_status(celery_id, context_id, created_at=None):
@@ -27,15 +49,16 @@ def create_status(celery_id, context_id, created_at=None):
 
     Note: create_status may be called after set_status. To avoid a race
     condition, we should not assume `create_status` would be called before
-    `set_status`, so the two functions set different keys.
+    `set_status`, so the two functions set different fields.
     """
     if created_at is None:
         created_at = time.time()
 
-    r = get_redis()
-    r.set(f"cjs:{celery_id}:c", created_at)
-    r.set(f"cjs:{celery_id}:x", context_id)
-    r.sadd(f"cjss:{context_id}", celery_id)
+    pipe = get_redis().pipeline()
+    pipe.hset(f"cjs:{celery_id}", mapping={"c": created_at, "x": context_id})
+    pipe.expire(f"cjs:{celery_id}", _TTL)
+    pipe.sadd(f"cjss:{context_id}", celery_id)
+    pipe.execute()
 
 
 def set_status(celery_id, state: str, progress=None, updated_at=None):
@@ -43,22 +66,49 @@ def set_status(celery_id, state: str, progress=None, updated_at=None):
     if updated_at is None:
         updated_at = time.time()
 
-    r = get_redis()
-    r.set(f"cjs:{celery_id}:s", state)
-    r.set(f"cjs:{celery_id}:u", updated_at)
-
+    mapping = {"s": state, "u": updated_at}
     if progress is not None and isinstance(progress, float):
-        r.set(f"cjs:{celery_id}:p", progress)
+        mapping["p"] = progress
+    pipe = get_redis().pipeline()
+    pipe.hset(f"cjs:{celery_id}", mapping=mapping)
+    pipe.expire(f"cjs:{celery_id}", _TTL)
+    pipe.execute()
+
+
+def count_step_done(celery_id, n_steps: int):
+    """Meant to be called from Celery, by each of the `n_steps` subtasks a job
+    is split into (e.g. the tasks of a chord) when it's done. Sets the
+    progress to the fraction of the steps done so far."""
+    n_done = get_redis().hincrby(f"cjs:{celery_id}", "n", 1)
+    set_status(celery_id, JobStatus.STARTED, progress=min(n_done / n_steps, 1.0))
 
 
 def delete_status(celery_id, context_id):
+    pipe = get_redis().pipeline()
+    pipe.delete(f"cjs:{celery_id}", *[f"cjs:{celery_id}:{f}" for f in _FIELDS])
+    pipe.srem(f"cjss:{context_id}", celery_id)
+    pipe.execute()
+
+
+def sweep_stale_statuses() -> int:
+    """Delete the statuses of the jobs that are stale (see
+    CeleryJobStatus.is_stale) or gone, in every context.
+
+    Returns how many were deleted.
+    """
     r = get_redis()
-    r.delete(f"cjs:{celery_id}:s")
-    r.delete(f"cjs:{celery_id}:p")
-    r.delete(f"cjs:{celery_id}:c")
-    r.delete(f"cjs:{celery_id}:u")
-    r.delete(f"cjs:{celery_id}:x")
-    r.srem(f"cjss:{context_id}", celery_id)
+    n_deleted = 0
+    for key in r.scan_iter(match="cjss:*"):
+        context_id = key.decode()[len("cjss:") :]
+        celery_ids = [x.decode() for x in r.smembers(f"cjss:{context_id}")]
+        statuses = CeleryJobStatus.fetch_by_celery_ids(celery_ids)
+        for celery_id, cjs in zip(celery_ids, statuses):
+            if cjs is None or cjs.is_stale():
+                delete_status(celery_id, context_id)
+                n_deleted += 1
+    if n_deleted:
+        logging.info(f"Deleted {n_deleted} stale job statuses")
+    return n_deleted
 
 
 class CeleryJobStatus:
@@ -100,24 +150,42 @@ class CeleryJobStatus:
         return False
 
     @staticmethod
-    def fetch_all_by_context_id(context_id):
+    def fetch_all_by_context_id(context_id) -> List["CeleryJobStatus"]:
+        """The statuses of the jobs of a context, oldest first, in two round
+        trips."""
         r = get_redis()
-        res = []
-        for celery_id in r.smembers(f"cjss:{context_id}"):
-            celery_id = celery_id.decode()
-            res.append(CeleryJobStatus.fetch_by_celery_id(celery_id))
+        celery_ids = [x.decode() for x in r.smembers(f"cjss:{context_id}")]
+        res = CeleryJobStatus.fetch_by_celery_ids(celery_ids)
+        res = [x for x in res if x is not None]
         res = sorted(res, key=lambda cjs: cjs.created_at)
         return res
 
     @staticmethod
-    def fetch_by_celery_id(celery_id):
-        r = get_redis()
+    def fetch_by_celery_id(celery_id) -> Optional["CeleryJobStatus"]:
+        return CeleryJobStatus.fetch_by_celery_ids([celery_id])[0]
 
-        _s = r.get(f"cjs:{celery_id}:s")
-        _p = r.get(f"cjs:{celery_id}:p")
-        _c = r.get(f"cjs:{celery_id}:c")
-        _u = r.get(f"cjs:{celery_id}:u")
-        _x = r.get(f"cjs:{celery_id}:x")
+    @staticmethod
+    def fetch_by_celery_ids(celery_ids: List[str]) -> List[Optional["CeleryJobStatus"]]:
+        """The status of each job, or None if it doesn't have one, in one
+        round trip."""
+        if not celery_ids:
+            return []
+
+        pipe = get_redis().pipeline(transaction=False)
+        for celery_id in celery_ids:
+            pipe.hgetall(f"cjs:{celery_id}")
+        return [
+            CeleryJobStatus._from_hash(celery_id, h)
+            for celery_id, h in zip(celery_ids, pipe.execute())
+        ]
+
+    @staticmethod
+    def _from_hash(celery_id, h: Dict[bytes, bytes]) -> Optional["CeleryJobStatus"]:
+        _s = h.get(b"s")
+        _p = h.get(b"p")
+        _c = h.get(b"c")
+        _u = h.get(b"u")
+        _x = h.get(b"x")
 
         now = time.time()
 
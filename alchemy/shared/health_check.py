@@ -1,7 +1,9 @@
 from datetime import datetime
+from typing import Dict, Optional
 
 from alchemy.db.fs import raw_data_dir
 from alchemy.db.utils import get_all_data_files
+from alchemy.shared import heartbeat
 
 
 def check_file_system() -> bool:
@@ -26,16 +28,19 @@ def check_file_system() -> bool:
     return True
 
 
-def check_celery() -> bool:
+def get_celery_status() -> Optional[Dict]:
+    """The health of each Celery queue, see heartbeat.get_queue_status, or
+    None if Redis can't be reached."""
     try:
-        from alchemy.ar.ar_celery import hello
-        task_result = hello.apply_async(retry=False, retry_policy={
-            'timeout': 5.0,
-            'max_retries': 1,
-        })
-        task_result.wait(timeout=5)
-        assert task_result.successful()
+        return heartbeat.get_queue_status()
     except:
+        return None
+
+
+def check_celery(celery_status: Optional[Dict] = None) -> bool:
+    """Whether the ar_celery workers sent a heartbeat recently."""
+    if celery_status is None:
+        celery_status = get_celery_status()
+    if celery_status is None:
         return False
-    else:
-        return True
+    return celery_status[heartbeat.MAIN_QUEUE]["ok"]
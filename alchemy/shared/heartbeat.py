@@ -0,0 +1,165 @@
+"""
+Celery workers publish a heartbeat to Redis every few seconds, so the health
+of the queues can be checked by reading Redis instead of sending a task and
+waiting for its result.
+
+The heartbeats of the workers of a queue are stored in the hash
+`hb:{queue}`, by worker hostname.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Dict, List, Optional
+
+from celery.signals import worker_ready, worker_shutdown
+from celery.worker import state as worker_state
+from envparse import env
+
+from alchemy.shared.celery_job_status import get_redis
+
+# The queue we check to tell whether Celery is up.
+MAIN_QUEUE = "ar_celery"
+QUEUES = ["ar_celery", "train_celery", "gcp_celery"]
+_TTL = 60 * 60
+
+
+def get_interval() -> float:
+    """How many seconds between the heartbeats of a worker."""
+    return env.float("ANNOTATION_TOOL_HEARTBEAT_INTERVAL", default=10.0)
+
+
+def publish_heartbeat(
+    queues: List[str],
+    hostname: str,
+    concurrency: Optional[int],
+    in_flight: int,
+    now: Optional[float] = None,
+):
+    if now is None:
+        now = time.time()
+    heartbeat = json.dumps(
+        {
+            "ts": now,
+            "hostname": hostname,
+            "pid": os.getpid(),
+            "concurrency": concurrency,
+            "in_flight": in_flight,
+        }
+    )
+    pipe = get_redis().pipeline()
+    for queue in queues:
+        pipe.hset(f"hb:{queue}", mapping={hostname: heartbeat})
+        # Forget the queue if all its workers die.
+        pipe.expire(f"hb:{queue}", _TTL)
+    pipe.execute()
+
+
+def remove_heartbeat(queues: List[str], hostname: str):
+    pipe = get_redis().pipeline()
+    for queue in queues:
+        pipe.hdel(f"hb:{queue}", hostname)
+    pipe.execute()
+
+
+def get_queue_status(
+    queues: List[str] = QUEUES, now: Optional[float] = None
+) -> Dict[str, Dict]:
+    """The health of each queue, from the heartbeats of its workers and its
+    length in the broker, in one round trip:
+
+        queue -> {
+            "ok": Whether a worker sent a heartbeat recently,
+            "age": Seconds since the latest heartbeat, or None,
+            "workers": How many workers sent a heartbeat recently,
+            "concurrency": How many tasks they can run at a time,
+            "in_flight": How many tasks they are running,
+            "depth": How many tasks are waiting in the queue,
+        }
+    """
+    if now is None:
+        now = time.time()
+    # Allow for a couple of missed heartbeats.
+    max_age = 3 * get_interval()
+
+    pipe = get_redis().pipeline(transaction=False)
+    for queue in queues:
+        pipe.hgetall(f"hb:{queue}")
+        # Celery's redis transport keeps the tasks of a queue in a list.
+        pipe.llen(queue)
+    res = pipe.execute()
+
+    status = {}
+    for i, queue in enumerate(queues):
+        heartbeats = [json.loads(x) for x in res[2 * i].values()]
+        fresh = [x for x in heartbeats if now - x["ts"] <= max_age]
+        latest = max((x["ts"] for x in heartbeats), default=None)
+        status[queue] = {
+            "ok": len(fresh) > 0,
+            "age": now - latest if latest is not None else None,
+            "workers": len(fresh),
+            "concurrency": sum(x["concurrency"] or 0 for x in fresh),
+            "in_flight": sum(x["in_flight"] for x in fresh),
+            "depth": res[2 * i + 1],
+        }
+    return status
+
+
+class _Heartbeat(threading.Thread):
+    """Publishes the heartbeat of the worker of `consumer` until stopped."""
+
+    def __init__(self, consumer):
+        super().__init__(name="heartbeat", daemon=True)
+        self.consumer = consumer
+        self.hostname = consumer.hostname or socket.gethostname()
+        self.queues = [q.name for q in consumer.app.amqp.queues.consumer_queues]
+        self.stopped = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                publish_heartbeat(
+                    self.queues,
+                    self.hostname,
+                    self._get_concurrency(),
+                    len(worker_state.active_requests),
+                )
+            except Exception as e:
+                logging.error(f"Could not publish the heartbeat: {e}")
+            if self.stopped.wait(get_interval()):
+                break
+
+        try:
+            remove_heartbeat(self.queues, self.hostname)
+        except Exception as e:
+            logging.error(f"Could not remove the heartbeat: {e}")
+
+    def _get_concurrency(self) -> Optional[int]:
+        # The number of processes changes with --autoscale.
+        pool = getattr(self.consumer, "pool", None)
+        n = getattr(pool, "num_processes", None)
+        if n is None:
+            n = getattr(self.consumer.controller, "concurrency", None)
+        return n
+
+
+def install(app):
+    """Publish heartbeats from the workers of `app`."""
+    heartbeats = []
+
+    # Signals are sent for every app in the process, not just this one.
+    @worker_ready.connect(weak=False)
+    def _start(sender=None, **kwargs):
+        if sender is not None and sender.app is app:
+            heartbeat = _Heartbeat(sender)
+            heartbeat.start()
+            heartbeats.append(heartbeat)
+
+    @worker_shutdown.connect(weak=False)
+    def _stop(sender=None, **kwargs):
+        if sender is not None and sender.app is app:
+            for heartbeat in heartbeats:
+                heartbeat.stopped.set()
+                heartbeat.join(timeout=5)
@@ -0,0 +1,126 @@
+"""
+Refresh the TaskStatistics of a task in the background when its annotations
+or annotation requests change.
+
+Refreshes are debounced: the first change marks the task in Redis, with the
+key `tstats:{task_id}`, and schedules ar_celery.refresh_task_statistics a few
+seconds later. Changes made until the refresh starts don't schedule another
+one, since the refresh will include them.
+
+Annotations change the statistics of every task with their label, so the
+tasks of each label are cached in the Redis hash `tstats:label_tasks`, and
+rebuilt when the tasks change, see invalidate_label_tasks.
+"""
+import json
+import logging
+from typing import Dict, Iterable, List
+
+from envparse import env
+
+from alchemy.db.model import Task
+from alchemy.shared.celery_job_status import get_redis
+
+# In case the refresh is lost, e.g. the worker died, let later changes
+# schedule another one.
+_TTL = 60 * 10
+
+_LABEL_TASKS_KEY = "tstats:label_tasks"
+# In case a change to the tasks didn't invalidate the cache, e.g. from a
+# script.
+_LABEL_TASKS_TTL = 60 * 10
+# Marks the cache as built, even if there are no tasks.
+_BUILT = "__built__"
+
+
+def get_delay() -> float:
+    """How many seconds to wait for more changes before refreshing."""
+    return env.float("ANNOTATION_TOOL_STATISTICS_REFRESH_DELAY", default=10.0)
+
+
+def get_max_age() -> float:
+    """How old the statistics shown can be before we refresh them anyway, in
+    case a change didn't schedule a refresh, e.g. from a script."""
+    return env.float("ANNOTATION_TOOL_STATISTICS_MAX_AGE", default=60 * 60)
+
+
+def schedule_refresh(task_ids: Iterable[int]):
+    """Refresh the statistics of the tasks soon, unless it's already
+    scheduled.
+
+    Errors are logged rather than raised, the statistics will be refreshed
+    once they're too old anyway.
+    """
+    task_ids = list(task_ids)
+    if not task_ids:
+        return
+
+    from alchemy.ar.ar_celery import refresh_task_statistics
+
+    try:
+        pipe = get_redis().pipeline()
+        for task_id in task_ids:
+            pipe.set(f"tstats:{task_id}", 1, nx=True, ex=_TTL)
+        is_first = pipe.execute()
+
+        for task_id, first in zip(task_ids, is_first):
+            if first:
+                refresh_task_statistics.apply_async(
+                    args=[task_id], countdown=get_delay()
+                )
+    except Exception as e:
+        logging.error(f"Could not schedule a refresh of the statistics: {e}")
+
+
+def schedule_refresh_for_labels(dbsession, labels: Iterable[str]):
+    """Refresh the statistics of every task with one of the labels, e.g. after
+    their annotations changed."""
+    try:
+        task_ids = get_task_ids_with_labels(dbsession, labels)
+    except Exception as e:
+        logging.error(f"Could not find the tasks to refresh the statistics of: {e}")
+        return
+    schedule_refresh(task_ids)
+
+
+def get_task_ids_with_labels(dbsession, labels: Iterable[str]) -> List[int]:
+    """The tasks with one of the labels, from the cache in Redis, which is
+    rebuilt from the database if needed."""
+    r = get_redis()
+    label_tasks = {k.decode(): v for k, v in r.hgetall(_LABEL_TASKS_KEY).items()}
+    if _BUILT not in label_tasks:
+        tasks = fetch_label_tasks(dbsession)
+        label_tasks = {label: json.dumps(ids) for label, ids in tasks.items()}
+        label_tasks[_BUILT] = "1"
+        pipe = r.pipeline()
+        pipe.hset(_LABEL_TASKS_KEY, mapping=label_tasks)
+        pipe.expire(_LABEL_TASKS_KEY, _LABEL_TASKS_TTL)
+        pipe.execute()
+
+    task_ids = set()
+    for label in labels:
+        if label != _BUILT and label in label_tasks:
+            task_ids.update(json.loads(label_tasks[label]))
+    return sorted(task_ids)
+
+
+def invalidate_label_tasks():
+    """Call when the labels of a task change, or a task is created."""
+    try:
+        get_redis().delete(_LABEL_TASKS_KEY)
+    except Exception as e:
+        logging.error(f"Could not invalidate the tasks of each label: {e}")
+
+
+def fetch_label_tasks(dbsession) -> Dict[str, List[int]]:
+    """The ids of the tasks of each label."""
+    # The labels are stored in a JSON column, there aren't many tasks.
+    res: Dict[str, List[int]] = {}
+    for task in dbsession.query(Task).order_by(Task.id).all():
+        for label in set(task.get_labels()):
+            res.setdefault(label, []).append(task.id)
+    return res
+
+
+def mark_started(task_id: int):
+    """Let the changes from now on schedule another refresh."""
+    get_redis().delete(f"tstats:{task_id}")
@@ -41,6 +41,23 @@ def load_jsonl(jsonl_fname, to_df=True):
         return None
 
 
+def iter_jsonl_chunks(jsonl_fname, chunk_size=10000):
+    """Lazily read a jsonl file in chunks of at most `chunk_size` rows.
+
+    Yields lists of dicts, so only one chunk needs to be in memory at a time.
+    """
+    assert chunk_size > 0, "chunk_size must be positive"
+    chunk = []
+    with open(jsonl_fname) as f:
+        for line in f:
+            chunk.append(json.loads(line))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
 def save_jsonl(fname, data):
     assert fname.endswith(".jsonl")
     with open(fname, "w") as outfile:
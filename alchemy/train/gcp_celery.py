@@ -4,6 +4,7 @@ from typing import Optional
 from celery import Celery
 from envparse import env
 
+from alchemy.shared import heartbeat
 from alchemy.train.gcp_job import GoogleAIPlatformJob, build_model_storage_manager
 from alchemy.train.gs_utils import DeployedInferenceMetadata, create_deployed_inference
 
@@ -74,6 +75,7 @@ def on_job_success(job: GoogleAIPlatformJob, metadata_dict: Optional[dict] = Non
 
 
 app.conf.task_routes = {"*.gcp_celery.*": {"queue": "gcp_celery"}}
+heartbeat.install(app)
 
 """
 celery --app=train.gcp_celery worker -Q gcp_celery -l info -n gcp_celery
@@ -2,6 +2,8 @@ import json
 import os
 import tempfile
 
+import pandas as pd
+
 from alchemy.admin_server.external_services import GCPPubSubService
 from alchemy.shared.utils import load_jsonl
 from alchemy.train.gs_url import (
@@ -11,6 +13,7 @@ from alchemy.train.gs_url import (
     build_raw_data_url,
 )
 from alchemy.train.no_deps.inference_results import InferenceResults
+from alchemy.train.no_deps.raw_data_columns import TEXT, load_raw_data_columns
 from alchemy.train.no_deps.utils import gs_copy_file, gs_exists
 
 
@@ -149,7 +152,7 @@ def build_prod_inference_dataframe(pred_fname, raw_fname, threshold):
     # TODO test
     inf = InferenceResults.load(pred_fname)
 
-    raw = load_jsonl(raw_fname, to_df=True)
+    raw = _load_raw_data_flat(raw_fname)
 
     if len(inf.probs) != len(raw):
         raise Exception(
@@ -158,6 +161,31 @@ def build_prod_inference_dataframe(pred_fname, raw_fname, threshold):
         )
 
     df = raw
+    df["prob"] = inf.probs
+    df["pred"] = df["prob"] > threshold
+
+    return df
+
+
+def _load_raw_data_flat(raw_fname):
+    """Load a raw data file as a dataframe, with the 'meta' column flattened
+    into 'meta_<key>' columns."""
+    with open(raw_fname) as f:
+        first_row = json.loads(f.readline() or "{}")
+    meta_keys = list((first_row.get("meta") or {}).keys())
+
+    raw_columns = None
+    if set(meta_keys) <= {"name", "domain"}:
+        # We have all the columns we need in the columnar cache.
+        raw_columns = load_raw_data_columns(raw_fname)
+
+    if raw_columns is not None:
+        df = pd.DataFrame({"text": raw_columns.get(TEXT)})
+        for key in meta_keys:
+            df["meta_" + key] = raw_columns.get(f"meta.{key}")
+        return df
+
+    df = load_jsonl(raw_fname, to_df=True)
 
     # Flatten the 'meta' column
     if "meta" in df and len(df) > 0:
@@ -166,7 +194,4 @@ def build_prod_inference_dataframe(pred_fname, raw_fname, threshold):
             df["meta_" + key] = df["meta"].apply(lambda row: row[key])
         df = df.drop(columns=["meta"])
 
-    df["prob"] = inf.probs
-    df["pred"] = df["prob"] > threshold
-
     return df
@@ -21,6 +21,8 @@ A model's directory consists of:
         results.
     - <dataset>.pred.<label_name>.histogram: A png of the histogram of positive
         class probabilities for `label_name`.
+    - prob_index.* : An index from text to positive class probability over
+        all the inferences, see alchemy.inference.prob_index.
 """
 
 
@@ -0,0 +1,263 @@
+"""
+A columnar cache of raw data files, so we don't have to parse the same jsonl
+file with `json.loads` every time we need its text or entities.
+
+This file only depends on numpy, so it can also be used for distributed model
+training.
+
+For a data file `raw_data/myfile.jsonl`, the cache lives in the hidden
+directory `raw_data/.myfile.jsonl.columns/` and contains, for each of the
+string columns `text`, `meta.name`, `meta.domain` and `meta` (the whole meta
+of each row, as JSON):
+
+    <column>.chars.npy      All the values of the column concatenated
+                            together, as UTF-8.
+    <column>.offsets.npy    Where each value starts and ends, in bytes.
+    <column>.missing.npy    Which values are missing (None).
+
+as well as:
+
+    text_hash.npy           A 64 bit hash of each (stripped) text, see
+                            `hash_text`.
+    meta.json               Size and mtime of the data file the cache was
+                            built from; the cache is rebuilt if they don't
+                            match.
+
+Use `load_raw_data_columns` to read a data file through the cache.
+"""
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+
+CACHE_VERSION = 3
+
+TEXT = "text"
+NAME = "meta.name"
+DOMAIN = "meta.domain"
+META = "meta"
+COLUMNS = [TEXT, NAME, DOMAIN, META]
+
+_META_FNAME = "meta.json"
+_TEXT_HASH_FNAME = "text_hash.npy"
+
+
+def cache_dir(fname: str) -> str:
+    """Where the columnar cache of the data file `fname` is stored."""
+    dirname, basename = os.path.split(os.path.abspath(fname))
+    return os.path.join(dirname, f".{basename}.columns")
+
+
+def hash_text(text: Optional[str]) -> int:
+    """A 64 bit hash of a text, ignoring leading and trailing whitespace."""
+    text = text or ""
+    return int(hashlib.md5(text.strip().encode()).hexdigest()[:16], 16)
+
+
+class StringColumn:
+    """A column of strings, some of which may be missing."""
+
+    def __init__(self, chars: np.ndarray, offsets: np.ndarray, missing: np.ndarray):
+        """
+        Inputs:
+            chars: All the strings concatenated together, as UTF-8 bytes.
+            offsets: The i-th string is the decoded chars[offsets[i]:offsets[i+1]],
+                so a range of strings can be decoded without the others.
+            missing: The i-th string is None if missing[i] is True.
+        """
+        self.chars = chars
+        self.offsets = offsets
+        self.missing = missing
+
+    def __len__(self):
+        return len(self.missing)
+
+    @staticmethod
+    def from_list(values: List[Optional[str]]) -> "StringColumn":
+        encoded = [x.encode() if x is not None else b"" for x in values]
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in encoded], out=offsets[1:])
+        chars = b"".join(encoded)
+        return StringColumn(
+            chars=np.frombuffer(chars, dtype=np.uint8),
+            offsets=offsets,
+            missing=np.array([x is None for x in values], dtype=bool),
+        )
+
+    def to_list(self) -> List[Optional[str]]:
+        return self.slice(0, len(self))
+
+    def slice(self, start: int, stop: int) -> List[Optional[str]]:
+        """The strings from `start` to `stop` (excluded), only reading and
+        decoding those."""
+        stop = min(stop, len(self))
+        if start >= stop:
+            return []
+        offsets = self.offsets[start : stop + 1].tolist()
+        missing = self.missing[start:stop].tolist()
+        first = offsets[0]
+        chars = self.chars[first : offsets[-1]].tobytes()
+        return [
+            None if missing[i] else chars[a - first : b - first].decode()
+            for i, (a, b) in enumerate(zip(offsets, offsets[1:]))
+        ]
+
+
+class RawDataColumns:
+    def __init__(self, columns: Dict[str, StringColumn], text_hash: np.ndarray):
+        self.columns = columns
+        self.text_hash = text_hash
+
+    def __len__(self):
+        return len(self.text_hash)
+
+    def get(self, column: str) -> List[Optional[str]]:
+        """All the values of a column, e.g. "text" or "meta.domain"."""
+        return self.columns[column].to_list()
+
+    def slice(self, column: str, start: int, stop: int) -> List[Optional[str]]:
+        """The values of a column from row `start` to `stop` (excluded)."""
+        return self.columns[column].slice(start, stop)
+
+    def get_meta(self) -> List[Dict]:
+        """The meta of each row, as in the data file, or {} if it has none."""
+        return [json.loads(x) if x is not None else {} for x in self.get(META)]
+
+    @staticmethod
+    def from_rows(rows: List[Dict]) -> Optional["RawDataColumns"]:
+        """Returns None if the rows can't be stored in columns, e.g. if some
+        text is not a string."""
+        values = {column: [] for column in COLUMNS}
+        for row in rows:
+            meta = row.get("meta")
+            values[META].append(json.dumps(meta) if meta is not None else None)
+            meta = meta or {}
+            values[TEXT].append(row.get("text"))
+            values[NAME].append(meta.get("name"))
+            values[DOMAIN].append(meta.get("domain"))
+
+        for column in COLUMNS:
+            if not all(x is None or isinstance(x, str) for x in values[column]):
+                return None
+
+        return RawDataColumns(
+            columns={column: StringColumn.from_list(values[column]) for column in COLUMNS},
+            text_hash=np.array([hash_text(x) for x in values[TEXT]], dtype=np.uint64),
+        )
+
+    def save(self, d: str, stat: os.stat_result):
+        """
+        Inputs:
+            d: The cache directory.
+            stat: The os.stat of the data file at the time it was read.
+        """
+        os.makedirs(d, exist_ok=True)
+
+        # meta.json is written last, so a partially written cache is never
+        # considered valid.
+        meta_fname = os.path.join(d, _META_FNAME)
+        if os.path.exists(meta_fname):
+            os.remove(meta_fname)
+
+        arrays = {_TEXT_HASH_FNAME: self.text_hash}
+        for column, values in self.columns.items():
+            arrays[f"{column}.chars.npy"] = values.chars
+            arrays[f"{column}.offsets.npy"] = values.offsets
+            arrays[f"{column}.missing.npy"] = values.missing
+
+        for name, arr in arrays.items():
+            tmp_fname = os.path.join(d, f"tmp.{os.getpid()}.{name}")
+            np.save(tmp_fname, arr)
+            os.replace(tmp_fname, os.path.join(d, name))
+
+        tmp_fname = os.path.join(d, f"tmp.{os.getpid()}.{_META_FNAME}")
+        with open(tmp_fname, "w") as f:
+            json.dump(
+                {
+                    "version": CACHE_VERSION,
+                    "size": stat.st_size,
+                    "mtime_ns": stat.st_mtime_ns,
+                },
+                f,
+            )
+        os.replace(tmp_fname, meta_fname)
+
+    @staticmethod
+    def load(d: str, stat: os.stat_result) -> Optional["RawDataColumns"]:
+        """Load the cache in directory d, or None if it's missing or stale.
+
+        Inputs:
+            d: The cache directory.
+            stat: The current os.stat of the data file.
+        """
+        try:
+            with open(os.path.join(d, _META_FNAME)) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if (
+            meta.get("version") != CACHE_VERSION
+            or meta.get("size") != stat.st_size
+            or meta.get("mtime_ns") != stat.st_mtime_ns
+        ):
+            return None
+
+        def _load(name):
+            return np.load(os.path.join(d, name), mmap_mode="r")
+
+        try:
+            return RawDataColumns(
+                columns={
+                    column: StringColumn(
+                        chars=_load(f"{column}.chars.npy"),
+                        offsets=_load(f"{column}.offsets.npy"),
+                        missing=_load(f"{column}.missing.npy"),
+                    )
+                    for column in COLUMNS
+                },
+                text_hash=_load(_TEXT_HASH_FNAME),
+            )
+        except (OSError, ValueError):
+            return None
+
+
+def load_raw_data_columns(fname: str) -> Optional[RawDataColumns]:
+    """Load the text and entities of a raw data file.
+
+    Reads from the columnar cache if it's up to date, otherwise parses the
+    jsonl file and (re)builds the cache. Returns None if the file doesn't
+    exist.
+    """
+    if not os.path.isfile(fname):
+        return None
+
+    d = cache_dir(fname)
+    # Stat before reading, so the cache looks stale if the file changes
+    # while we're reading it.
+    stat = os.stat(fname)
+
+    res = RawDataColumns.load(d, stat)
+    if res is not None:
+        return res
+
+    rows = []
+    with open(fname) as f:
+        for line in f:
+            rows.append(json.loads(line))
+
+    res = RawDataColumns.from_rows(rows)
+    if res is None:
+        logging.warning(f"Cannot store {fname} in columns, reading it as jsonl")
+        return None
+
+    try:
+        res.save(d, stat)
+    except OSError as e:
+        # We can still use the columns, they just won't be cached.
+        logging.error(f"Could not save the columns of {fname}: {e}")
+
+    return res
@@ -8,6 +8,8 @@ import pandas as pd
 from scipy.special import softmax
 from sklearn.model_selection import train_test_split
 
+from .raw_data_columns import TEXT, load_raw_data_columns
+
 BINARY_CLASSIFICATION = "binary"
 MULTILABEL_CLASSIFICATION = "multilabel"
 
@@ -30,6 +32,10 @@ def load_jsonl(jsonl_fname, to_df=True):
 
 
 def load_original_data_text(datafname):
+    raw_columns = load_raw_data_columns(datafname)
+    if raw_columns is not None:
+        return [x or "" for x in raw_columns.get(TEXT)]
+
     text = load_jsonl(datafname)["text"]
     text = text.fillna("")
     text = list(text)
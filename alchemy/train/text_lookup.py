@@ -1,3 +1,4 @@
+from alchemy.db.raw_data_index import ENTITY_KEY, get_raw_data_index
 from alchemy.shared.utils import json_lookup, load_jsonl
 
 
@@ -37,6 +38,20 @@ def get_entity_text_lookup_function(
         fn(1, 'blah.com')  =>  ''
     """
 
+    if entity_name_key == ENTITY_KEY:
+        # Look up the rows we need through the file's index, instead of
+        # loading the whole file.
+        index = get_raw_data_index(jsonl_file_path)
+
+        def fn(_entity_type, _entity_name):
+            if entity_type == _entity_type:
+                row = index.get_row_for_entity(_entity_name)
+                if row is not None:
+                    return json_lookup(row, entity_text_key) or ""
+            return ""
+
+        return fn
+
     data = load_jsonl(jsonl_file_path, to_df=False)
 
     lookup = {}
@@ -6,6 +6,7 @@ from envparse import env
 
 from alchemy.db.config import DevelopmentConfig
 from alchemy.db.model import Database, ModelDeploymentConfig, TextClassificationModel
+from alchemy.shared import heartbeat
 from alchemy.train.gcp_celery import poll_status as gcp_poll_status
 from alchemy.train.gcp_job import ModelDefn, submit_job
 from alchemy.train.gs_utils import (
@@ -83,6 +84,7 @@ def submit_gcp_inference_on_new_file(dataset_name):
 
 
 app.conf.task_routes = {"*.train_celery.*": {"queue": "train_celery"}}
+heartbeat.install(app)
 
 """
 celery --app=train.train_celery worker -Q train_celery -c 1 -l info --max-tasks-per-child 1 -P threads -n train_celery
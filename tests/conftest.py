@@ -34,3 +34,31 @@ def disable_cloud_logging():
         del os.environ['USE_CLOUD_LOGGING']
     else:
         os.environ['USE_CLOUD_LOGGING'] = old_val
+
+
+@pytest.fixture(scope="session", autouse=True)
+def set_up_inference_cache_tempdir(tmp_path_factory):
+    import os
+    old_val = os.environ.get('ANNOTATION_TOOL_INFERENCE_CACHE_DIR', default=None)
+    os.environ['ANNOTATION_TOOL_INFERENCE_CACHE_DIR'] = str(tmp_path_factory.mktemp('infcache'))
+
+    yield
+
+    if old_val is None:
+        del os.environ['ANNOTATION_TOOL_INFERENCE_CACHE_DIR']
+    else:
+        os.environ['ANNOTATION_TOOL_INFERENCE_CACHE_DIR'] = old_val
+
+
+@pytest.fixture
+def make_data_file(tmp_path):
+    """Returns fn(rows, name="data.jsonl") that writes a raw data file in
+    tmp_path and returns its path."""
+    from alchemy.shared.utils import save_jsonl
+
+    def _make_data_file(rows, name="data.jsonl"):
+        fname = str(tmp_path / name)
+        save_jsonl(fname, rows)
+        return fname
+
+    return _make_data_file
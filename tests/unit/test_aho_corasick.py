@@ -0,0 +1,83 @@
+import pytest
+
+from alchemy.inference.aho_corasick import AhoCorasickMatcher, RegexDoc, regex_tokenize
+from alchemy.inference.pattern_model import PatternModel
+
+
+def test_regex_tokenize():
+    assert regex_tokenize("My dog, is healthy!") == [
+        "My",
+        "dog",
+        ",",
+        "is",
+        "healthy",
+        "!",
+    ]
+    assert regex_tokenize("") == []
+
+
+def test_regex_doc():
+    doc = RegexDoc("  my  dog, is healthy")
+    assert len(doc) == 5
+    assert list(doc) == ["my", "dog", ",", "is", "healthy"]
+    assert doc[1:3].text == "dog,"
+    assert doc[4:5].text == "healthy"
+
+
+def test_aho_corasick_matcher():
+    matcher = AhoCorasickMatcher(
+        [
+            ("A", ["a", "b", "c"]),
+            ("A", ["b", "c"]),
+            ("A", ["b", "c"]),
+            ("B", ["c"]),
+            ("B", ["a", "b", "d"]),
+            ("B", []),
+        ]
+    )
+    assert matcher.labels == ["A", "B"]
+
+    # The failure links take us from "a b" to "b" and then "b d" doesn't
+    # exist, so we restart.
+    matches = matcher(["x", "a", "b", "c", "a", "b", "d", "c"])
+    assert sorted(matches) == [
+        (0, 1, 4),
+        (0, 2, 4),
+        (1, 3, 4),
+        (1, 4, 7),
+        (1, 7, 8),
+    ]
+    assert matcher([]) == []
+
+
+@pytest.mark.parametrize("backend", ["spacy", "aho_corasick"])
+def test_pattern_model_backends(backend, monkeypatch, tmp_path):
+    monkeypatch.setenv("ANNOTATION_TOOL_INFERENCE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setenv("ANNOTATION_TOOL_PATTERN_MODEL_SPACY_MODEL", "blank:en")
+    monkeypatch.setenv("ANNOTATION_TOOL_PATTERN_MATCHER_BACKEND", backend)
+
+    patterns = [
+        {"label": "HEALTHCARE", "pattern": [{"lower": "my"}]},
+        {"label": "HEALTHCARE", "pattern": [{"lower": "dog is healthy"}]},
+        {"label": "HEALTHCARE", "pattern": [{"lower": "and happy"}]},
+        {"label": "HEALTHCARE", "pattern": [{"lower": "healthy and happy"}]},
+    ]
+
+    model = PatternModel(patterns)
+    preds = model.predict(["my dog is healthy and happy", None], fancy=True)
+    assert preds == [
+        {
+            "tokens": ["my", "dog", "is", "healthy", "and", "happy"],
+            "matches": [(0, 1, "my"), (3, 6, "healthy and happy")],
+            "score": 4.0 / 6,
+        },
+        {"tokens": [], "matches": [], "score": 0.0},
+    ]
+    assert backend in model.cache_key()
+
+
+def test_pattern_model_unknown_backend(monkeypatch):
+    monkeypatch.setenv("ANNOTATION_TOOL_PATTERN_MATCHER_BACKEND", "regex")
+
+    with pytest.raises(Exception, match="Unknown pattern matcher backend"):
+        PatternModel([]).predict(["hello"])
@@ -1,11 +1,24 @@
+import json
+
+import numpy as np
+
 from alchemy import ar
-from alchemy.ar import Example
+from alchemy.ar import EntityIndex, Example, ExampleStore
+from alchemy.ar.pattern_matches import PatternMatches
 from alchemy.db.model import (
     ClassificationAnnotation,
     LabelPatterns,
     User,
     get_or_create,
 )
+from alchemy.inference.cache import load_cached_scores
+from alchemy.inference.pattern_model import PatternModel
+from alchemy.inference.random_model import RandomModel
+from alchemy.train.no_deps.raw_data_columns import (
+    DOMAIN,
+    RawDataColumns,
+    load_raw_data_columns,
+)
 
 
 def test_assign_round_robin():
@@ -70,6 +83,40 @@ def test_assign_blacklist():
     assert per_anno_queue == {"u1": ["b", "c"], "u2": ["a", "b", "c"]}
 
 
+def test_assign_least_loaded_first():
+    datapoints = ["a", "b", "c", "d", "e"]
+    annotators = ["u3", "u1", "u2"]
+
+    def blacklist_fn(dp, anno):
+        return (dp, anno) in {("a", "u1"), ("b", "u1"), ("c", "u2")}
+
+    per_anno_queue = ar._assign(
+        datapoints,
+        annotators,
+        max_per_annotator=2,
+        max_per_dp=2,
+        blacklist_fn=blacklist_fn,
+    )
+
+    # Ties are broken by annotator, and nothing is left for "e" once
+    # everyone has 2 datapoints.
+    assert per_anno_queue == {"u1": ["c", "d"], "u2": ["a", "b"], "u3": ["a", "b"]}
+
+
+def test_assign_duplicate_annotators():
+    # An annotator listed twice gets picked more often, since each listing
+    # has its own place in the queue.
+    per_anno_queue = ar._assign(
+        ["a", "b", "c", "d"], ["u2", "u1", "u1"], max_per_annotator=3, max_per_dp=1
+    )
+    assert per_anno_queue == {"u1": ["a", "b", "d"], "u2": ["c"]}
+
+    per_anno_queue = ar._assign(
+        ["a", "b", "c", "d"], ["u2", "u1"], max_per_annotator=3, max_per_dp=1
+    )
+    assert per_anno_queue == {"u1": ["a", "c"], "u2": ["b", "d"]}
+
+
 def populate_db(dbsession):
     users = [
         get_or_create(dbsession=dbsession, model=User, username="user0"),
@@ -126,6 +173,27 @@ def test_build_blacklist_lookup(dbsession):
     assert lookup == foo_lookup.union(bar_lookup)
 
 
+def test_build_blacklist_lookup_for_entities(dbsession, monkeypatch):
+    populate_db(dbsession)
+    # Make sure the entities are looked up in several batches.
+    monkeypatch.setattr(ar, "_BLACKLIST_QUERY_BATCH_SIZE", 1)
+
+    def key(entity, label, user):
+        return ar.LookupKey(entity_type="blah", entity=entity, label=label, user=user)
+
+    lookup = ar._build_blacklist_lookup(
+        dbsession, ["foo", "bar"], entities=["entity1", "new_entity"]
+    )
+    assert lookup == {key("entity1", "foo", "user0"), key("entity1", "foo", "user1")}
+
+    lookup = ar._build_blacklist_lookup(
+        dbsession, ["foo", "bar"], entities=["entity0", "entity1"]
+    )
+    assert lookup == ar._build_blacklist_lookup(dbsession, ["foo", "bar"])
+
+    assert ar._build_blacklist_lookup(dbsession, ["foo"], entities=[]) == set()
+
+
 def test_blacklisting_requests(dbsession):
     users, entities, annotations = populate_db(dbsession)
 
@@ -184,7 +252,14 @@ def _do_test_shuffle(random_pred_class_a, random_pred_class_b, is_pred_class_a):
     preds_a = [random_pred_class_a(i) for i in range(N)]
     preds_b = [random_pred_class_b(i) for i in range(N)]
 
-    shuffled = ar._shuffle_together_examples([preds_a, preds_b], proportions=[0.8, 0.2])
+    entity_index = EntityIndex()
+    shuffled = ar._shuffle_together_examples(
+        [
+            ExampleStore.from_examples(preds_a, entity_index),
+            ExampleStore.from_examples(preds_b, entity_index),
+        ],
+        proportions=[0.8, 0.2],
+    ).to_examples()
 
     # Since there are N unique lines, the result should contain N elements.
     assert len(shuffled) == N
@@ -273,8 +348,11 @@ def test__consolidate_ranked_examples_per_label__simple():
         [ex("a"), ex("b"), ex("c")],
     ]
 
-    res = ar.consolidate_ranked_examples_per_label(ranked_examples_per_label)
-    res = [x.entity for x in res]
+    entity_index = EntityIndex()
+    res = ar.consolidate_ranked_examples_per_label(
+        [ExampleStore.from_examples(ls, entity_index) for ls in ranked_examples_per_label]
+    )
+    res = [x.entity for x in res.to_examples()]
     assert res == ["a", "b", "c"]
 
 
@@ -297,8 +375,11 @@ def test__consolidate_ranked_examples_per_label__round_robin():
         [ex("c"), ex("a"), ex("b")],
     ]
 
-    res = ar.consolidate_ranked_examples_per_label(ranked_examples_per_label)
-    res = [x.entity for x in res]
+    entity_index = EntityIndex()
+    res = ar.consolidate_ranked_examples_per_label(
+        [ExampleStore.from_examples(ls, entity_index) for ls in ranked_examples_per_label]
+    )
+    res = [x.entity for x in res.to_examples()]
     assert res == ["a", "c", "b"]
 
 
@@ -330,3 +411,333 @@ def test__get_pattern_model_for_label__normal(dbsession):
     res = pat_model.predict(["blah blah hello world", "xyz"])
     assert res[0]["score"] > 0
     assert res[1]["score"] == 0
+
+
+class _LineNumberModel:
+    """Scores each text by its integer value."""
+
+    def predict(self, text_list):
+        return [{"score": float(text)} for text in text_list]
+
+
+def _rows(n):
+    return [{"text": str(i), "meta": {"domain": f"{i}.com"}} for i in range(n)]
+
+
+def test__get_examples_for_models__streaming(make_data_file):
+    fname = make_data_file(_rows(10))
+
+    examples = ar._get_examples_for_models(
+        [fname], [_LineNumberModel(), RandomModel()], "blah", "foo", chunk_size=3
+    )
+
+    assert len(examples) == 2
+    examples = [ex.to_examples() for ex in examples]
+    assert [ex.line_number for ex in examples[0]] == list(range(10))
+    assert [ex.entity for ex in examples[0]] == [f"{i}.com" for i in range(10)]
+    assert len(examples[1]) == 10
+
+
+def test__get_examples_for_models__limit(make_data_file):
+    fname = make_data_file(_rows(10))
+
+    examples = ar._get_examples_for_models(
+        [fname],
+        [_LineNumberModel(), RandomModel()],
+        "blah",
+        "foo",
+        limit=3,
+        chunk_size=2,
+    )
+
+    # Only the top 3 are kept, in descending order of score.
+    examples = [ex.to_examples() for ex in examples]
+    assert [ex.line_number for ex in examples[0]] == [9, 8, 7]
+    assert len(examples[1]) == 3
+    assert len(set(ex.entity for ex in examples[1])) == 3
+
+
+class _CachedLineNumberModel(_LineNumberModel):
+    def __init__(self):
+        self.n_texts = 0
+
+    def predict(self, text_list):
+        self.n_texts += len(text_list)
+        return super().predict(text_list)
+
+    def cache_key(self):
+        return "line_number"
+
+
+def test__get_examples_for_models__cached(monkeypatch, tmp_path, make_data_file):
+    monkeypatch.setenv("ANNOTATION_TOOL_INFERENCE_CACHE_DIR", str(tmp_path / "cache"))
+    fname = make_data_file(_rows(10))
+    model = _CachedLineNumberModel()
+
+    res = []
+    for _ in range(2):
+        examples = ar._get_examples_for_models(
+            [fname], [model], "blah", "foo", limit=3, chunk_size=2
+        )
+        res.append(examples[0].to_examples())
+
+    # The second time around the scores are read from the cache.
+    assert model.n_texts == 10
+    assert res[0] == res[1]
+    assert [ex.line_number for ex in res[1]] == [9, 8, 7]
+    assert [ex.entity for ex in res[1]] == ["9.com", "8.com", "7.com"]
+
+
+def test__get_examples_for_models__cached_no_text(
+    monkeypatch, tmp_path, make_data_file
+):
+    monkeypatch.setenv("ANNOTATION_TOOL_INFERENCE_CACHE_DIR", str(tmp_path / "cache"))
+    fname = make_data_file(_rows(10))
+    models = [_CachedLineNumberModel(), RandomModel()]
+    ar._get_examples_for_models([fname], models, "blah", "foo", limit=3)
+
+    read = []
+    slice_ = RawDataColumns.slice
+
+    def _slice(self, column, start, stop):
+        read.append(column)
+        return slice_(self, column, start, stop)
+
+    monkeypatch.setattr(RawDataColumns, "slice", _slice)
+
+    # The RandomModel doesn't need the text, and the other model is cached.
+    examples = ar._get_examples_for_models([fname], models, "blah", "foo", limit=3)
+    assert models[0].n_texts == 10
+    assert [ex.line_number for ex in examples[0].to_examples()] == [9, 8, 7]
+    assert len(examples[1]) == 3
+    # Only the entities were read.
+    assert set(read) == {DOMAIN}
+
+
+def test__get_examples_for_models__columnar_cache(monkeypatch, make_data_file):
+    fname = make_data_file(_rows(10))
+    # Build the columnar cache.
+    load_raw_data_columns(fname)
+
+    def _iter_jsonl_chunks(*args, **kwargs):
+        raise AssertionError("The jsonl file should not be parsed")
+
+    monkeypatch.setattr(ar, "iter_jsonl_chunks", _iter_jsonl_chunks)
+
+    model = _LineNumberModel()
+    examples = ar._get_examples_for_models(
+        [fname], [model], "blah", "foo", limit=3, chunk_size=4
+    )
+    res = examples[0].to_examples()
+    assert [ex.line_number for ex in res] == [9, 8, 7]
+    assert [ex.entity for ex in res] == ["9.com", "8.com", "7.com"]
+
+
+class _IncompleteModel(_CachedLineNumberModel):
+    """Can't be cached once it has seen the text "0" of a data file."""
+
+    def __init__(self):
+        super().__init__()
+        self.incomplete = False
+
+    def start_data_file(self):
+        self.incomplete = False
+
+    def predict(self, text_list):
+        self.incomplete = self.incomplete or "0" in text_list
+        return super().predict(text_list)
+
+    def cache_key(self):
+        return None if self.incomplete else super().cache_key()
+
+
+def test__get_examples_for_models__cache_per_file(
+    monkeypatch, tmp_path, make_data_file
+):
+    monkeypatch.setenv("ANNOTATION_TOOL_INFERENCE_CACHE_DIR", str(tmp_path / "cache"))
+    fnames = [
+        make_data_file(_rows(3), "data0.jsonl"),
+        make_data_file(_rows(5)[3:], "data1.jsonl"),
+    ]
+    model = _IncompleteModel()
+    ar._get_examples_for_models(fnames, [model], "blah", "foo")
+    assert model.n_texts == 5
+
+    # Only the file without "0" was cached.
+    model.start_data_file()
+    assert load_cached_scores(fnames[0], model) is None
+    assert list(load_cached_scores(fnames[1], model)) == [3.0, 4.0]
+
+
+def test_rank_candidates__merges_data_files(make_data_file):
+    fnames = [
+        make_data_file(
+            [{"text": str(j), "meta": {"domain": f"{i}-{j}.com"}} for j in range(10)],
+            f"data{i}.jsonl",
+        )
+        for i in range(2)
+    ]
+
+    def _get_candidates(data_filenames, entity_index):
+        models = [_LineNumberModel(), _CachedLineNumberModel()]
+        examples = ar._get_examples_for_models(
+            data_filenames,
+            models,
+            "blah",
+            "foo",
+            limit=4,
+            entity_index=entity_index,
+        )
+        return [
+            ar.Candidates(name, proportion, ex)
+            for name, proportion, ex in zip(["a", "b"], [1, 3], examples)
+        ]
+
+    entity_index = EntityIndex()
+    np.random.seed(0)
+    expected = ar.rank_candidates(_get_candidates(fnames, entity_index))
+
+    # Ranking each file on its own, e.g. in different processes, gives the
+    # same result once the candidates are merged.
+    entity_index = EntityIndex()
+    candidates = []
+    for fname in fnames:
+        for x in _get_candidates([fname], EntityIndex()):
+            examples = ExampleStore.from_dict(x.examples.to_dict(), entity_index)
+            candidates.append(x._replace(examples=examples))
+    np.random.seed(0)
+    res = ar.rank_candidates(candidates, limit=4)
+
+    assert res.to_examples() == expected.to_examples()
+    assert len(res) == 4
+
+
+def _pattern_model(*phrases):
+    return PatternModel(
+        [{"label": "POSITIVE", "pattern": [{"lower": x}]} for x in phrases]
+    )
+
+
+def test__get_examples_for_models__pattern_matches(
+    monkeypatch, tmp_path, make_data_file
+):
+    monkeypatch.setenv("ANNOTATION_TOOL_INFERENCE_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("ANNOTATION_TOOL_PATTERN_MATCHER_BACKEND", "aho_corasick")
+    texts = ["a dog", "no match", "a dog and a cat", "cat", "dog dog dog"]
+    fname = make_data_file([{"text": x, "meta": {"domain": x}} for x in texts])
+
+    pattern_matches = PatternMatches([fname])
+    examples = ar._get_examples_for_models(
+        [fname],
+        [_pattern_model("dog", "a cat")],
+        "blah",
+        "foo",
+        limit=3,
+        chunk_size=2,
+        pattern_matches=pattern_matches,
+    )
+    assert [ex.line_number for ex in examples[0].to_examples()] == [4, 2, 0]
+
+    # Only the matches of the candidates are kept.
+    assert pattern_matches.get(fname, 4) == [(0, 1, 0, 3), (1, 2, 4, 7), (2, 3, 8, 11)]
+    assert pattern_matches.get(fname, 2) == [(1, 2, 2, 5), (3, 5, 10, 15)]
+    assert pattern_matches.get(fname, 0) == [(1, 2, 2, 5)]
+    assert pattern_matches.get_score(fname, 2) == 0.6
+    assert pattern_matches.get(fname, 3) is None
+    assert pattern_matches.get("other.jsonl", 4) is None
+
+
+def test_pattern_matches__to_dict_concat():
+    matches = []
+    for fname in ["a.jsonl", "b.jsonl", "c.jsonl"]:
+        x = PatternMatches([fname])
+        if fname != "c.jsonl":
+            spans = [[(0, 1, 0, 3)], [], [(1, 2, 4, 7), (2, 3, 8, 11)]]
+            x.add(fname, 0, spans, [0.5, 0.0, 0.4])
+        examples = [Example(0, "blah", "x", "foo", fname, i) for i in [1, 2]]
+        x.keep([ExampleStore.from_examples(examples)])
+        matches.append(PatternMatches.from_dict(json.loads(json.dumps(x.to_dict()))))
+
+    res = PatternMatches.concat(matches[::-1])
+    for fname in ["a.jsonl", "b.jsonl"]:
+        assert res.get(fname, 0) is None
+        assert res.get(fname, 1) == []
+        assert res.get(fname, 2) == [(1, 2, 4, 7), (2, 3, 8, 11)]
+        assert res.get_score(fname, 1) == 0.0
+        assert res.get_score(fname, 2) == 0.4
+    # The matches weren't recorded for this file, e.g. its scores were cached.
+    assert res.get("c.jsonl", 2) is None
+    assert res.get_score("c.jsonl", 2) is None
+
+
+def test__get_pattern_decor(monkeypatch, tmp_path):
+    monkeypatch.setenv("ANNOTATION_TOOL_PATTERN_MATCHER_BACKEND", "aho_corasick")
+    fname = str(tmp_path / "data.jsonl")
+    text_list = ["my dog is healthy", None, "a dog and a cat"]
+    examples = [Example(0, "blah", None, "foo", fname, i) for i in range(3)]
+    models = [_pattern_model("dog", "healthy"), _pattern_model("dog and a cat")]
+
+    assert ar._get_pattern_decor(examples, text_list, [], []) is None
+
+    # Only the first label recorded its matches, and only for the first
+    # example; the rest are matched again.
+    pattern_matches = [PatternMatches([fname]), PatternMatches([fname])]
+    # The score isn't recomputed from the spans.
+    pattern_matches[0].add(fname, 0, [[(1, 2, 3, 6)]], [0.3])
+    pattern_matches[0].keep([ExampleStore.from_examples(examples[:1])])
+
+    res = ar._get_pattern_decor(examples, text_list, models, pattern_matches)
+    assert res == [
+        # The recorded matches are used as is.
+        {"spans": [(3, 6)], "score": [0.3, 0.0]},
+        {"spans": [], "score": [0.0, 0.0]},
+        {"spans": [(2, 5), (2, 15)], "score": [0.2, 0.8]},
+    ]
+
+    # With a single label, the score isn't a list.
+    res = ar._get_pattern_decor(
+        examples[2:], text_list[2:], models[:1], [PatternMatches([fname])]
+    )
+    assert res == [{"spans": [(2, 5)], "score": 0.2}]
+
+
+def test__load_jsonl_lines(make_data_file):
+    fname = make_data_file(_rows(10))
+
+    rows = ar._load_jsonl_lines(fname, {1, 7})
+    assert rows == {
+        1: {"text": "1", "meta": {"domain": "1.com"}},
+        7: {"text": "7", "meta": {"domain": "7.com"}},
+    }
+
+
+def test_shuffle__small_batches(monkeypatch):
+    monkeypatch.setattr(ar, "_SHUFFLE_BATCH_SIZE", 7)
+
+    def ex(entity, score):
+        return Example(
+            score=score,
+            entity_type="blah",
+            entity=entity,
+            label="foo",
+            fname="data.jsonl",
+            line_number=0,
+        )
+
+    entity_index = EntityIndex()
+    lists = [
+        # Missing and repeated entities are skipped.
+        [ex(None, 0.9), ex("a", 0.8), ex("a", 0.7), ex("b", 0.6)],
+        # Every list ranks some of the same entities.
+        [ex(str(i), 1 - i / 100) for i in range(50)] + [ex("b", 0.5)],
+        [ex(str(i), i / 100) for i in range(30)],
+        [],
+    ]
+    shuffled = ar._shuffle_together_examples(
+        [ExampleStore.from_examples(ls, entity_index) for ls in lists],
+        proportions=[1, 1, 1, 1],
+    ).to_examples()
+
+    entities = [x.entity for x in shuffled]
+    assert len(entities) == len(set(entities))
+    assert set(entities) == {"a", "b"} | set(str(i) for i in range(50))
@@ -0,0 +1,131 @@
+import pytest
+from sqlalchemy.orm import Session
+
+from alchemy.ar import ar_celery
+from alchemy.db.model import LabelPatterns, Task
+from alchemy.inference.pattern_model import PatternModel
+from alchemy.shared import celery_job_status, statistics_refresh
+from alchemy.shared.celery_job_status import JobStatus
+from tests.unit.test_shared_celery_job_status import FakeRedis
+
+TEXTS = ["a dog", "a cat", "dog and cat", "nothing"]
+
+
+class _Database:
+    def __init__(self, bind):
+        self.session = Session(bind=bind)
+
+
+@pytest.fixture
+def task(dbsession, monkeypatch, tmp_path, make_data_file):
+    """A task with 2 labels that have patterns, on 2 data files, whose
+    requests are saved in `task.saved` instead of the database."""
+    monkeypatch.setenv("ALCHEMY_FILESTORE_DIR", str(tmp_path))
+    monkeypatch.setenv("ANNOTATION_TOOL_INFERENCE_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("ANNOTATION_TOOL_PATTERN_MATCHER_BACKEND", "aho_corasick")
+    fake_redis = FakeRedis()
+    monkeypatch.setattr(celery_job_status, "get_redis", lambda: fake_redis)
+    monkeypatch.setattr(statistics_refresh, "schedule_refresh", lambda task_ids: None)
+    monkeypatch.setattr(
+        ar_celery.Database, "from_config", lambda config: _Database(dbsession.bind)
+    )
+    monkeypatch.setattr(ar_celery.app.conf, "task_always_eager", True)
+
+    (tmp_path / "raw_data").mkdir()
+    for i in range(2):
+        make_data_file(
+            [{"text": x, "meta": {"domain": f"{i}-{x}"}} for x in TEXTS],
+            f"raw_data/data{i}.jsonl",
+        )
+
+    task = Task(
+        name="task", default_params={"data_filenames": ["data0.jsonl", "data1.jsonl"]}
+    )
+    task.set_labels(["foo", "bar"])
+    task.set_annotators(["u1", "u2"])
+    dbsession.add(task)
+    for label, pattern in [("foo", "dog"), ("bar", "cat")]:
+        patterns = LabelPatterns(label=label)
+        patterns.set_positive_patterns([pattern])
+        dbsession.add(patterns)
+    dbsession.commit()
+
+    task.saved = {}
+
+    def _save_annotation_requests(dbsession, task_, res, entity_type):
+        task.saved.update(res)
+
+    monkeypatch.setattr(
+        ar_celery, "_save_annotation_requests", _save_annotation_requests
+    )
+    return task
+
+
+def _get_state(celery_id):
+    return celery_job_status.get_redis().hgetall(f"cjs:{celery_id}")[b"s"].decode()
+
+
+def test_generate_annotation_requests__reuses_pattern_matches(
+    task, monkeypatch, tmp_path
+):
+    n_matched = []
+    predict = PatternModel.predict
+
+    def _predict(self, text_list, *args, **kwargs):
+        n_matched.append(len(text_list))
+        return predict(self, text_list, *args, **kwargs)
+
+    monkeypatch.setattr(PatternModel, "predict", _predict)
+
+    n_tokenized = []
+    tokenize = PatternModel._tokenize
+
+    def _tokenize(self, text_list, *args, **kwargs):
+        n_tokenized.append(len(text_list))
+        return tokenize(self, text_list, *args, **kwargs)
+
+    monkeypatch.setattr(PatternModel, "_tokenize", _tokenize)
+
+    r = ar_celery.generate_annotation_requests.apply(args=[task.id, 4, 1, "company"])
+    assert _get_state(r.id) == JobStatus.DONE
+
+    # Each row was matched once per label while ranking, and not again to
+    # decorate the requests.
+    assert sum(n_matched) == sum(n_tokenized) == 2 * 2 * len(TEXTS)
+
+    requests = [x for res in task.saved.values() for x in res]
+    assert len(requests) == 8
+    for x in requests:
+        text = x["data"]["text"]
+        expected = [text.find(w) for w in ["dog", "cat"] if w in text]
+        assert [start for start, _ in x["pattern_info"]["spans"]] == expected
+
+    # The candidates passed through the filestore are cleaned up.
+    assert list((tmp_path / "ar_candidates").iterdir()) == []
+
+
+def test_generate_annotation_requests__no_data_files(task, dbsession):
+    task.default_params = {"data_filenames": []}
+    dbsession.commit()
+
+    r = ar_celery.generate_annotation_requests.apply(args=[task.id, 4, 1, "company"])
+    assert _get_state(r.id) == JobStatus.DONE
+    assert task.saved == {}
+
+
+def test_assign_annotation_requests__labels_changed(task, dbsession):
+    results = [
+        ar_celery.rank_examples_for_label("job", 5, label, fname, 10)
+        for label in ["foo", "bar"]
+        for fname in ar_celery.get_data_filenames(task)
+    ]
+
+    # The labels of the task changed while the examples were ranked.
+    task.set_labels(["baz"])
+    dbsession.commit()
+
+    ar_celery.assign_annotation_requests(
+        results, "job", task.id, ["foo", "bar"], 4, 1, "company"
+    )
+    assert _get_state("job") == JobStatus.DONE
+    assert sum(len(x) for x in task.saved.values()) == 8
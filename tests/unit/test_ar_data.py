@@ -1,7 +1,26 @@
+import csv
+import io
+import json
+from types import SimpleNamespace
+
+from alchemy.ar import data as ar_data
 from alchemy.ar.data import (
     _compute_total_distinct_number_of_annotated_entities_for_label,
+    _insert_annotation_requests,
+    construct_annotation_dict,
+    construct_ar_request_dict,
+    merge_context,
+    read_pattern_info,
+    save_new_ar_for_user_db,
+)
+from alchemy.db.model import (
+    AnnotationRequest,
+    AnnotationRequestStatus,
+    ClassificationAnnotation,
+    EntityContext,
+    User,
 )
-from alchemy.db.model import ClassificationAnnotation, User
+from alchemy.scripts.deduplicate_entity_contexts import deduplicate, restore
 
 
 def test__compute_total_distinct_number_of_annotated_entities_for_label(dbsession):
@@ -41,3 +60,290 @@ def test__compute_total_distinct_number_of_annotated_entities_for_label(dbsessio
         dbsession, "foo"
     )
     assert res == 5
+
+
+def _requests(n):
+    return [
+        {
+            "entity": f"{i}.com",
+            "score": 0.5,
+            "data": {"text": f'text, "{i}"\nmore', "meta": {"domain": f"{i}.com"}},
+        }
+        for i in range(n)
+    ]
+
+
+def test_save_new_ar_for_user_db(dbsession):
+    dbsession.add(User(username="user_1"))
+    dbsession.commit()
+
+    reqs = _requests(5)
+    for _ in range(2):
+        save_new_ar_for_user_db(
+            dbsession, None, "user_1", reqs, "foo", "company", batch_size=2
+        )
+
+    # The existing requests were replaced.
+    saved = dbsession.query(AnnotationRequest).order_by(AnnotationRequest.order).all()
+    assert [x.order for x in saved] == [0, 1, 2, 3, 4]
+    # Requests were generated in reverse order.
+    contexts = [merge_context(x.context, x.entity_context.context) for x in saved]
+    assert contexts == reqs[::-1]
+    assert [x.context for x in saved] == [
+        {"entity": x["entity"], "score": x["score"]} for x in reqs[::-1]
+    ]
+    assert [x.entity for x in saved] == [f"{i}.com" for i in range(5)][::-1]
+    assert all(x.status == AnnotationRequestStatus.Pending for x in saved)
+    assert all(x.user.username == "user_1" and x.label == "foo" for x in saved)
+
+
+class _FakeCursor:
+    def __init__(self):
+        self.copied = []
+
+    def copy_expert(self, sql, f):
+        self.copied.append((sql, f.read()))
+
+    def close(self):
+        pass
+
+
+def test_copy_annotation_requests(monkeypatch):
+    cursor = _FakeCursor()
+
+    class _FakeSession:
+        def get_bind(self):
+            return SimpleNamespace(dialect=SimpleNamespace(name="postgresql"))
+
+        def connection(self):
+            return SimpleNamespace(connection=SimpleNamespace(cursor=lambda: cursor))
+
+    rows = [
+        dict(
+            user_id=1,
+            entity_type="company",
+            entity=req["entity"],
+            label="foo",
+            annotation_type=1,
+            status=0,
+            task_id=None,
+            order=i,
+            context=req,
+            entity_context_id=None,
+        )
+        for i, req in enumerate(_requests(2))
+    ]
+    _insert_annotation_requests(_FakeSession(), rows)
+
+    sql, data = cursor.copied[0]
+    assert sql.startswith('COPY annotation_request ("user_id", ')
+    parsed = list(csv.reader(io.StringIO(data)))
+    assert [row[2] for row in parsed] == ["0.com", "1.com"]
+    # task_id is NULL.
+    assert [row[6] for row in parsed] == ["", ""]
+    assert [json.loads(row[8]) for row in parsed] == [x["context"] for x in rows]
+
+
+def test_save_new_ar_for_user_db__incremental(dbsession):
+    dbsession.add(User(username="user_1"))
+    dbsession.commit()
+
+    reqs = _requests(5)
+    save_new_ar_for_user_db(dbsession, None, "user_1", reqs, "foo", "company")
+    before = {x.entity: x for x in dbsession.query(AnnotationRequest).all()}
+    before["4.com"].status = AnnotationRequestStatus.Complete
+    dbsession.commit()
+    before_ids = {entity: x.id for entity, x in before.items()}
+
+    # Drop 0.com, add 5.com and 6.com, and move 3.com to the front.
+    new_reqs = [reqs[3], reqs[1], reqs[2], reqs[4]] + _requests(7)[5:]
+    save_new_ar_for_user_db(
+        dbsession, None, "user_1", new_reqs, "foo", "company", incremental=True
+    )
+
+    saved = dbsession.query(AnnotationRequest).order_by(AnnotationRequest.order).all()
+    assert [x.entity for x in saved] == [x["entity"] for x in new_reqs[::-1]]
+    assert [x.order for x in saved] == list(range(6))
+    assert all(x.status == AnnotationRequestStatus.Pending for x in saved)
+
+    # Pending requests that are still wanted are kept as is, the completed one
+    # is replaced.
+    ids = {x.entity: x.id for x in saved}
+    for entity in ["1.com", "2.com", "3.com"]:
+        assert ids[entity] == before_ids[entity]
+    assert ids["4.com"] not in before_ids.values()
+
+
+def test_save_new_ar_for_user_db__incremental_context(dbsession):
+    dbsession.add(User(username="user_1"))
+    dbsession.commit()
+
+    reqs = _requests(3)
+    save_new_ar_for_user_db(dbsession, None, "user_1", reqs, "foo", "company")
+    before_ids = {x.entity: x.id for x in dbsession.query(AnnotationRequest).all()}
+
+    # The kept requests get the new score and pattern matches.
+    new_reqs = _requests(3)
+    new_reqs[0]["score"] = 0.9
+    new_reqs[1]["pattern_info"] = {"spans": [[0, 4]], "score": 0.25}
+    save_new_ar_for_user_db(
+        dbsession, None, "user_1", new_reqs, "foo", "company", incremental=True
+    )
+
+    saved = dbsession.query(AnnotationRequest).all()
+    assert {x.entity: x.id for x in saved} == before_ids
+    for x in saved:
+        req = new_reqs[int(x.entity[0])]
+        assert merge_context(x.context, x.entity_context.context) == req
+
+
+def test_save_new_ar_for_user_db__incremental_commit(dbsession, monkeypatch):
+    dbsession.add(User(username="user_1"))
+    dbsession.commit()
+
+    reqs = _requests(3)
+    save_new_ar_for_user_db(dbsession, None, "user_1", reqs, "foo", "company")
+
+    commits = []
+    commit = dbsession.commit
+    monkeypatch.setattr(dbsession, "commit", lambda: commits.append(commit()))
+    insert = ar_data._insert_annotation_requests
+
+    def _insert_annotation_requests(dbsession, rows):
+        # The deletes and updates aren't committed on their own.
+        assert commits == []
+        insert(dbsession, rows)
+
+    monkeypatch.setattr(
+        ar_data, "_insert_annotation_requests", _insert_annotation_requests
+    )
+    new_reqs = reqs[1:] + _requests(5)[3:]
+    new_reqs[0]["score"] = 0.9
+    save_new_ar_for_user_db(
+        dbsession,
+        None,
+        "user_1",
+        new_reqs,
+        "foo",
+        "company",
+        batch_size=1,
+        incremental=True,
+    )
+    assert len(commits) == 1
+
+    saved = dbsession.query(AnnotationRequest).order_by(AnnotationRequest.order).all()
+    assert [x.entity for x in saved] == [x["entity"] for x in new_reqs[::-1]]
+
+
+def test_save_new_ar_for_user_db__entity_contexts(dbsession):
+    dbsession.add_all([User(username="user_1"), User(username="user_2")])
+    dbsession.commit()
+
+    reqs = _requests(3)
+    for username in ["user_1", "user_2"]:
+        save_new_ar_for_user_db(dbsession, None, username, reqs, "foo", "company")
+    # A different label can have different pattern matches.
+    reqs[0]["pattern_info"] = {"spans": [[0, 4]], "score": 0.25}
+    save_new_ar_for_user_db(dbsession, None, "user_1", reqs[:1], "bar", "company")
+
+    # Each context is only stored once.
+    assert dbsession.query(EntityContext).count() == 4
+    saved = dbsession.query(AnnotationRequest).all()
+    assert len({x.entity_context_id for x in saved}) == 4
+
+    for x in saved:
+        req = reqs[0] if x.label == "bar" else _requests(3)[int(x.entity[0])]
+        assert construct_ar_request_dict(dbsession, x.id) == {
+            "ar_id": x.id,
+            "entity": x.entity,
+            "entity_type": "company",
+            "label": x.label,
+            "fname": None,
+            "line_number": None,
+            "score": 0.5,
+            "data": req["data"],
+            "pattern_info": req.get("pattern_info"),
+        }
+
+
+def test_deduplicate_entity_contexts(dbsession):
+    user = User(username="user_1")
+    reqs = _requests(2) * 2
+    dbsession.add_all(
+        [
+            AnnotationRequest(
+                user=user,
+                entity_type="company",
+                entity=req["entity"],
+                label="foo",
+                annotation_type=1,
+                order=i,
+                context=req,
+            )
+            for i, req in enumerate(reqs)
+        ]
+        + [
+            ClassificationAnnotation(
+                user=user,
+                entity_type="company",
+                entity=req["entity"],
+                label="foo",
+                value=1,
+                context={"data": req["data"], "pattern_info": None},
+            )
+            for req in reqs[:2]
+        ]
+        + [
+            ClassificationAnnotation(
+                user=user,
+                entity_type="company",
+                entity="x.com",
+                label="foo",
+                value=1,
+                context="Some text",
+            )
+        ]
+    )
+    dbsession.commit()
+
+    def _dicts():
+        return [construct_ar_request_dict(dbsession, i) for i in range(1, 5)] + [
+            construct_annotation_dict(dbsession, i) for i in range(1, 4)
+        ]
+
+    before = _dicts()
+
+    assert deduplicate(dbsession, AnnotationRequest, batch_size=3) == 4
+    assert deduplicate(dbsession, ClassificationAnnotation, batch_size=3) == 2
+    # The requests of an entity share a context, the annotations have another
+    # one since they have a (null) pattern_info.
+    assert dbsession.query(EntityContext).count() == 4
+    assert dbsession.query(ClassificationAnnotation).get(1).context is None
+
+    assert _dicts() == before
+
+    assert restore(dbsession, AnnotationRequest, batch_size=3) == 4
+    assert [x.context for x in dbsession.query(AnnotationRequest)] == reqs
+
+
+def test_read_pattern_info():
+    data = {"text": "My dog  is healthy!"}
+    old = {
+        "tokens": ["My", "dog", "is", "healthy", "!"],
+        "matches": [[1, 2, "dog"], [1, 4, "dog is healthy"], [1, 2, "dog"]],
+        "score": 0.8,
+    }
+    assert read_pattern_info(old, data) == {
+        "spans": [(3, 6), (3, 18)],
+        "score": 0.8,
+    }
+
+    # Matches past a token that isn't in the text can't be highlighted.
+    assert read_pattern_info(old, {"text": "My dog is sick!"}) == {
+        "spans": [(3, 6)],
+        "score": 0.8,
+    }
+
+    new = {"spans": [[3, 6]], "score": 0.2}
+    assert read_pattern_info(new, data) is new
+    assert read_pattern_info(None, data) is None
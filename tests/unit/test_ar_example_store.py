@@ -0,0 +1,99 @@
+import json
+
+import numpy as np
+
+from alchemy.ar.example_store import EntityIndex, Example, ExampleStore
+
+
+def _ex(score, entity, label="foo", fname="a.jsonl", line_number=0):
+    return Example(
+        score=score,
+        entity_type="blah",
+        entity=entity,
+        label=label,
+        fname=fname,
+        line_number=line_number,
+    )
+
+
+def test_entity_index():
+    index = EntityIndex()
+    assert list(index.get_ids(["a", "b", "a", None])) == [0, 1, 0, -1]
+    assert len(index) == 2
+    assert index.get_entity(1) == "b"
+    assert index.get_entity(-1) is None
+
+
+def test_from_examples_round_trip():
+    examples = [
+        _ex(0.5, "a.com", label="foo", fname="a.jsonl", line_number=3),
+        _ex(0.1, None, label="bar", fname="b.jsonl", line_number=0),
+        _ex(0.9, "c.com", label="foo", fname="b.jsonl", line_number=7),
+    ]
+    store = ExampleStore.from_examples(examples)
+    assert len(store) == 3
+    assert store.to_examples() == examples
+
+
+def test_to_dict_round_trip():
+    examples = [
+        _ex(0.5, "a.com", label="foo", fname="a.jsonl", line_number=3),
+        _ex(0.1, None, label="bar", fname="b.jsonl", line_number=0),
+        _ex(0.9, "a.com", label="foo", fname="b.jsonl", line_number=7),
+    ]
+    d = ExampleStore.from_examples(examples).to_dict()
+    assert d["entities"] == [None, "a.com"]
+
+    # Entities are interned into the given index.
+    index = EntityIndex()
+    index.get_id("z.com")
+    store = ExampleStore.from_dict(json.loads(json.dumps(d)), index)
+    assert store.to_examples() == examples
+    assert list(store.entity_ids) == [1, -1, 1]
+
+    empty = ExampleStore.empty("blah", "foo", ["a.jsonl"])
+    assert len(ExampleStore.from_dict(empty.to_dict())) == 0
+
+
+def test_sorted_is_stable():
+    examples = [_ex(s, str(i), line_number=i) for i, s in enumerate([1, 3, 1, 3, 2])]
+    store = ExampleStore.from_examples(examples)
+    assert [ex.line_number for ex in store.sorted().to_examples()] == [1, 3, 4, 0, 2]
+
+
+def test_top_k_matches_sorted():
+    rng = np.random.RandomState(0)
+    # Lots of ties, to make sure they're broken the same way as a stable sort.
+    scores = rng.randint(0, 5, size=200)
+    examples = [_ex(float(s), str(i), line_number=i) for i, s in enumerate(scores)]
+    store = ExampleStore.from_examples(examples)
+
+    expected = store.sorted().to_examples()
+    for k in [0, 1, 7, 50, 199, 200, 300]:
+        assert store.top_k(k).to_examples() == expected[:k]
+
+
+def test_concat_remaps_vocabularies():
+    a = ExampleStore.from_examples(
+        [_ex(0.1, "x.com", label="foo", fname="a.jsonl", line_number=1)]
+    )
+    b = ExampleStore.from_examples(
+        [
+            _ex(0.2, "y.com", label="bar", fname="b.jsonl", line_number=2),
+            _ex(0.3, "x.com", label="foo", fname="a.jsonl", line_number=3),
+        ]
+    )
+    combined = ExampleStore.concat([a, b])
+
+    assert combined.to_examples() == a.to_examples() + b.to_examples()
+    # The same entity gets the same id, even from a different index.
+    assert combined.entity_ids[0] == combined.entity_ids[2]
+    assert combined.labels == ["foo", "bar"]
+    assert combined.fnames == ["a.jsonl", "b.jsonl"]
+
+
+def test_unique_entities():
+    store = ExampleStore.from_examples(
+        [_ex(0.1, "b.com"), _ex(0.2, None), _ex(0.3, "a.com"), _ex(0.4, "b.com")]
+    )
+    assert sorted(store.unique_entities()) == ["a.com", "b.com"]
@@ -0,0 +1,35 @@
+from collections import OrderedDict
+
+from alchemy.ar import worker
+from alchemy.inference import pattern_matchers
+
+
+def test_maybe_evict_caches(monkeypatch):
+    matchers = OrderedDict({("spacy", "abc"): object()})
+    monkeypatch.setattr(pattern_matchers, "_matchers", matchers)
+    monkeypatch.setattr(worker, "get_rss_mb", lambda: 1000.0)
+
+    monkeypatch.setenv("ANNOTATION_TOOL_AR_WORKER_EVICT_MB", "2000")
+    assert not worker.maybe_evict_caches()
+    assert len(matchers) == 1
+
+    monkeypatch.setenv("ANNOTATION_TOOL_AR_WORKER_EVICT_MB", "500")
+    assert worker.maybe_evict_caches()
+    assert len(matchers) == 0
+
+    # Disabled.
+    matchers[("spacy", "abc")] = object()
+    monkeypatch.setenv("ANNOTATION_TOOL_AR_WORKER_EVICT_MB", "0")
+    assert not worker.maybe_evict_caches()
+    assert len(matchers) == 1
+
+
+def test_get_max_memory_per_child(monkeypatch):
+    monkeypatch.setenv("ANNOTATION_TOOL_AR_WORKER_MAX_MEMORY_MB", "100")
+    assert worker.get_max_memory_per_child() == 100 * 1024
+    monkeypatch.setenv("ANNOTATION_TOOL_AR_WORKER_MAX_MEMORY_MB", "0")
+    assert worker.get_max_memory_per_child() is None
+
+
+def test_get_rss_mb():
+    assert worker.get_rss_mb() > 0
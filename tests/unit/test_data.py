@@ -18,9 +18,13 @@ from alchemy.ar.data import (
     _retrieve_annotation_with_same_entity_shared_by_two_users,
     _retrieve_entity_ids_and_annotation_values_by_user,
     compute_annotation_request_statistics,
+    compute_annotation_statistics_db,
     construct_ar_request_dict,
     fetch_annotated_ar_ids_from_db,
     fetch_ar_ids,
+    fetch_task_statistics,
+    load_task_statistics,
+    refresh_task_statistics,
 )
 from alchemy.db.model import (
     AnnotationRequest,
@@ -275,6 +279,43 @@ def test__construct_kappa_stats_raw_data(dbsession):
     }
 
 
+def test_refresh_task_statistics(dbsession, monkeypatch):
+    monkeypatch.setenv(
+        "ANNOTATION_TOOL_ANNOTATION_SERVER_SERVER", "http://localhost:5001"
+    )
+    _, _, _, _, _, _, label1, label2, _ = _populate_annotation_data(dbsession)
+    task = Task(name="task", default_params={"labels": [label1, label2]})
+    dbsession.add(task)
+    dbsession.commit()
+
+    assert fetch_task_statistics(dbsession, task.id) is None
+    refresh_task_statistics(dbsession, task)
+    # The snapshot is updated in place.
+    refresh_task_statistics(dbsession, task)
+
+    snapshot = fetch_task_statistics(dbsession, task.id)
+    assert 0 <= snapshot.get_age_seconds() < 60
+
+    statistics_per_label, request_statistics = load_task_statistics(
+        snapshot.statistics, task.id
+    )
+    assert request_statistics == compute_annotation_request_statistics(
+        dbsession, task.id
+    )
+    for label in [label1, label2]:
+        expected = compute_annotation_statistics_db(dbsession, label, task.id)
+        res = statistics_per_label[label]
+
+        kappa_table = res.pop("kappa_table")
+        expected_kappa_table = expected.pop("kappa_table")
+        assert list(kappa_table) == list(expected_kappa_table)
+        for k in kappa_table:
+            # Including the NaN of users without overlapping annotations.
+            pd.testing.assert_frame_equal(kappa_table[k], expected_kappa_table[k])
+
+        assert res == expected
+
+
 def _populate_annotation_requests(dbsession):
     username1 = "ooo"
     username2 = "ppp"
@@ -448,7 +489,8 @@ def test_construct_ar_request_dict(dbsession):
         "line_number": request1.context["line_number"],
         "score": request1.context["score"],
         "data": request1.context["data"],
-        "pattern_info": request1.context["pattern_info"],
+        # Converted from the tokens and matches.
+        "pattern_info": {"spans": [(5, 9)], "score": 0.11627906976744186},
         "entity": request1.entity,
         "entity_type": ENTITY_TYPE,
         "label": request1.label,
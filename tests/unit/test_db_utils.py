@@ -1,12 +1,6 @@
 from alchemy.db.utils import is_data_file, is_pattern_file
 
 
-def make_data_file(tmpdir):
-    f = tmpdir.join("data.jsonl")
-    f.write('{"text":"hello"}\n{"text":"world"}')
-    return str(f)
-
-
 def make_pattern_file(tmpdir):
     f = tmpdir.join("pattern.jsonl")
     f.write(
@@ -21,8 +15,8 @@ def make_invalid_file(tmpdir):
     return str(f)
 
 
-def test_file_type_detector(tmpdir):
-    data_file = make_data_file(tmpdir)
+def test_file_type_detector(tmpdir, make_data_file):
+    data_file = make_data_file([{"text": "hello"}, {"text": "world"}])
     pattern_file = make_pattern_file(tmpdir)
     invalid_file = make_invalid_file(tmpdir)
 
@@ -33,3 +27,10 @@ def test_file_type_detector(tmpdir):
     assert is_pattern_file(data_file) is False
     assert is_pattern_file(pattern_file) is True
     assert is_pattern_file(invalid_file) is False
+
+
+def test_file_type_detector_skips_directories(tmpdir):
+    d = str(tmpdir.mkdir(".data.jsonl.index"))
+
+    assert is_data_file(d) is False
+    assert is_pattern_file(d) is False
@@ -0,0 +1,115 @@
+import os
+import time
+
+import numpy as np
+
+from alchemy.inference import get_predicted
+from alchemy.inference.base import ITextCatModel
+from alchemy.inference.cache import (
+    evict,
+    get_file_hash,
+    load_cached_scores,
+    save_cached_scores,
+)
+
+DATA = [
+    {"text": "hello", "meta": {"name": "A", "domain": "a.com"}},
+    {"text": "world", "meta": {"name": "B", "domain": "b.com", "rank": 2}},
+]
+
+
+class CountingModel(ITextCatModel):
+    def __init__(self, key="counting"):
+        self.key = key
+        self.n_calls = 0
+
+    def predict(self, text_list):
+        self.n_calls += 1
+        return [{"score": float(len(text)), "prob": 0.5} for text in text_list]
+
+    def cache_key(self):
+        return self.key
+
+
+class UncachedModel(CountingModel):
+    def cache_key(self):
+        return None
+
+
+def test_get_predicted_cache(monkeypatch, tmp_path, make_data_file):
+    monkeypatch.setenv("ANNOTATION_TOOL_INFERENCE_CACHE_DIR", str(tmp_path / "cache"))
+    fname = make_data_file(DATA)
+    model = CountingModel()
+
+    expected = [
+        {"score": 5.0, "prob": 0.5, "meta": {"name": "A", "domain": "a.com"}},
+        {"score": 5.0, "prob": 0.5, "meta": DATA[1]["meta"]},
+    ]
+    assert get_predicted(fname, model) == expected
+    assert model.n_calls == 1
+
+    # Only the scores are cached.
+    for row in expected:
+        del row["prob"]
+    assert get_predicted(fname, model) == expected
+    assert model.n_calls == 1
+
+    # Bypass the cache.
+    get_predicted(fname, model, cache=False)
+    assert model.n_calls == 2
+
+
+def test_cache_key_changes(monkeypatch, tmp_path, make_data_file):
+    monkeypatch.setenv("ANNOTATION_TOOL_INFERENCE_CACHE_DIR", str(tmp_path / "cache"))
+    fname = make_data_file(DATA)
+    save_cached_scores(fname, CountingModel("v1"), [1.0, 2.0])
+
+    assert list(load_cached_scores(fname, CountingModel("v1"))) == [1.0, 2.0]
+    assert load_cached_scores(fname, CountingModel("v2")) is None
+
+    # Changing the data file invalidates the cache.
+    time.sleep(0.01)
+    make_data_file(DATA[:1])
+    assert load_cached_scores(fname, CountingModel("v1")) is None
+
+
+def test_uncached_model(monkeypatch, tmp_path, make_data_file):
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setenv("ANNOTATION_TOOL_INFERENCE_CACHE_DIR", str(cache_dir))
+    fname = make_data_file(DATA)
+    model = UncachedModel()
+
+    get_predicted(fname, model)
+    get_predicted(fname, model)
+    assert model.n_calls == 2
+    assert not cache_dir.exists()
+
+
+def test_get_file_hash(make_data_file):
+    fname = make_data_file(DATA)
+    other_fname = make_data_file(DATA, "other.jsonl")
+
+    assert get_file_hash(fname) == get_file_hash(other_fname)
+
+    time.sleep(0.01)
+    make_data_file(DATA[:1])
+    assert get_file_hash(fname) != get_file_hash(other_fname)
+
+
+def test_evict(monkeypatch, tmp_path, make_data_file):
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setenv("ANNOTATION_TOOL_INFERENCE_CACHE_DIR", str(cache_dir))
+    fname = make_data_file(DATA)
+
+    for key in ["a", "b", "c"]:
+        save_cached_scores(fname, CountingModel(key), np.zeros(100))
+    size = os.path.getsize(next(cache_dir.iterdir()))
+
+    # "a" is now the most recently used.
+    time.sleep(0.01)
+    assert load_cached_scores(fname, CountingModel("a")) is not None
+
+    evict(str(cache_dir), 2 * size)
+    assert load_cached_scores(fname, CountingModel("a")) is not None
+    assert load_cached_scores(fname, CountingModel("b")) is None
+    assert load_cached_scores(fname, CountingModel("c")) is not None
@@ -1,5 +1,14 @@
+import time
+
+import numpy as np
+import pytest
+
 from alchemy.db.model import Model
+from alchemy.inference import nlp_model as nlp_model_module
+from alchemy.inference import prob_index
+from alchemy.inference.prob_index import ProbIndex, get_inference_fingerprint
 from alchemy.inference.nlp_model import (
+    InferenceBudget,
     NLPModel,
     NLPModelBottomResults,
     NLPModelTopResults,
@@ -20,11 +29,14 @@ def test_highest_entropy_nlp_model(dbsession, monkeypatch, tmp_path):
         {"score": 0.0, "prob": None}
     ]
 
-    assert nlp_model.predict(["hello", "bonjour", "nihao"]) == [
-        {"score": 0.33734745550768536, "prob": 0.5276218490386013},
-        {"score": 0.07659863544127907, "prob": 0.9201215737671476},
-        {"score": 0.07659863544127907, "prob": 0.9201215737671476},
-    ]
+    res = nlp_model.predict(["hello", "bonjour", "nihao"])
+    # The probabilities are stored as float32.
+    assert [x["score"] for x in res] == pytest.approx(
+        [0.33734745550768536, 0.07659863544127907, 0.07659863544127907]
+    )
+    assert [x["prob"] for x in res] == pytest.approx(
+        [0.5276218490386013, 0.9201215737671476, 0.9201215737671476]
+    )
 
     assert len(nlp_model._cache) == 3
 
@@ -38,16 +50,171 @@ def test_top_bottom_nlp_model(dbsession, monkeypatch, tmp_path):
 
     nlp_model_top = NLPModelTopResults(dbsession, model.id)
 
-    assert nlp_model_top.predict(["hello", "bonjour", "nihao"]) == [
-        {"score": 0.5276218490386013, "prob": 0.5276218490386013},
-        {"score": 0.9201215737671476, "prob": 0.9201215737671476},
-        {"score": 0.9201215737671476, "prob": 0.9201215737671476},
-    ]
+    res = nlp_model_top.predict(["hello", "bonjour", "nihao"])
+    # The probabilities are stored as float32.
+    assert [x["score"] for x in res] == pytest.approx(
+        [0.5276218490386013, 0.9201215737671476, 0.9201215737671476]
+    )
+    assert [x["prob"] for x in res] == pytest.approx(
+        [0.5276218490386013, 0.9201215737671476, 0.9201215737671476]
+    )
 
     nlp_model_bottom = NLPModelBottomResults(dbsession, model.id)
 
-    assert nlp_model_bottom.predict(["hello", "bonjour", "nihao"]) == [
-        {"score": -0.5276218490386013, "prob": 0.5276218490386013},
-        {"score": -0.9201215737671476, "prob": 0.9201215737671476},
-        {"score": -0.9201215737671476, "prob": 0.9201215737671476},
+    res = nlp_model_bottom.predict(["hello", "bonjour", "nihao"])
+    # The probabilities are stored as float32.
+    assert [x["score"] for x in res] == pytest.approx(
+        [-0.5276218490386013, -0.9201215737671476, -0.9201215737671476]
+    )
+    assert [x["prob"] for x in res] == pytest.approx(
+        [0.5276218490386013, 0.9201215737671476, 0.9201215737671476]
+    )
+
+
+def test_nlp_model_cache_key(dbsession, monkeypatch, tmp_path):
+    monkeypatch.setenv("ALCHEMY_FILESTORE_DIR", str(tmp_path))
+
+    create_example_model(dbsession)
+
+    model = dbsession.query(Model).first()
+
+    key = NLPModel(dbsession, model.id).cache_key()
+    assert key == NLPModel(dbsession, model.id).cache_key()
+    assert key != NLPModelTopResults(dbsession, model.id).cache_key()
+    assert NLPModel(dbsession, model.id + 1).cache_key() is None
+
+
+def test_nlp_models_share_prob_index(dbsession, monkeypatch, tmp_path):
+    monkeypatch.setenv("ALCHEMY_FILESTORE_DIR", str(tmp_path))
+
+    create_example_model(dbsession)
+
+    model = dbsession.query(Model).first()
+
+    nlp_models = [
+        NLPModel(dbsession, model.id),
+        NLPModelTopResults(dbsession, model.id),
+        NLPModelBottomResults(dbsession, model.id),
+    ]
+    indexes = [x._warm_up_cache() for x in nlp_models]
+    assert indexes[0] is indexes[1] is indexes[2]
+
+    # The index is persisted with the inference results.
+    inference_dir = tmp_path / "models" / "abc" / "1" / "inference"
+    assert (inference_dir / "prob_index.json").is_file()
+    assert ProbIndex.load(model.dir(abs=True), []) is None
+    index = ProbIndex.load(
+        model.dir(abs=True), get_inference_fingerprint(model.dir(abs=True))
+    )
+    assert list(index.hashes) == list(indexes[0].hashes)
+
+    # The index is rebuilt when the inference results change.
+    time.sleep(0.01)
+    np.save(str(inference_dir / "myfile.pred.npy"), np.array([[0.0, 0.0]] * 3))
+    res = NLPModelTopResults(dbsession, model.id).predict(["hello"])
+    assert res == [{"score": 0.5, "prob": 0.5}]
+
+
+def _mock_infer(calls):
+    def _infer(version_dir, text_list):
+        calls.append(text_list)
+        return np.array([0.25] * len(text_list), dtype=np.float32)
+
+    return _infer
+
+
+def test_nlp_model_infers_missing_texts(dbsession, monkeypatch, tmp_path):
+    monkeypatch.setenv("ALCHEMY_FILESTORE_DIR", str(tmp_path))
+    calls = []
+    monkeypatch.setattr(nlp_model_module, "_infer", _mock_infer(calls))
+
+    create_example_model(dbsession)
+
+    model = dbsession.query(Model).first()
+    (tmp_path / "models" / "abc" / "1" / "model").mkdir()
+
+    res = NLPModelTopResults(dbsession, model.id).predict(
+        ["hello", "new text", "other text", "new text"]
+    )
+    assert calls == [["new text", "other text"]]
+    assert [x["prob"] for x in res] == pytest.approx([0.5276218, 0.25, 0.25, 0.25])
+
+    # The results are shared and persisted.
+    prob_index._loaded.clear()
+    res = NLPModelBottomResults(dbsession, model.id).predict(["other text"])
+    assert res == [{"score": -0.25, "prob": 0.25}]
+    assert len(calls) == 1
+
+    # They're kept when the index is rebuilt.
+    prob_index._loaded.clear()
+    (tmp_path / "models" / "abc" / "1" / "inference" / "prob_index.json").unlink()
+    res = NLPModel(dbsession, model.id).predict(["other text"])
+    assert res[0]["prob"] == 0.25
+    assert len(calls) == 1
+
+
+def test_nlp_model_inference_budget(dbsession, monkeypatch, tmp_path):
+    monkeypatch.setenv("ALCHEMY_FILESTORE_DIR", str(tmp_path))
+    monkeypatch.setenv("ANNOTATION_TOOL_NLP_MODEL_INFERENCE_BUDGET", "1")
+    calls = []
+    monkeypatch.setattr(nlp_model_module, "_infer", _mock_infer(calls))
+
+    create_example_model(dbsession)
+
+    model = dbsession.query(Model).first()
+    (tmp_path / "models" / "abc" / "1" / "model").mkdir()
+
+    nlp_model = NLPModelTopResults(dbsession, model.id)
+    assert nlp_model.cache_key() is not None
+    res = nlp_model.predict(["new text", "other text"])
+    assert calls == [["new text"]]
+    assert res == [{"score": 0.25, "prob": 0.25}, {"score": 0.0, "prob": None}]
+
+    # Some texts have no results, so the scores can't be cached.
+    assert nlp_model.cache_key() is None
+
+    # Until the model scores another data file.
+    nlp_model.start_data_file()
+    assert nlp_model.cache_key() is not None
+
+
+def test_nlp_models_share_inference_budget(dbsession, monkeypatch, tmp_path):
+    monkeypatch.setenv("ALCHEMY_FILESTORE_DIR", str(tmp_path))
+    calls = []
+    monkeypatch.setattr(nlp_model_module, "_infer", _mock_infer(calls))
+
+    create_example_model(dbsession)
+
+    model = dbsession.query(Model).first()
+    (tmp_path / "models" / "abc" / "1" / "model").mkdir()
+
+    budget = InferenceBudget(2)
+    nlp_models = [
+        NLPModel(dbsession, model.id, budget),
+        NLPModelTopResults(dbsession, model.id, budget),
+        NLPModelBottomResults(dbsession, model.id, budget),
     ]
+    for i, nlp_model in enumerate(nlp_models):
+        nlp_model.predict([f"text {i}"])
+
+    # The budget is spent once for all the models.
+    assert calls == [["text 0"], ["text 1"]]
+    assert budget.remaining == 0
+
+
+def test_nlp_model_inference_fails(dbsession, monkeypatch, tmp_path):
+    monkeypatch.setenv("ALCHEMY_FILESTORE_DIR", str(tmp_path))
+
+    def _infer(version_dir, text_list):
+        raise Exception("No model")
+
+    monkeypatch.setattr(nlp_model_module, "_infer", _infer)
+
+    create_example_model(dbsession)
+
+    model = dbsession.query(Model).first()
+    (tmp_path / "models" / "abc" / "1" / "model").mkdir()
+
+    nlp_model = NLPModel(dbsession, model.id)
+    assert nlp_model.predict(["new text"]) == [{"score": 0.0, "prob": None}]
+    assert nlp_model._inference_budget.remaining == 0
@@ -0,0 +1,120 @@
+import os
+import subprocess
+import sys
+from collections import OrderedDict
+
+import pytest
+
+from alchemy.inference import pattern_matchers
+from alchemy.inference.pattern_matchers import get_phrase_matcher
+from alchemy.inference.pattern_model import PatternModel
+
+PATTERNS = [
+    {"label": "HEALTHCARE", "pattern": [{"lower": "health"}]},
+    {"label": "HEALTHCARE", "pattern": [{"lower": "Dog is healthy"}]},
+]
+
+
+@pytest.fixture
+def blank_nlp(monkeypatch, tmp_path):
+    """Use a blank English pipeline, which only has a tokenizer."""
+    monkeypatch.setenv("ANNOTATION_TOOL_INFERENCE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setenv("ANNOTATION_TOOL_PATTERN_MODEL_SPACY_MODEL", "blank:en")
+    monkeypatch.setattr(pattern_matchers, "_matchers", OrderedDict())
+    return pattern_matchers.get_nlp()
+
+
+def test_get_phrase_matcher(blank_nlp):
+    matcher = get_phrase_matcher(PATTERNS)
+    assert get_phrase_matcher(list(PATTERNS)) is matcher
+    assert get_phrase_matcher(PATTERNS[:1]) is not matcher
+
+    doc = blank_nlp("my dog is healthy")
+    assert [(start, end) for _, start, end in matcher(doc)] == [(1, 4)]
+
+
+def test_get_phrase_matcher__persisted(blank_nlp, monkeypatch):
+    get_phrase_matcher(PATTERNS)
+
+    # A new process only has to load the tokens of the phrases.
+    def _tokenize_patterns(tokenize, spacy_patterns):
+        raise AssertionError("Patterns should not be tokenized again")
+
+    monkeypatch.setattr(pattern_matchers, "_matchers", OrderedDict())
+    monkeypatch.setattr(pattern_matchers, "_tokenize_patterns", _tokenize_patterns)
+    matcher = get_phrase_matcher(PATTERNS)
+
+    doc = blank_nlp("my health")
+    assert [(start, end) for _, start, end in matcher(doc)] == [(1, 2)]
+
+
+def test_get_phrase_matcher__bad_pattern(blank_nlp):
+    with pytest.raises(Exception, match="Cannot load pattern"):
+        get_phrase_matcher([{"label": "X", "pattern": [{"orth": "health"}]}])
+
+
+def test_pattern_models_share_matcher(blank_nlp):
+    models = [PatternModel(PATTERNS), PatternModel(PATTERNS)]
+    for model in models:
+        model._load()
+    assert models[0].matcher is models[1].matcher
+
+    assert models[0].predict(["my dog is healthy"], fancy=True) == [
+        {
+            "tokens": ["my", "dog", "is", "healthy"],
+            "matches": [(1, 4, "dog is healthy")],
+            "score": 0.75,
+        }
+    ]
+
+
+def test_pattern_model_parallel(blank_nlp):
+    model = PatternModel(PATTERNS)
+    text_list = [
+        "my dog is healthy",
+        None,
+        "health",
+        "",
+        "a dog is healthy, and my health is good",
+        "nothing to see here",
+        "Health",
+    ]
+
+    expected = model.predict(text_list, fancy=True)
+    assert [x["score"] for x in expected] == [0.75, 0.0, 1.0, 0.0, 0.4, 0.0, 0.0]
+
+    res = model.predict(text_list, fancy=True, n_process=2, batch_size=2)
+    assert res == expected
+
+
+def test_pattern_model_spans(blank_nlp):
+    model = PatternModel(PATTERNS)
+    text_list = ["a dog is healthy, and my health is good", "nothing"]
+
+    res = model.predict(text_list, spans=True)
+    assert res == [
+        {"score": 0.4, "spans": [(1, 4, 2, 16), (7, 8, 25, 31)]},
+        {"score": 0.0, "spans": []},
+    ]
+
+
+def test_aho_corasick_without_spacy(tmp_path):
+    # Make importing spaCy fail, in a fresh process.
+    code = """
+import sys
+sys.modules["spacy"] = None
+from alchemy.inference.pattern_model import PatternModel
+model = PatternModel([{"label": "A", "pattern": [{"lower": "health"}]}])
+print(model.predict(["my health is good"])[0]["score"])
+"""
+    env = {
+        "ANNOTATION_TOOL_PATTERN_MATCHER_BACKEND": "aho_corasick",
+        "ANNOTATION_TOOL_INFERENCE_CACHE_DIR": str(tmp_path),
+    }
+    res = subprocess.run(
+        [sys.executable, "-c", code],
+        env={**os.environ, **env},
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    assert res.stdout.decode().split() == ["0.25"]
@@ -1,11 +1,10 @@
-from functools import cmp_to_key
-
 import pytest
 
 from alchemy.inference.pattern_model import (
     PatternModel,
-    _compare_matches,
     _maximize_non_overlapping_matches,
+    _score_matches,
+    _select_non_overlapping_matches,
 )
 
 
@@ -48,18 +47,22 @@ def test_pattern_model_phrase():
 @pytest.mark.parametrize(
     "matches,expected",
     [
-        ([("", 3, 4), ("", 1, 2)], [("", 1, 2), ("", 3, 4)]),
-        ([("", 3, 5), ("", 1, 2)], [("", 1, 2), ("", 3, 5)]),
-        ([("", 3, 5), ("", 1, 6)], [("", 1, 6), ("", 3, 5)]),
-        ([("", 3, 5), ("", 3, 6)], [("", 3, 5), ("", 3, 6)]),
-        ([("", 3, 7), ("", 3, 5)], [("", 3, 5), ("", 3, 7)]),
-        ([("", 3, 5), ("", 3, 5)], [("", 3, 5), ("", 3, 5)]),
+        # Sorted by start.
+        ([(3, 4), (1, 2)], [1, 0]),
+        ([(3, 5), (1, 2)], [1, 0]),
+        # The longer of 2 overlapping matches is kept.
+        ([(3, 5), (1, 6)], [1]),
+        ([(3, 5), (3, 6)], [1]),
+        ([(3, 7), (3, 5)], [0]),
+        # Or the later one if they have the same length.
+        ([(3, 5), (3, 5)], [1]),
     ],
 )
-def test_compare_matches(matches, expected):
-    # format: ("", match_start_index, match_end_index_exclusive)
-    sorted_matches = sorted(matches, key=cmp_to_key(_compare_matches))
-    assert sorted_matches == expected
+def test_select_non_overlapping_matches__order(matches, expected):
+    # format: (match_start_index, match_end_index_exclusive)
+    starts, ends = zip(*matches)
+    selected = _select_non_overlapping_matches([0] * len(matches), starts, ends)
+    assert selected.tolist() == expected
 
 
 def test_maximize_non_overlapping_matches():
@@ -95,3 +98,43 @@ def test_maximize_non_overlapping_matches():
     matches4 = [("", 1, 2)]
     selected_matches = _maximize_non_overlapping_matches(matches=matches4)
     assert selected_matches == {("", 1, 2)}
+
+
+def test_select_non_overlapping_matches():
+    # The matches of test_maximize_non_overlapping_matches, for 3 documents at
+    # once, in reverse order.
+    docs = [
+        [(1, 2), (2, 3), (2, 4), (3, 5), (4, 5), (4, 6), (8, 9)],
+        [(1, 2), (2, 3), (2, 4), (3, 4), (3, 5), (4, 5), (4, 6)],
+        [(3, 5)],
+    ]
+    matches = [(i, start, end) for i, doc in enumerate(docs) for start, end in doc]
+    doc_ids, starts, ends = zip(*reversed(matches))
+
+    selected = _select_non_overlapping_matches(doc_ids, starts, ends)
+    assert [(doc_ids[i], starts[i], ends[i]) for i in selected] == [
+        (0, 1, 2),
+        (0, 4, 6),
+        (0, 8, 9),
+        (1, 1, 2),
+        (1, 4, 6),
+        (2, 3, 5),
+    ]
+
+    assert len(_select_non_overlapping_matches([], [], [])) == 0
+
+
+def test_score_matches():
+    scores, selected = _score_matches(
+        doc_ids=[0, 0, 2, 2],
+        starts=[0, 1, 0, 3],
+        ends=[2, 3, 1, 5],
+        n_tokens=[4, 0, 5, 0],
+    )
+    # [1, 3) is kept over [0, 2), which it overlaps and is as long as.
+    assert scores.tolist() == [0.5, 0.0, 0.6, 0.0]
+    assert selected.tolist() == [1, 2, 3]
+
+    scores, selected = _score_matches([], [], [], n_tokens=[3, 0])
+    assert scores.tolist() == [0.0, 0.0]
+    assert len(selected) == 0
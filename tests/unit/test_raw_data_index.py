@@ -0,0 +1,59 @@
+import os
+import time
+
+from alchemy.db.raw_data_index import RawDataIndex, get_raw_data_index, index_dir
+
+
+ROWS = [{"text": f"héllo {i}", "meta": {"domain": f"{i % 3}.com"}} for i in range(5)]
+
+
+def test_read_lines(make_data_file):
+    fname = make_data_file(ROWS)
+    index = get_raw_data_index(fname)
+
+    assert len(index) == 5
+    assert index.read_lines([4, 1, 99]) == {
+        1: {"text": "héllo 1", "meta": {"domain": "1.com"}},
+        4: {"text": "héllo 4", "meta": {"domain": "1.com"}},
+    }
+    assert index.read_lines([]) == {}
+
+
+def test_lookup_entity(make_data_file):
+    fname = make_data_file(ROWS)
+    index = get_raw_data_index(fname)
+
+    assert index.get_lines_for_entity("1.com") == [1, 4]
+    assert index.get_lines_for_entity("x.com") == []
+    assert index.get_row_for_entity("0.com")["text"] == "héllo 3"
+    assert index.get_row_for_entity("x.com") is None
+
+
+def test_index_is_saved_and_invalidated(make_data_file):
+    fname = make_data_file(ROWS)
+    assert RawDataIndex.load(fname) is None
+
+    get_raw_data_index(fname)
+    assert os.path.isdir(index_dir(fname))
+    assert len(RawDataIndex.load(fname)) == 5
+
+    # Changing the file makes the saved index stale.
+    time.sleep(0.01)
+    with open(fname, "a") as f:
+        f.write('{"text": "new", "meta": {"domain": "new.com"}}\n')
+    assert RawDataIndex.load(fname) is None
+
+    index = get_raw_data_index(fname)
+    assert len(index) == 6
+    assert index.read_lines([5])[5]["text"] == "new"
+    assert len(RawDataIndex.load(fname)) == 6
+
+
+def test_empty_file(tmp_path):
+    fname = str(tmp_path / "empty.jsonl")
+    open(fname, "w").close()
+
+    index = get_raw_data_index(fname)
+    assert len(index) == 0
+    assert index.read_lines([0]) == {}
+    assert index.get_row_for_entity("a.com") is None
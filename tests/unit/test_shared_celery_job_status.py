@@ -2,9 +2,11 @@ from alchemy.shared import celery_job_status
 from alchemy.shared.celery_job_status import (
     CeleryJobStatus,
     JobStatus,
+    count_step_done,
     create_status,
     delete_status,
     set_status,
+    sweep_stale_statuses,
 )
 
 
@@ -12,22 +14,71 @@ class FakeRedis:
     def __init__(self):
         self.store = {}
 
-    def set(self, k, v):
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def delete(self, *keys):
+        for k in keys:
+            self.store.pop(k, None)
+
+    def expire(self, k, seconds):
+        pass
+
+    def set(self, k, v, nx=False, ex=None):
+        if nx and k in self.store:
+            return None
         self.store[k] = str(v).encode()
+        return True
+
+    def hset(self, k, mapping):
+        h = self.store.setdefault(k, {})
+        h.update({f.encode(): str(v).encode() for f, v in mapping.items()})
+
+    def hincrby(self, k, f, n):
+        h = self.store.setdefault(k, {})
+        h[f.encode()] = str(int(h.get(f.encode(), 0)) + n).encode()
+        return int(h[f.encode()])
 
-    def get(self, k):
-        return self.store.get(k)
+    def hgetall(self, k):
+        return dict(self.store.get(k, {}))
 
-    def delete(self, k):
-        del self.store[k]
+    def hdel(self, k, f):
+        self.store.get(k, {}).pop(f.encode(), None)
+
+    def llen(self, k):
+        return len(self.store.get(k, []))
 
     def sadd(self, k, v):
         self.store[k] = self.store.get(k, set())
-        self.store[k].add(v)
+        self.store[k].add(v.encode())
 
     def srem(self, k, v):
         if k in self.store and isinstance(self.store[k], set):
-            self.store[k].remove(v)
+            self.store[k].discard(v.encode())
+
+    def smembers(self, k):
+        return set(self.store.get(k, set()))
+
+    def scan_iter(self, match):
+        assert match.endswith("*")
+        return [k.encode() for k in self.store if k.startswith(match[:-1])]
+
+
+class FakePipeline:
+    """Runs the commands when executed, like a redis pipeline."""
+
+    def __init__(self, fake_redis):
+        self.fake_redis = fake_redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        fn = getattr(self.fake_redis, name)
+        return lambda *args, **kwargs: self.commands.append((fn, args, kwargs))
+
+    def execute(self):
+        res = [fn(*args, **kwargs) for fn, args, kwargs in self.commands]
+        self.commands = []
+        return res
 
 
 def test_celery_job_status(monkeypatch):
@@ -43,7 +94,7 @@ def test_celery_job_status(monkeypatch):
     # Application creates a status.
     create_status(celery_id, context_id)
 
-    assert len(fake_redis.store) == 3
+    assert len(fake_redis.store) == 2
 
     cjs = CeleryJobStatus.fetch_by_celery_id(celery_id)
     assert cjs.state == JobStatus.INIT
@@ -75,3 +126,58 @@ def test_celery_job_status(monkeypatch):
     delete_status(celery_id, context_id)
 
     assert CeleryJobStatus.fetch_by_celery_id(celery_id) is None
+
+
+def test_count_step_done(monkeypatch):
+    fake_redis = FakeRedis()
+    monkeypatch.setattr(celery_job_status, "get_redis", lambda: fake_redis)
+
+    celery_id = "test_12345"
+    context_id = "myapp:blah"
+    create_status(celery_id, context_id)
+
+    count_step_done(celery_id, n_steps=4)
+    cjs = CeleryJobStatus.fetch_by_celery_id(celery_id)
+    assert str(cjs) == "STARTED - 25.00% complete"
+
+    count_step_done(celery_id, n_steps=4)
+    cjs = CeleryJobStatus.fetch_by_celery_id(celery_id)
+    assert str(cjs) == "STARTED - 50.00% complete"
+
+    delete_status(celery_id, context_id)
+    assert fake_redis.hgetall(f"cjs:{celery_id}") == {}
+
+
+def test_fetch_all_by_context_id(monkeypatch):
+    fake_redis = FakeRedis()
+    monkeypatch.setattr(celery_job_status, "get_redis", lambda: fake_redis)
+
+    create_status("b", "myapp:blah", created_at=2.0)
+    create_status("a", "myapp:blah", created_at=1.0)
+    create_status("c", "myapp:other", created_at=3.0)
+    set_status("b", JobStatus.STARTED, progress=0.5)
+
+    res = CeleryJobStatus.fetch_all_by_context_id("myapp:blah")
+    assert [(x.celery_id, str(x)) for x in res] == [
+        ("a", "INIT"),
+        ("b", "STARTED - 50.00% complete"),
+    ]
+    assert CeleryJobStatus.fetch_by_celery_ids(["c", "d"])[1] is None
+
+
+def test_sweep_stale_statuses(monkeypatch):
+    fake_redis = FakeRedis()
+    monkeypatch.setattr(celery_job_status, "get_redis", lambda: fake_redis)
+
+    create_status("running", "myapp:blah")
+    set_status("running", JobStatus.STARTED, progress=0.5)
+    create_status("done", "myapp:blah")
+    set_status("done", JobStatus.DONE, updated_at=0.0)
+    create_status("old", "myapp:other", created_at=0.0)
+    # Only in the context, e.g. its status was stored in the old format.
+    fake_redis.sadd("cjss:myapp:other", "gone")
+
+    assert sweep_stale_statuses() == 3
+    assert fake_redis.smembers("cjss:myapp:blah") == {b"running"}
+    assert fake_redis.smembers("cjss:myapp:other") == set()
+    assert CeleryJobStatus.fetch_by_celery_id("done") is None
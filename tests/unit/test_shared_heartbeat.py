@@ -0,0 +1,97 @@
+import json
+import time
+from types import SimpleNamespace
+
+from alchemy.shared import celery_job_status, health_check, heartbeat
+from alchemy.shared.heartbeat import (
+    get_queue_status,
+    publish_heartbeat,
+    remove_heartbeat,
+)
+from tests.unit.test_shared_celery_job_status import FakeRedis
+
+
+def _setup_redis(monkeypatch):
+    fake_redis = FakeRedis()
+    monkeypatch.setattr(celery_job_status, "get_redis", lambda: fake_redis)
+    monkeypatch.setattr(heartbeat, "get_redis", lambda: fake_redis)
+    return fake_redis
+
+
+def test_get_queue_status(monkeypatch):
+    fake_redis = _setup_redis(monkeypatch)
+    fake_redis.store["ar_celery"] = ["task"] * 3
+
+    publish_heartbeat(["ar_celery"], "ar_celery1@a", 2, 1, now=1000)
+    publish_heartbeat(["ar_celery"], "ar_celery2@b", 4, 3, now=1005)
+    # Too old, the worker is gone.
+    publish_heartbeat(["ar_celery"], "ar_celery3@c", 8, 8, now=900)
+
+    status = get_queue_status(["ar_celery", "train_celery"], now=1010)
+    assert status == {
+        "ar_celery": {
+            "ok": True,
+            "age": 5,
+            "workers": 2,
+            "concurrency": 6,
+            "in_flight": 4,
+            "depth": 3,
+        },
+        "train_celery": {
+            "ok": False,
+            "age": None,
+            "workers": 0,
+            "concurrency": 0,
+            "in_flight": 0,
+            "depth": 0,
+        },
+    }
+
+    # Stale once 3 heartbeats were missed.
+    assert not get_queue_status(["ar_celery"], now=1036)["ar_celery"]["ok"]
+
+    remove_heartbeat(["ar_celery"], "ar_celery2@b")
+    status = get_queue_status(["ar_celery"], now=1010)["ar_celery"]
+    assert status["workers"] == 1
+    assert status["age"] == 10
+
+
+def test_heartbeat_thread(monkeypatch):
+    fake_redis = _setup_redis(monkeypatch)
+    monkeypatch.setenv("ANNOTATION_TOOL_HEARTBEAT_INTERVAL", "0.01")
+
+    consumer = SimpleNamespace(
+        hostname="ar_celery1@a",
+        app=SimpleNamespace(
+            amqp=SimpleNamespace(
+                queues=SimpleNamespace(
+                    consumer_queues=[SimpleNamespace(name="ar_celery")]
+                )
+            )
+        ),
+        pool=SimpleNamespace(num_processes=3),
+        controller=SimpleNamespace(concurrency=2),
+    )
+    hb = heartbeat._Heartbeat(consumer)
+    hb.start()
+    try:
+        deadline = time.time() + 5
+        while "hb:ar_celery" not in fake_redis.store and time.time() < deadline:
+            time.sleep(0.01)
+        assert get_queue_status(["ar_celery"])["ar_celery"]["concurrency"] == 3
+        value = json.loads(fake_redis.store["hb:ar_celery"][b"ar_celery1@a"])
+        assert value["in_flight"] == 0
+    finally:
+        hb.stopped.set()
+        hb.join()
+
+    # The worker is gone.
+    assert fake_redis.store["hb:ar_celery"] == {}
+
+
+def test_check_celery(monkeypatch):
+    _setup_redis(monkeypatch)
+    assert not health_check.check_celery()
+
+    publish_heartbeat(["ar_celery"], "ar_celery1@a", 2, 0)
+    assert health_check.check_celery()
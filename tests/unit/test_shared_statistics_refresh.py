@@ -0,0 +1,86 @@
+from alchemy.ar import ar_celery
+from alchemy.db.model import Task
+from alchemy.shared import statistics_refresh
+from alchemy.shared.statistics_refresh import (
+    get_task_ids_with_labels,
+    invalidate_label_tasks,
+    mark_started,
+    schedule_refresh,
+    schedule_refresh_for_labels,
+)
+from tests.unit.test_shared_celery_job_status import FakeRedis
+
+
+def _setup(monkeypatch):
+    fake_redis = FakeRedis()
+    monkeypatch.setattr(statistics_refresh, "get_redis", lambda: fake_redis)
+
+    scheduled = []
+
+    def apply_async(args, countdown):
+        scheduled.append((args[0], countdown))
+
+    monkeypatch.setattr(ar_celery.refresh_task_statistics, "apply_async", apply_async)
+    return scheduled
+
+
+def test_schedule_refresh(monkeypatch):
+    scheduled = _setup(monkeypatch)
+    monkeypatch.setenv("ANNOTATION_TOOL_STATISTICS_REFRESH_DELAY", "5")
+
+    schedule_refresh([1, 2])
+    # Already scheduled, the refresh will include this change.
+    schedule_refresh([1])
+    assert scheduled == [(1, 5), (2, 5)]
+
+    # Changes made once the refresh started need another one.
+    mark_started(1)
+    schedule_refresh([1, 2])
+    assert scheduled == [(1, 5), (2, 5), (1, 5)]
+
+
+def test_schedule_refresh__redis_down(monkeypatch):
+    scheduled = _setup(monkeypatch)
+
+    def get_redis():
+        raise ConnectionError("Redis is down")
+
+    monkeypatch.setattr(statistics_refresh, "get_redis", get_redis)
+    schedule_refresh([1])
+    assert scheduled == []
+
+
+def test_schedule_refresh_for_labels(dbsession, monkeypatch):
+    scheduled = _setup(monkeypatch)
+
+    tasks = [
+        Task(name="a", default_params={"labels": ["x", "y"]}),
+        Task(name="b", default_params={"labels": ["y"]}),
+        Task(name="c", default_params={}),
+    ]
+    dbsession.add_all(tasks)
+    dbsession.commit()
+
+    schedule_refresh_for_labels(dbsession, ["y"])
+    assert [task_id for task_id, _ in scheduled] == [tasks[0].id, tasks[1].id]
+
+
+def test_get_task_ids_with_labels(dbsession, monkeypatch):
+    _setup(monkeypatch)
+
+    task = Task(name="a", default_params={"labels": ["x", "y"]})
+    dbsession.add(task)
+    dbsession.commit()
+
+    assert get_task_ids_with_labels(dbsession, ["x"]) == [task.id]
+    assert get_task_ids_with_labels(dbsession, ["z"]) == []
+
+    # The tasks of each label are cached.
+    other = Task(name="b", default_params={"labels": ["x", "z"]})
+    dbsession.add(other)
+    dbsession.commit()
+    assert get_task_ids_with_labels(dbsession, ["x", "z"]) == [task.id]
+
+    invalidate_label_tasks()
+    assert get_task_ids_with_labels(dbsession, ["x", "z"]) == [task.id, other.id]
+    assert get_task_ids_with_labels(dbsession, ["z"]) == [other.id]
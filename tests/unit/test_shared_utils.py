@@ -5,8 +5,10 @@ from alchemy.shared.utils import (
     build_counter,
     get_entropy,
     get_weighted_majority_vote,
+    iter_jsonl_chunks,
     json_lookup,
     list_to_textarea,
+    save_jsonl,
     stem,
     textarea_to_list,
 )
@@ -115,3 +117,12 @@ def test_get_weighted_majority_vote():
     ]
     res = get_weighted_majority_vote(weighted_votes, invalid_values=(0, -3, None))
     assert res is None, "No valid votes present"
+
+
+def test_iter_jsonl_chunks(tmp_path):
+    fname = str(tmp_path / "data.jsonl")
+    save_jsonl(fname, [{"text": str(i)} for i in range(5)])
+
+    chunks = list(iter_jsonl_chunks(fname, chunk_size=2))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    assert [row["text"] for chunk in chunks for row in chunk] == list("01234")
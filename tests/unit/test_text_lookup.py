@@ -19,3 +19,27 @@ def test_get_entity_text_lookup_function(monkeypatch, tmp_path):
     assert fn(dummy_entity_id, "x") == ""
     assert fn(dummy_entity_id + 1, "a") == ""
     assert fn(dummy_entity_id + 1, "x") == ""
+
+
+def test_get_entity_text_lookup_function_by_domain(monkeypatch, tmp_path):
+    monkeypatch.setenv("ALCHEMY_FILESTORE_DIR", str(tmp_path))
+    dummy_entity_id = 123
+    p = tmp_path / "data.jsonl"
+    data = [
+        {"text": "hello world", "meta": {"domain": "a.com"}},
+        {"text": "lorem ipsum", "meta": {"domain": "b.com"}},
+        {"text": "no domain", "meta": {}},
+        {"text": "hello again", "meta": {"domain": "a.com"}},
+    ]
+    save_jsonl(str(p), data)
+
+    fn = get_entity_text_lookup_function(
+        str(p), "meta.domain", "text", dummy_entity_id
+    )
+
+    # Like a dict, the last row of an entity wins.
+    assert fn(dummy_entity_id, "a.com") == "hello again"
+    assert fn(dummy_entity_id, "b.com") == "lorem ipsum"
+    assert fn(dummy_entity_id, "x.com") == ""
+    assert fn(dummy_entity_id, None) == ""
+    assert fn(dummy_entity_id + 1, "a.com") == ""
@@ -0,0 +1,78 @@
+import os
+import time
+
+from alchemy.train.no_deps.raw_data_columns import (
+    DOMAIN,
+    NAME,
+    TEXT,
+    RawDataColumns,
+    cache_dir,
+    hash_text,
+    load_raw_data_columns,
+)
+from alchemy.train.no_deps.utils import load_original_data_text
+
+DATA = [
+    {"text": "héllo wörld", "meta": {"name": "A", "domain": "a.com", "id": [1]}},
+    {"text": None, "meta": {"domain": "b.com"}},
+    {"text": "", "meta": {"name": "😀", "domain": "c.com"}},
+    {"text": " lorem ipsum\n"},
+]
+
+
+def test_load_raw_data_columns(make_data_file):
+    fname = make_data_file(DATA)
+
+    for _ in range(2):
+        # The second time around we read from the cache.
+        columns = load_raw_data_columns(fname)
+        assert os.path.isfile(os.path.join(cache_dir(fname), "meta.json"))
+
+        assert len(columns) == 4
+        assert columns.get(TEXT) == ["héllo wörld", None, "", " lorem ipsum\n"]
+        assert columns.get(NAME) == ["A", None, "😀", None]
+        assert columns.get(DOMAIN) == ["a.com", "b.com", "c.com", None]
+        assert columns.get_meta() == [row.get("meta", {}) for row in DATA]
+        assert list(columns.text_hash) == [
+            hash_text("héllo wörld"),
+            hash_text(""),
+            hash_text(""),
+            hash_text("lorem ipsum"),
+        ]
+
+
+def test_raw_data_columns_slice(make_data_file):
+    columns = load_raw_data_columns(make_data_file(DATA))
+
+    assert columns.slice(TEXT, 0, 2) == ["héllo wörld", None]
+    assert columns.slice(TEXT, 2, 10) == ["", " lorem ipsum\n"]
+    assert columns.slice(NAME, 1, 3) == [None, "😀"]
+    assert columns.slice(DOMAIN, 4, 6) == []
+
+
+def test_load_raw_data_columns__stale_cache(make_data_file):
+    fname = make_data_file(DATA)
+    load_raw_data_columns(fname)
+
+    time.sleep(0.01)
+    make_data_file(DATA[:1])
+    stat = os.stat(fname)
+    assert RawDataColumns.load(cache_dir(fname), stat) is None
+
+    columns = load_raw_data_columns(fname)
+    assert columns.get(TEXT) == ["héllo wörld"]
+    assert RawDataColumns.load(cache_dir(fname), stat) is not None
+
+
+def test_load_raw_data_columns__fallback(tmp_path, make_data_file):
+    assert load_raw_data_columns(str(tmp_path / "missing.jsonl")) is None
+
+    # Text that isn't a string can't be stored in the columns.
+    fname = make_data_file([{"text": 123}])
+    assert load_raw_data_columns(fname) is None
+    assert not os.path.exists(cache_dir(fname))
+
+
+def test_load_original_data_text(make_data_file):
+    fname = make_data_file(DATA)
+    assert load_original_data_text(fname) == ["héllo wörld", "", "", " lorem ipsum\n"]